@@ -5,7 +5,8 @@ sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 import cv2
 import os
 import time
-import serial
+from serial_link import SerialLink
+import argparse
 from dotenv import load_dotenv
 
 # Nạp biến môi trường
@@ -14,50 +15,34 @@ load_dotenv(env_path)
 
 EXPECTED_PIN = os.getenv('EXPECTED_PIN', '2828')
 
-def init_serial(port='COM4', baudrate=115200):
-    try:
-        ser = serial.Serial(port, baudrate, timeout=1)
-        print(f"[INFO] Đã kết nối Serial tại {port}")
-        return ser
-    except serial.SerialException as e:
-        print(f"[ERROR] Không thể kết nối Serial: {e}")
-        return None
-
-def send_serial_command(ser, command):
-    if ser and ser.is_open:
-        ser.write(f"{command}\n".encode())
+def send_serial_command(link, command):
+    if link and link.is_open:
+        link.request(command)
         print(f"[INFO] Đã gửi: {command}")
 
-def main():
+def main(port='COM4'):
     print("[INFO] Bắt đầu quá trình thu thập khuôn mặt...")
     
-    ser = init_serial()
+    ser = SerialLink.open(port)
     if not ser:
         print("[ERROR] Không thể kết nối với ESP32.")
         return
     
-    # Gửi yêu cầu nhập PIN
+    # Gửi yêu cầu nhập PIN và chờ PIN_ENTERED / PIN_TIMEOUT (thread Serial đánh thức, không vòng bận)
+    requested_at = time.perf_counter()
     send_serial_command(ser, "PIN_REQUIRED")
     print("[INFO] Đang chờ người dùng nhập PIN trên ESP32...")
     
     received_pin = ""
-    start_wait = time.time()
-    
-    while time.time() - start_wait < 30:
-        if ser.in_waiting > 0:
-            response = ser.readline().decode('utf-8').strip()
-            print(f"[DEBUG] ESP32 Response: {response}")
-            
-            if response.startswith("PIN_ENTERED:"):
-                received_pin = response.replace("PIN_ENTERED:", "").strip()
-                print(f"[INFO] Đã nhận PIN từ ESP32: {received_pin}")
-                break
-            
-            if "PIN_TIMEOUT" in response:
-                print("[FAIL] Người dùng không nhập PIN kịp thời.")
-                send_serial_command(ser, "FAIL")
-                ser.close()
-                return
+    response = ser.wait_for(('PIN_ENTERED', 'PIN_TIMEOUT'), timeout=30, since=requested_at)
+    if response is not None and response.kind == 'PIN_TIMEOUT':
+        print("[FAIL] Người dùng không nhập PIN kịp thời.")
+        send_serial_command(ser, "FAIL")
+        ser.close()
+        return
+    if response is not None:
+        received_pin = response.value
+        print(f"[INFO] Đã nhận PIN từ ESP32: {received_pin}")
     
     # Kiểm tra PIN
     if received_pin != EXPECTED_PIN:
@@ -76,4 +61,6 @@ def main():
     ser.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Thu thập khuôn mặt sau khi xác thực PIN trên ESP32")
+    parser.add_argument("--serial_port", default="COM4", help="Cổng ESP32 (hoặc pty của esp32_emulator.py)")
+    main(parser.parse_args().serial_port)
\ No newline at end of file
@@ -2,20 +2,16 @@ import sys, io
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 
 import cv2
-import numpy as np
 import os
-import pickle
 from datetime import datetime
 import firebase_admin
 from firebase_admin import credentials, storage, db
 import requests
 from dotenv import load_dotenv
 import pyttsx3
-from facenet_pytorch import MTCNN, InceptionResnetV1
 import torch
 import time
 import traceback
-import serial
 import pygame
 import threading
 import re
@@ -29,9 +25,25 @@ from image_enhancement import (
     enhance_image_for_low_light, 
     auto_gamma,  # THAY ĐỔI: Dùng auto_gamma thay vì adjust_gamma
     auto_brightness_contrast, 
-    detect_low_light,
-    preprocess_image  # THÊM: Hàm pipeline tự động
+    DENOISE_MODES
 )
+from gallery_matcher import GalleryMatcher
+from ann_index import load_index, DEFAULT_NPROBE
+from gallery_prototypes import PrototypeMatcher, load_prototypes, MATCH_MODES
+from gallery_store import load_gallery, remove_gallery, GalleryStoreError
+import trainer
+from model_loader import load_mtcnn, load_metrics, ModelLoadError
+from embedding_backend import load_embedder, embedder_version, gallery_model_version, BACKENDS, MODEL_VERSIONS
+from face_pipeline import PIPELINE_MODES, create_full_frame_mtcnn
+from recognition_pipeline import STAGES, FrameProcessor, RecognitionPipeline, load_face_detectors
+from camera_capture import CaptureThread
+from serial_link import SerialLink
+from fake_camera import ScriptedCamera
+from event_dispatcher import EventDispatcher, RecognitionEvent
+from face_tracker import FaceTracker
+from presence_gate import PresenceGate
+from frame_scheduler import AdaptiveScheduler
+from metrics import REGISTRY, DEFAULT_METRICS_PORT, start_http_server, start_unix_server
 
 # Thiết lập logging cho thống kê hiệu năng
 logging.basicConfig(
@@ -66,62 +78,53 @@ if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
 distance = None
 distance_lock = threading.Lock()
 
+# Metrics Prometheus (GET /metrics, xem metrics.py); vòng xử lý giữ sẵn các chuỗi theo nhãn
+STAGE_LATENCY = REGISTRY.histogram('smartlock_stage_latency_seconds',
+                                   'Độ trễ từng bước xử lý frame (capture = tuổi frame khi bắt đầu xử lý)', ('stage',))
+DECISION_LATENCY = REGISTRY.histogram('smartlock_decision_latency_seconds',
+                                      'Từ lúc camera chụp đến khi có kết quả nhận diện')
+FRAMES = REGISTRY.counter('smartlock_frames', 'Frame camera theo cách xử lý', ('result',))
+LOW_LIGHT_FRAMES = REGISTRY.counter('smartlock_low_light_frames', 'Frame ánh sáng yếu')
+FACES = REGISTRY.counter('smartlock_faces', 'Khuôn mặt đủ lớn được phát hiện')
+RECOGNITIONS = REGISTRY.counter('smartlock_recognitions', 'Khuôn mặt được so khớp theo kết quả', ('result',))
+SCHEDULER_LEVEL = REGISTRY.gauge('smartlock_scheduler_level', 'Mức chất lượng hiện tại của bộ lập lịch')
+DISTANCE_CM = REGISTRY.gauge('smartlock_distance_cm', 'Khoảng cách siêu âm gần nhất (-1 = ngoài phạm vi)')
+
 # Xác định device cho Torch
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 print(f"[INFO] Sử dụng device: {device}")
 
-# Khởi tạo Serial và đọc khoảng cách
+# Khởi tạo Serial: SerialLink giữ cổng, một thread đọc duy nhất chia DISTANCE và phản hồi lệnh
 def init_serial(port='COM4', baudrate=115200):
-    try:
-        ser = serial.Serial(port, baudrate, timeout=1)
-        print(f"[INFO] Đã kết nối Serial tại {port}")
-        return ser
-    except serial.SerialException as e:
-        print(f"[ERROR] Không thể kết nối Serial: {e}")
-        return None
+    link = SerialLink.open(port, baudrate)
+    if link is not None:
+        link.subscribe('DISTANCE', update_distance)
+    return link
 
-def read_distance_from_serial(ser):
+def update_distance(event):
     global distance
-    try:
-        while True:
-            if ser.in_waiting > 0:
-                line = ser.readline().decode('utf-8', errors='ignore').strip()
-                if line.startswith("DISTANCE:"):
-                    distance_str = line.replace("DISTANCE:", "")
-                    with distance_lock:
-                        if distance_str == "OUT_RANGE":
-                            distance = "Ngoài phạm vi"
-                        else:
-                            try:
-                                distance = float(distance_str.replace(" cm", ""))
-                                print(f"[INFO] Khoảng cách nhận được: {distance} cm")
-                            except ValueError:
-                                distance = "Lỗi định dạng"
-            time.sleep(0.1)  # Giảm tải CPU
-    except serial.SerialException as e:
-        print(f"[ERROR] Lỗi Serial trong thread: {e}")
-    finally:
-        if ser.is_open:
-            ser.close()
+    with distance_lock:
+        distance = event.value if event.value is not None else "Ngoài phạm vi"
+    DISTANCE_CM.set(event.value if event.value is not None else -1)
 
 # Gửi lệnh Serial
-def send_serial_command(ser, command, expected_response=None, timeout=10):
-    if ser and ser.is_open:
-        try:
-            ser.reset_input_buffer()
-            ser.write(f"{command}\n".encode())
-            print(f"[INFO] Đã gửi: {command}, đợi phản hồi...")
-            start_time = time.time()
-            while time.time() - start_time < timeout:
-                if ser.in_waiting > 0:
-                    response = ser.readline().decode('utf-8').strip()
-                    print(f"[INFO] ESP phản hồi: {response}")
-                    if expected_response is None or expected_response in response:
-                        return True
-            print("[WARNING] Hết thời gian chờ phản hồi từ ESP.")
-        except serial.SerialException as e:
-            print(f"[ERROR] Lỗi Serial: {e}")
-    return False
+def send_serial_command(link, command, expected_response=None, timeout=10):
+    """
+    Không có expected_response: gửi và không chờ (độ trễ xác nhận "[CMD] ..." vẫn được SerialLink ghi lại).
+    Có expected_response: chờ sự kiện đó tối đa timeout giây. Returns: True nếu gửi/nhận phản hồi thành công.
+    """
+    if link is None or not link.is_open:
+        return False
+    print(f"[INFO] Đã gửi: {command}")
+    future = link.request(command, expect=expected_response, timeout=timeout)
+    if expected_response is None:
+        return True
+    response = future.result()
+    if response is None:
+        print("[WARNING] Hết thời gian chờ phản hồi từ ESP.")
+        return False
+    print(f"[INFO] ESP phản hồi: {response.line}")
+    return True
 
 def play_startup_sound(sound_path):
     try:
@@ -201,152 +204,89 @@ def write_activity_log(lock_id, event_type, user_name, confidence, image_url):
 # ---------------------------------------------
 
 # Tải danh sách tên và embeddings từ Firebase hoặc cache cục bộ (sử dụng device)
-def load_known_faces(bucket, local_dir, lock_id):
-    # Tạo thư mục riêng cho từng lock_id
-    lock_dataset_dir = os.path.join(local_dir, lock_id)
-    os.makedirs(lock_dataset_dir, exist_ok=True)
-    embeddings_path = os.path.join(lock_dataset_dir, "embeddings.pkl")
-    
-    # Kiểm tra xem file embeddings đã tồn tại chưa
-    if not os.path.exists(embeddings_path):
-        print(f"[INFO] Không tìm thấy embeddings cho khóa {lock_id}. Đang gọi trainer...")
-        # Gọi trainer.py để tạo embeddings
-        trainer_script = os.path.join(os.path.dirname(__file__), 'trainer.py')
-        import subprocess
-        try:
-            result = subprocess.run(
-                [sys.executable, trainer_script, lock_id],
-                check=True,
-                capture_output=True,
-                text=True,
-                encoding='utf-8'
-            )
-            print(result.stdout)
-            if result.stderr:
-                print(f"[WARNING] Trainer stderr: {result.stderr}")
-        except subprocess.CalledProcessError as e:
-            print(f"[ERROR] Trainer thất bại: {e.stderr}")
-            return [], [], []
-    
-    # Tải embeddings từ file đã được tạo
-    if os.path.exists(embeddings_path):
+def run_trainer(lock_id, lock_dataset_dir, bucket=None, models=None, isolate=False, backend="torch"):
+    """
+    Tạo gallery cho khóa bằng trainer.
+    Mặc định chạy ngay trong tiến trình này, dùng lại bucket và model đã tải (models = (mtcnn, resnet, device)).
+    isolate=True: gọi trainer.py trong tiến trình con như trước (tải lại torch/Firebase/model),
+    với cùng backend embedding để gallery khớp embedder của vòng nhận diện.
+    Returns: Gallery đã tạo hoặc None nếu thất bại.
+    """
+    if not isolate:
+        mtcnn, resnet, model_device = models if models is not None else (None, None, None)
         try:
-            with open(embeddings_path, 'rb') as f:
-                data = pickle.load(f)
-                # Xử lý cả định dạng cũ (4 phần tử) và mới (3 phần tử)
-                if len(data) == 4:
-                    print("[WARNING] Phát hiện file embeddings định dạng cũ. Đang xóa và tạo lại...")
-                    os.remove(embeddings_path)
-                    # Gọi lại trainer để tạo mới
-                    trainer_script = os.path.join(os.path.dirname(__file__), 'trainer.py')
-                    import subprocess
-                    try:
-                        result = subprocess.run(
-                            [sys.executable, trainer_script, lock_id],
-                            check=True,
-                            capture_output=True,
-                            text=True,
-                            encoding='utf-8'
-                        )
-                        print(result.stdout)
-                        # Đọc lại file mới
-                        with open(embeddings_path, 'rb') as f2:
-                            known_embeddings, known_ids, known_names = pickle.load(f2)
-                    except subprocess.CalledProcessError as e:
-                        print(f"[ERROR] Trainer thất bại: {e.stderr}")
-                        return [], [], []
-                elif len(data) == 3:
-                    known_embeddings, known_ids, known_names = data
-                else:
-                    print(f"[ERROR] Định dạng file embeddings không hợp lệ")
-                    return [], [], []
-                
-                print(f"[INFO] Đã tải {len(known_ids)} embeddings từ cache cho khóa {lock_id}")
-                return known_embeddings, known_ids, known_names
+            return trainer.generate_embeddings(lock_id, mtcnn=mtcnn, resnet=resnet, device=model_device,
+                                               bucket=bucket, backend=backend)
         except Exception as e:
-            print(f"[ERROR] Lỗi khi đọc file embeddings: {e}")
-            print("[INFO] Đang xóa file lỗi và tạo lại...")
-            try:
-                os.remove(embeddings_path)
-                # Gọi trainer để tạo mới
-                trainer_script = os.path.join(os.path.dirname(__file__), 'trainer.py')
-                import subprocess
-                result = subprocess.run(
-                    [sys.executable, trainer_script, lock_id],
-                    check=True,
-                    capture_output=True,
-                    text=True,
-                    encoding='utf-8'
-                )
-                print(result.stdout)
-                # Đọc lại file mới
-                with open(embeddings_path, 'rb') as f:
-                    known_embeddings, known_ids, known_names = pickle.load(f)
-                    print(f"[INFO] Đã tải {len(known_ids)} embeddings từ cache sau khi tạo lại")
-                    return known_embeddings, known_ids, known_names
-            except Exception as e2:
-                print(f"[ERROR] Không thể tạo lại embeddings: {e2}")
-                return [], [], []
-    
-    print(f"[WARNING] Không thể tạo embeddings cho khóa {lock_id}")
-    return [], [], []
-
-# Tải mô hình DNN
-def get_model_paths():
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    cascades_dir = os.path.abspath(os.path.join(base_dir, "..", "cascades"))
-    proto_path = os.path.join(cascades_dir, "deploy.prototxt")
-    model_path = os.path.join(cascades_dir, "res10_300x300_ssd_iter_140000.caffemodel")
-    return proto_path, model_path
-
-def check_model_files():
-    proto_path, model_path = get_model_paths()
-    if not os.path.exists(proto_path):
-        print(f"[ERROR] Không tìm thấy file prototxt tại: {proto_path}")
-        print("Vui lòng tải từ: https://raw.githubusercontent.com/opencv/opencv/master/samples/dnn/face_detector/deploy.prototxt")
-        return False
-    if not os.path.exists(model_path):
-        print(f"[ERROR] Không tìm thấy file model tại: {model_path}")
-        print("Vui lòng tải từ: https://github.com/opencv/opencv_3rdparty/raw/dnn_samples_face_detector_20180205_fp16/res10_300x300_ssd_iter_140000_fp16.caffemodel")
-        return False
-    print("[SUCCESS] Tất cả file mô hình đã sẵn sàng")
-    return True
+            print(f"[ERROR] Trainer thất bại: {e}")
+            return None
 
-def load_deep_face_detector():
-    proto_path, model_path = get_model_paths()
-    if not check_model_files():
-        print("[WARNING] Sử dụng Haar Cascade thay thế")
+    trainer_script = os.path.join(os.path.dirname(__file__), 'trainer.py')
+    import subprocess
+    try:
+        result = subprocess.run(
+            [sys.executable, trainer_script, lock_id, "--embed_backend", backend],
+            check=True,
+            capture_output=True,
+            text=True,
+            encoding='utf-8'
+        )
+        print(result.stdout)
+        if result.stderr:
+            print(f"[WARNING] Trainer stderr: {result.stderr}")
+    except subprocess.CalledProcessError as e:
+        print(f"[ERROR] Trainer thất bại: {e.stderr}")
         return None
     try:
-        net = cv2.dnn.readNetFromCaffe(proto_path, model_path)
-        print("[INFO] Đã tải thành công DNN model")
-        return net
-    except Exception as e:
-        print(f"[ERROR] Lỗi khi tải DNN model: {str(e)}")
+        return load_gallery(lock_dataset_dir, migrate=False)
+    except GalleryStoreError as e:
+        print(f"[ERROR] Không thể tạo lại embeddings: {e}")
         return None
 
-def detect_faces_dnn(net, frame, conf_threshold=0.7):
-    h, w = frame.shape[:2]
-    blob = cv2.dnn.blobFromImage(cv2.resize(frame, (300, 300)), 1.0, (300, 300), (104.0, 177.0, 123.0))
-    net.setInput(blob)
-    detections = net.forward()
-    faces = []
-    min_face_size = 150
-    for i in range(detections.shape[2]):
-        confidence = detections[0, 0, i, 2]
-        if confidence > conf_threshold:
-            box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-            (x, y, x2, y2) = box.astype("int")
-            width, height = x2 - x, y2 - y
-            if width >= min_face_size and height >= min_face_size:
-                faces.append((x, y, width, height))
-    return faces
-
-def send_telegram_message_with_photo(message, photo_path):
+def load_known_faces(bucket, local_dir, lock_id, models=None, isolate_trainer=False, backend="torch"):
+    """
+    Mở gallery của khóa (ma trận mmap + nhãn dạng mã), chuyển đổi embeddings.pkl cũ một lần nếu có.
+    Gallery thiếu hoặc hỏng -> xóa và gọi trainer đúng một lần (xem run_trainer).
+    Gallery tạo bằng embedder khác (vd. torch trong khi chạy onnx-int8) -> gọi trainer để embed lại;
+    nếu vẫn không khớp thì từ chối dùng gallery.
+    Returns: (embeddings [N, D], ids, names)
+    """
+    expected_version = embedder_version(models[1]) if models is not None else MODEL_VERSIONS[backend]
+    # Tạo thư mục riêng cho từng lock_id
+    lock_dataset_dir = os.path.join(local_dir, lock_id)
+    os.makedirs(lock_dataset_dir, exist_ok=True)
+
+    try:
+        gallery = load_gallery(lock_dataset_dir)
+    except GalleryStoreError as e:
+        print(f"[ERROR] Gallery lỗi: {e}. Đang xóa và tạo lại...")
+        remove_gallery(lock_dataset_dir)
+        gallery = None
+
+    if gallery is not None and gallery_model_version(gallery.header) != expected_version:
+        print(f"[WARNING] Gallery khóa {lock_id} tạo bằng {gallery_model_version(gallery.header)}, "
+              f"embedder hiện tại là {expected_version}. Đang gọi trainer để embed lại...")
+        gallery = None
+
+    if gallery is None:
+        print(f"[INFO] Không tìm thấy embeddings cho khóa {lock_id}. Đang gọi trainer...")
+        gallery = run_trainer(lock_id, lock_dataset_dir, bucket=bucket, models=models, isolate=isolate_trainer,
+                              backend=backend)
+        if gallery is None:
+            print(f"[WARNING] Không thể tạo embeddings cho khóa {lock_id}")
+            return [], [], []
+        if gallery_model_version(gallery.header) != expected_version:
+            print(f"[ERROR] Gallery khóa {lock_id} vẫn không khớp embedder {expected_version}, bỏ qua")
+            return [], [], []
+
+    print(f"[INFO] Đã tải {len(gallery.ids)} embeddings (gallery thế hệ {gallery.header['generation']}) cho khóa {lock_id}")
+    return gallery.embeddings, gallery.ids, gallery.names
+
+def send_telegram_message_with_photo(message, photo_path=None, photo_bytes=None):
     if not message or not isinstance(message, str) or len(message.strip()) == 0:
         print("[ERROR] Tin nhắn không hợp lệ hoặc rỗng, bỏ qua gửi Telegram.")
         return False
-    if not os.path.exists(photo_path):
+    if photo_bytes is None and (photo_path is None or not os.path.exists(photo_path)):
         print(f"[ERROR] File ảnh không tồn tại tại: {photo_path}")
         return False
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
@@ -354,7 +294,10 @@ def send_telegram_message_with_photo(message, photo_path):
         return False
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendPhoto"
     payload = {'chat_id': TELEGRAM_CHAT_ID, 'caption': message.strip()}
-    files = {'photo': open(photo_path, 'rb')}
+    if photo_bytes is not None:
+        files = {'photo': io.BytesIO(photo_bytes)}
+    else:
+        files = {'photo': open(photo_path, 'rb')}
     try:
         response = requests.post(url, data=payload, files=files, timeout=5)
         if response.status_code != 200:
@@ -384,6 +327,56 @@ def upload_and_get_url(bucket, local_path, lock_id, remote_folder='logs'):
     except Exception as e:
         print(f"[ERROR] Lỗi khi upload ảnh log: {e}")
         return None
+
+def upload_bytes_and_get_url(bucket, image_bytes, lock_id, remote_folder='logs'):
+    if not image_bytes:
+        return None
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    filename = f"log_{timestamp}.jpg"
+    blob = bucket.blob(f"locks/{lock_id}/{remote_folder}/{filename}")
+
+    try:
+        blob.upload_from_string(image_bytes, content_type='image/jpeg')
+        blob.make_public()
+        return blob.public_url
+    except Exception as e:
+        print(f"[ERROR] Lỗi khi upload ảnh log: {e}")
+        return None
+# -----------------------------------------
+
+# --- Dispatcher cho các tác vụ phụ sau mỗi sự kiện nhận diện ---
+def build_event_dispatcher(bucket):
+    """
+    Tạo dispatcher với 3 sink chạy nền:
+    - storage: upload ảnh + ghi activity_log (1 worker để giữ thứ tự sự kiện)
+    - telegram: gửi ảnh + caption
+    - speech: đọc thông báo (engine TTS được tạo trong chính worker)
+    Lệnh Serial mở cửa KHÔNG đi qua dispatcher.
+    """
+    dispatcher = EventDispatcher()
+
+    def handle_storage(event, _):
+        if event.frame is not None:
+            event.image_url = upload_bytes_and_get_url(bucket, event.jpeg_bytes(), event.lock_id)
+        write_activity_log(event.lock_id, event.event_type, event.name, event.confidence,
+                           event.resolved_image_url())
+
+    def handle_telegram(event, _):
+        send_telegram_message_with_photo(event.message, photo_bytes=event.jpeg_bytes())
+
+    def handle_speech(event, engine):
+        if engine:
+            engine.say(event.speech)
+            engine.runAndWait()
+
+    dispatcher.register_sink('storage', handle_storage, workers=1, queue_size=16)
+    dispatcher.register_sink('telegram', handle_telegram, workers=2, queue_size=16)
+    dispatcher.register_sink('speech', handle_speech, workers=1, queue_size=2, init=init_tts_engine)
+    return dispatcher
+
+def speak_async(dispatcher, lock_id, text):
+    dispatcher.dispatch(RecognitionEvent('SPEECH', lock_id, speech=text), ['speech'])
 # -----------------------------------------
 
 # Parse command-line arguments for mode & pin
@@ -391,6 +384,44 @@ def parse_cli_args():
     parser = argparse.ArgumentParser(description="Face recognition runtime mode selection")
     parser.add_argument("--mode", choices=["face_only", "face_pin"], default="face_only", help="Recognition mode")
     parser.add_argument("--lock_id", required=True, help="ID of the lock to use")
+    parser.add_argument("--match_metric", choices=GalleryMatcher.METRICS, default="l2",
+                        help="Gallery matching metric (cosine assumes L2-normalised embeddings)")
+    parser.add_argument("--match_mode", choices=MATCH_MODES, default="full",
+                        help="Match the full gallery, per-identity prototypes only, or prototypes then refine")
+    parser.add_argument("--ann_nprobe", type=int, default=DEFAULT_NPROBE,
+                        help="IVF lists probed per query on large galleries (higher = better recall, slower)")
+    parser.add_argument("--embed_backend", choices=BACKENDS, default="torch",
+                        help="Embedding backend: PyTorch, ONNX Runtime FP32 or INT8 (see embedding_backend.py)")
+    parser.add_argument("--isolate_trainer", action="store_true",
+                        help="Run the trainer in a subprocess (reloads models) instead of in-process")
+    parser.add_argument("--reverify_interval", type=int, default=15,
+                        help="Frames before a tracked, recognised face is re-embedded (1 = every frame)")
+    parser.add_argument("--no_presence_gate", action="store_true",
+                        help="Run detection on every frame instead of gating on distance/motion")
+    parser.add_argument("--arm_distance", type=float, default=80.0,
+                        help="Ultrasonic distance (cm) that arms recognition")
+    parser.add_argument("--idle_check_every", type=int, default=5,
+                        help="While idle, check motion every N frames")
+    parser.add_argument("--armed_detect_every", type=int, default=1,
+                        help="While armed, run detection every N frames")
+    parser.add_argument("--frame_budget_ms", type=float, default=125.0,
+                        help="Per-frame processing budget for the adaptive scheduler (0 = fixed full quality)")
+    parser.add_argument("--pipeline", choices=PIPELINE_MODES, default="ssd_mtcnn",
+                        help="Detect/align mode: SSD + MTCNN on crop, SSD + square crop, or MTCNN on the full frame")
+    parser.add_argument("--enhance_mode", choices=["frame", "roi"], default="frame",
+                        help="Enhance the whole frame, or only a cheap global check plus full enhancement on face ROIs")
+    parser.add_argument("--denoise", choices=DENOISE_MODES, default="nlm",
+                        help="Low-light denoiser: per-frame fastNlMeans (nlm, default) or a cheaper running temporal average")
+    parser.add_argument("--serial_port", default="COM4",
+                        help="ESP32 serial port (e.g. the pty printed by esp32_emulator.py)")
+    parser.add_argument("--camera", default="1",
+                        help="Camera index, or a scripted fake camera such as 'blank:2,../temp/*.jpg:5' (fake_camera.py)")
+    parser.add_argument("--metrics_port", type=int, default=DEFAULT_METRICS_PORT,
+                        help="Port for the Prometheus /metrics endpoint (0 disables it)")
+    parser.add_argument("--metrics_host", default="127.0.0.1",
+                        help="Address the metrics endpoint binds to")
+    parser.add_argument("--metrics_socket",
+                        help="Also serve /metrics on this Unix socket path (POSIX only)")
     return parser.parse_args()
 
 def enable_ir_mode(cam):
@@ -410,6 +441,21 @@ def enable_ir_mode(cam):
         print(f"[WARNING] Không thể kích hoạt IR: {e}")
         return False
 
+def start_metrics_endpoints(args):
+    """
+    Mở endpoint /metrics (HTTP cục bộ và/hoặc Unix socket). Lỗi mở cổng chỉ cảnh báo, không dừng hệ thống.
+    """
+    if args.metrics_port:
+        try:
+            start_http_server(args.metrics_port, args.metrics_host)
+        except OSError as e:
+            print(f"[WARNING] Không mở được endpoint metrics tại {args.metrics_host}:{args.metrics_port}: {e}")
+    if args.metrics_socket:
+        try:
+            start_unix_server(args.metrics_socket)
+        except (OSError, AttributeError) as e:
+            print(f"[WARNING] Không mở được Unix socket metrics {args.metrics_socket}: {e}")
+
 # --- Thêm hằng số cấu hình ---
 FACE_MATCH_THRESHOLD = 0.3
 # -----------------------------------
@@ -422,6 +468,8 @@ def main():
     print(f"[MODE] Chế độ hoạt động: {selected_mode}")
     print(f"[LOCK] Sử dụng lock_id: {lock_id}")
 
+    start_metrics_endpoints(args)
+
     profiler = cProfile.Profile()
     profiler.enable()
 
@@ -429,11 +477,9 @@ def main():
         print("[ERROR] Token Telegram không hợp lệ.")
         sys.exit(1)
 
-    tts_engine = init_tts_engine()
-    ser = init_serial(port='COM4')
+    ser = init_serial(port=args.serial_port)
     if ser:
         send_serial_command(ser, "SYSTEM_READY") # SỬA: Gửi SYSTEM_READY thay vì RECOGNIZING
-        threading.Thread(target=read_distance_from_serial, args=(ser,), daemon=True).start()
 
     fail_count = 0
     lockout_time = 0
@@ -447,8 +493,9 @@ def main():
 
     correct_recognitions = 0
     total_recognitions = 0
-    processing_times = []
-    serial_latencies = []
+    stage_metrics = {stage: STAGE_LATENCY.labels(stage) for stage in ('capture',) + STAGES}
+    frame_metrics = {result: FRAMES.labels(result) for result in ('processed', 'gated', 'skipped', 'locked', 'dropped')}
+    known_metric, unknown_metric = RECOGNITIONS.labels('known'), RECOGNITIONS.labels('unknown')
     error_count = 0
     frame_drop_count = 0
 
@@ -458,37 +505,103 @@ def main():
 
     try:
         bucket = initialize_firebase()
+        dispatcher = build_event_dispatcher(bucket)
+
+        # Khởi tạo MTCNN với cấu hình phù hợp ánh sáng yếu
+        # Giảm ngưỡng thresholds để dễ phát hiện hơn trong điều kiện thiếu sáng
+        pipeline_mode = args.pipeline
+        print(f"[INFO] Chế độ phát hiện/căn chỉnh: {pipeline_mode}")
+        # Trọng số local đã kiểm tra hash (model_loader), warm-up trước khi mở camera
+        mtcnn = None
+        mtcnn_full = None
+        try:
+            if pipeline_mode == "ssd_mtcnn":
+                mtcnn = load_mtcnn(
+                    device,
+                    keep_all=False,
+                    min_face_size=120,  # Giảm từ 150 xuống 120
+                    thresholds=[0.6, 0.7, 0.7],  # Giảm từ [0.7, 0.8, 0.8]
+                    post_process=True  # Bật post-processing
+                )
+            elif pipeline_mode == "mtcnn":
+                # Một bộ phát hiện duy nhất trên frame thu nhỏ, không cần SSD
+                mtcnn_full = create_full_frame_mtcnn(device)
+
+            # Embedder theo backend: torch hoặc onnxruntime (FP32/INT8), gọi giống nhau
+            resnet = load_embedder(device, args.embed_backend)
+        except ModelLoadError as e:
+            print(f"[ERROR] {e}")
+            sys.exit(1)
+        logger.info(f"Thời gian tải model: {load_metrics()}")
+
         dataset_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "dataset"))
         load_start = time.perf_counter()
-        known_embeddings, known_ids, known_names = load_known_faces(bucket, dataset_path, lock_id)
+        # Khóa mới chưa có gallery: trainer chạy ngay trong tiến trình, dùng lại MTCNN/resnet vừa tải
+        known_embeddings, known_ids, known_names = load_known_faces(
+            bucket, dataset_path, lock_id, models=(mtcnn if mtcnn is not None else mtcnn_full, resnet, device),
+            isolate_trainer=args.isolate_trainer, backend=args.embed_backend)
         load_time = time.perf_counter() - load_start
         logger.info(f"Thời gian tải embeddings: {load_time:.3f}s")
         print(f"[INFO] Tải embeddings: {load_time:.3f}s")
 
-        if not known_embeddings:
+        if len(known_ids) == 0:
             print("[ERROR] Không có dữ liệu khuôn mặt.")
             sys.exit(1)
 
-        # Khởi tạo MTCNN với cấu hình phù hợp ánh sáng yếu
-        # Giảm ngưỡng thresholds để dễ phát hiện hơn trong điều kiện thiếu sáng
-        mtcnn = MTCNN(
-            keep_all=False, 
-            min_face_size=120,  # Giảm từ 150 xuống 120
-            thresholds=[0.6, 0.7, 0.7],  # Giảm từ [0.7, 0.8, 0.8]
-            device=device,
-            post_process=True  # Bật post-processing
-        )
-        
-        resnet = InceptionResnetV1(pretrained='vggface2').eval().to(device)
-        face_detector = load_deep_face_detector()
-        if face_detector is None:
-            face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-            if face_cascade.empty():
-                print("[ERROR] Không tải được Haar Cascade.")
-                sys.exit(1)
-            print("[INFO] Dùng Haar Cascade.")
-
-        cam = cv2.VideoCapture(1, cv2.CAP_DSHOW)
+        lock_dataset_dir = os.path.join(dataset_path, lock_id)
+        matcher = None
+        if args.match_mode != "full":
+            # So với prototype của từng người trước, chỉ tinh chỉnh trong người thắng (trainer.py --prototypes)
+            prototypes = load_prototypes(lock_dataset_dir)
+            if prototypes is None:
+                print("[WARNING] Chưa có prototype cho gallery này, dùng gallery đầy đủ.")
+            else:
+                matcher = PrototypeMatcher(prototypes, known_embeddings, metric=args.match_metric,
+                                           refine=args.match_mode == "refine",
+                                           reject_distance=FACE_MATCH_THRESHOLD)
+                print(f"[INFO] Prototype: {len(prototypes)} cho {len(prototypes.identity_ids)} người, "
+                      f"chế độ {args.match_mode}")
+        if matcher is None:
+            # Gom embeddings thành một ma trận float32 để so khớp bằng một phép nhân ma trận
+            # Gallery lớn có chỉ mục IVF do trainer tạo; nhỏ hơn ngưỡng thì so khớp vét cạn
+            matcher = GalleryMatcher(known_embeddings, known_ids, known_names, metric=args.match_metric,
+                                     index=load_index(lock_dataset_dir), nprobe=args.ann_nprobe)
+            print(f"[INFO] Gallery: {len(matcher)} mẫu, metric={matcher.metric}, "
+                  f"{'IVF ' + str(matcher.index.nlist) + ' lists, nprobe=' + str(matcher.nprobe) if matcher.index else 'exact'}")
+
+        # Theo dõi khuôn mặt giữa các frame, chỉ embed lại khi cần xác minh
+        tracker = FaceTracker(reverify_interval=args.reverify_interval,
+                              unknown_reverify_interval=min(5, args.reverify_interval))
+
+        # Cổng hiện diện: cửa trống thì không chạy tiền xử lý/phát hiện/embedding
+        gate = None
+        if not args.no_presence_gate:
+            gate = PresenceGate(arm_distance_cm=args.arm_distance,
+                                disarm_distance_cm=args.arm_distance * 1.5,
+                                idle_check_every=args.idle_check_every,
+                                armed_detect_every=args.armed_detect_every)
+
+        # Bộ lập lịch: hạ độ phân giải phát hiện / mức tăng cường / bỏ frame khi máy quá tải
+        scheduler = AdaptiveScheduler(frame_budget_ms=args.frame_budget_ms)
+
+        face_detector, face_cascade = load_face_detectors(pipeline_mode)
+        if pipeline_mode != "mtcnn" and face_detector is None and face_cascade is None:
+            print("[ERROR] Không tải được Haar Cascade.")
+            sys.exit(1)
+
+        # Tiền xử lý -> phát hiện -> căn chỉnh -> embedding -> so khớp (dùng chung với replay_benchmark.py)
+        pipeline = RecognitionPipeline(pipeline_mode, resnet, device, matcher, tracker, FACE_MATCH_THRESHOLD,
+                                       mtcnn=mtcnn, mtcnn_full=mtcnn_full, face_detector=face_detector,
+                                       face_cascade=face_cascade, enhance_mode=args.enhance_mode,
+                                       denoise=args.denoise)
+        # Cổng hiện diện -> bộ lập lịch -> pipeline -> khóa tạm (dùng chung với e2e_latency.py)
+        processor = FrameProcessor(pipeline, scheduler, gate)
+
+        if args.camera.isdigit():
+            cam = cv2.VideoCapture(int(args.camera), cv2.CAP_DSHOW)
+        else:
+            # Camera giả phát frame theo kịch bản (lặp lại) để chạy thử không cần phần cứng
+            cam = ScriptedCamera.from_spec(args.camera, loop=True)
         if not cam.isOpened():
             print("[ERROR] Không mở được camera.")
             sys.exit(1)
@@ -498,6 +611,9 @@ def main():
         # Kích hoạt IR nếu có
         enable_ir_mode(cam)
 
+        # Đọc camera trong thread riêng, vòng xử lý luôn nhận frame mới nhất
+        capture = CaptureThread(cam, buffer_size=1, flip=True).start()
+
         sound_path = os.path.join(os.path.dirname(__file__), '../sound/Ring-Doorbell-Sound.wav')
         if os.path.exists(sound_path):
             play_startup_sound(sound_path)
@@ -505,88 +621,90 @@ def main():
         print("\n[INFO] Hệ thống sẵn sàng. Nhấn 'q' để thoát.")
 
         while True:
-            ret, frame = cam.read()
-            if not ret:
+            captured = capture.read(timeout=1.0)
+            if captured is None:
                 print("[ERROR] Không đọc được frame.")
                 frame_drop_count += 1
+                frame_metrics['dropped'].inc()
                 continue
 
-            frame = cv2.flip(frame, 1)
+            frame = captured.frame
             frame_count += 1
-            
-            # SỬA LỖI: Lấy giá trị brightness trước khi xử lý ảnh
-            # Điều này đảm bảo biến 'brightness' luôn được định nghĩa.
-            _, brightness = detect_low_light(frame)
+            stage_metrics['capture'].observe(time.perf_counter() - captured.timestamp)
+
+            with distance_lock:
+                current_distance = distance
+            decision = processor.process(frame, current_distance, locked=time.perf_counter() < lockout_time)
+            if decision.status == 'gated':
+                cv2.putText(frame, f"{gate.state} - Cho nguoi den gan", (10, 30),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (200, 200, 200), 1)
+                frame_metrics['gated'].inc()
+                cv2.imshow("Face Recognition", frame)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+                continue
 
-            # === PHÁT HIỆN VÀ XỬ LÝ ÁNH SÁNG YẾU (CÁCH 1: Tự động hoàn toàn) ===
-            frame = preprocess_image(frame)  # SỬ DỤNG PIPELINE TỰ ĐỘNG
-            
-            # HOẶC CÁCH 2: Xử lý thủ công như cũ nhưng dùng auto_gamma
-            """
-            is_low_light, brightness = detect_low_light(frame)
-            
-            if is_low_light:
+            if decision.status == 'skipped':
+                frame_metrics['skipped'].inc()
+                cv2.imshow("Face Recognition", frame)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+                continue
+
+            prepared = decision.prepared
+            frame = prepared.frame
+            brightness = prepared.brightness
+            if prepared.is_low_light:
+                # Cả hai enhance_mode đều tăng cường frame khi ánh sáng yếu (FrameEnhancer / auto_gamma)
                 low_light_frames += 1
-                print(f"[WARNING] Phát hiện ánh sáng yếu (độ sáng: {brightness:.1f})")
-                
-                frame = enhance_image_for_low_light(frame)
                 enhanced_frames += 1
-                
-                cv2.putText(frame, f"LOW LIGHT - Enhanced (Brightness: {brightness:.0f})", 
-                           (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 255), 2)
-            else:
-                frame = auto_brightness_contrast(frame, clip_hist_percent=1)
-            """
-            
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                LOW_LIGHT_FRAMES.inc()
+            stage_metrics['preprocess'].observe_ms(prepared.preprocess_ms)
 
-            if time.perf_counter() < lockout_time:
+            if decision.status == 'locked':
                 cv2.putText(frame, "He thong bi khoa 1 phut...", (10, 30),
                             cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+                frame_metrics['locked'].inc()
                 cv2.imshow("Face Recognition", frame)
                 if cv2.waitKey(1) & 0xFF == ord('q'):
                     break
                 continue
 
-            process_start = time.perf_counter()
-            if face_detector:
-                faces = detect_faces_dnn(face_detector, frame)
-            else:
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                faces = face_cascade.detectMultiScale(gray, 1.1, 6, minSize=(150, 150))
-            detection_time = time.perf_counter() - process_start
-            processing_times.append(detection_time * 1000)
+            analysis = decision.analysis
+            frame_metrics['processed'].inc()
+            for stage, elapsed_ms in analysis.timings.items():
+                if stage != 'preprocess':
+                    stage_metrics[stage].observe_ms(elapsed_ms)
+            face_boxes, matches = analysis.face_boxes, analysis.matches
 
             current_time = datetime.now()
             time_since_last_voice = (current_time - last_voice_time).total_seconds()
-
-            for (x, y, w, h) in faces:
-                if w < 150 or h < 150:
-                    continue
-
-                if w < 200 and time_since_last_voice > voice_cooldown and tts_engine:
-                    tts_engine.say("Vui lòng đưa khuôn mặt gần hơn")
-                    tts_engine.runAndWait()
+            for (x, y, w, h) in face_boxes:
+                if w < 200 and time_since_last_voice > voice_cooldown:
+                    speak_async(dispatcher, lock_id, "Vui lòng đưa khuôn mặt gần hơn")
                     last_voice_time = current_time
-
                 cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-                face_img = frame_rgb[y:y + h, x:x + w]
-                face_tensor = mtcnn(face_img)
 
+            if face_boxes:
+                FACES.inc(len(face_boxes))
+                DECISION_LATENCY.observe(time.perf_counter() - captured.timestamp)
+            SCHEDULER_LEVEL.set(scheduler.level_idx)
+            if scheduler.frames_processed % 100 == 0:
+                logger.info(f"Scheduler metrics: {scheduler.metrics()}")
+
+            for (x, y, w, h), match in zip(face_boxes, matches):
                 name = "Unknown"
                 confidence_percent = 0.0
 
-                if face_tensor is not None:
-                    embedding = resnet(face_tensor.unsqueeze(0).to(device)).detach().cpu().numpy()
-                    distances = [np.linalg.norm(embedding - emb) for emb in known_embeddings]
-                    if distances:
-                        min_distance = min(distances)
-                        min_idx = distances.index(min_distance)
-                        confidence_percent = max(0, min(100, (1 - min_distance / 2) * 100))
-                        if min_distance < FACE_MATCH_THRESHOLD:
-                            name = known_names[min_idx]
-                            total_recognitions += 1
-                            correct_recognitions += 1
+                if match is not None:
+                    confidence_percent = match.confidence
+                    if match.distance < FACE_MATCH_THRESHOLD:
+                        name = match.name
+                        total_recognitions += 1
+                        correct_recognitions += 1
+                        known_metric.inc()
+                    else:
+                        unknown_metric.inc()
 
                 now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 cv2.putText(frame, f"{name}: {confidence_percent:.1f}%", (x, y - 10),
@@ -595,22 +713,17 @@ def main():
                 # === XỬ LÝ THEO CHẾ ĐỘ ===
                 if name != "Unknown":
                     fail_count = 0
-                    cv2.imwrite(temp_photo_path, frame)
-                    
-                    # Upload ảnh log và ghi vào Realtime Database
-                    log_image_url = upload_and_get_url(bucket, temp_photo_path, lock_id)
-                    write_activity_log(lock_id, 'SUCCESS', name, confidence_percent, log_image_url)
+
+                    # Upload ảnh log và ghi vào Realtime Database (chạy nền trong sink storage)
+                    event = RecognitionEvent('SUCCESS', lock_id, name, confidence_percent, frame=frame.copy())
 
                     if selected_mode == "face_only":
-                        # CHẾ ĐỘ 1: MỞ CỬA NGAY
-                        message = f"[✅ Mở cửa] {name} - {confidence_percent:.1f}% | {now_str}"
-                        send_telegram_message_with_photo(message, temp_photo_path)
-                        
+                        # CHẾ ĐỘ 1: MỞ CỬA NGAY - lệnh Serial gửi trước mọi tác vụ phụ
                         send_serial_command(ser, "SUCCESS")
-                        
-                        if tts_engine:
-                            tts_engine.say(f"Xin chào {name}. Mở cửa.")
-                            tts_engine.runAndWait()
+
+                        event.message = f"[✅ Mở cửa] {name} - {confidence_percent:.1f}% | {now_str}"
+                        event.speech = f"Xin chào {name}. Mở cửa."
+                        dispatcher.dispatch(event, ['storage', 'telegram', 'speech'])
                         
                         print("[INFO] Chế độ face_only: Đã mở cửa.")
                         
@@ -623,59 +736,52 @@ def main():
                     elif selected_mode == "face_pin":
                         # CHẾ ĐỘ 2: YÊU CẦU PIN VÀ CHỜ KẾT QUẢ
                         print(f"[ACTION] Nhận diện: {name} ({confidence_percent:.1f}%) → Yêu cầu PIN")
-                        
-                        if tts_engine:
-                            tts_engine.say(f"Xin chào {name}. Vui lòng nhập mã PIN trên thiết bị.")
-                            tts_engine.runAndWait()
+
+                        event.speech = f"Xin chào {name}. Vui lòng nhập mã PIN trên thiết bị."
+                        dispatcher.dispatch(event, ['storage', 'speech'])
 
                         # Gửi yêu cầu và chờ ESP32 sẵn sàng
-                        if not send_serial_command(ser, "PIN_REQUIRED", expected_response="PIN_PROMPT", timeout=5):
+                        prompt = ser.request("PIN_REQUIRED", expect="PIN_PROMPT", timeout=5).result() if ser else None
+                        if prompt is None:
                             print("[ERROR] ESP32 không phản hồi yêu cầu nhập PIN.")
                             return
 
-                        # CHỜ NHẬN PIN TỪ ESP32
+                        # CHỜ NHẬN PIN TỪ ESP32 (thread Serial đánh thức khi có PIN_ENTERED/PIN_TIMEOUT)
                         print("[INFO] Đang chờ người dùng nhập PIN trên ESP32...")
-                        received_pin = ""
                         expected_pin = EXPECTED_PIN
                         print(f"[DEBUG] Mã PIN mong đợi: {expected_pin}")
-                        start_wait = time.time()
-                        
-                        while time.time() - start_wait < 35:
-                            if ser.in_waiting > 0:
-                                response = ser.readline().decode('utf-8').strip()
-                                print(f"[DEBUG] ESP32 Response: {response}")
-                                
-                                if response.startswith("PIN_ENTERED:"):
-                                    received_pin = response.replace("PIN_ENTERED:", "").strip()
-                                    print(f"[INFO] Đã nhận PIN từ ESP32: {received_pin}")
-                                    break
-                                
-                                if "PIN_TIMEOUT" in response:
-                                    print("[FAIL] Người dùng không nhập PIN kịp thời.")
-                                    message = f"[❌ Timeout] {name} - Không nhập PIN | {now_str}"
-                                    send_telegram_message_with_photo(message, temp_photo_path)
-                                    send_serial_command(ser, "FAIL")
-                                    return
-                        
+                        response = ser.wait_for(('PIN_ENTERED', 'PIN_TIMEOUT'), timeout=35, since=prompt.timestamp)
+                        received_pin = ""
+                        if response is not None and response.kind == 'PIN_TIMEOUT':
+                            print("[FAIL] Người dùng không nhập PIN kịp thời.")
+                            send_serial_command(ser, "FAIL")
+                            dispatcher.dispatch(RecognitionEvent(
+                                'PIN_TIMEOUT', lock_id, name, confidence_percent, parent=event,
+                                message=f"[❌ Timeout] {name} - Không nhập PIN | {now_str}"), ['telegram'])
+                            return
+                        if response is not None:
+                            received_pin = response.value
+                            print(f"[INFO] Đã nhận PIN từ ESP32: {received_pin}")
+
                         # Kiểm tra PIN  
                         if received_pin == expected_pin:
                             print("[SUCCESS] PIN chính xác!")
-                            message = f"[✅ Mở cửa] {name} - PIN đúng | {now_str}"
-                            send_telegram_message_with_photo(message, temp_photo_path)
                             send_serial_command(ser, "SUCCESS")
                             print("[INFO] Đã gửi lệnh mở cửa.")
-                            write_activity_log(lock_id, 'SUCCESS_PIN', name, confidence_percent, log_image_url)
+                            dispatcher.dispatch(RecognitionEvent(
+                                'SUCCESS_PIN', lock_id, name, confidence_percent, parent=event,
+                                message=f"[✅ Mở cửa] {name} - PIN đúng | {now_str}"), ['storage', 'telegram'])
                             
                             # THÊM: Đợi 6 giây rồi gửi RECOGNITION_DONE
                             time.sleep(6)
                             send_serial_command(ser, "RECOGNITION_DONE")
                         else:
                             print("[FAIL] PIN sai hoặc không nhận được PIN.")
-                            message = f"[❌ PIN sai] {name} - PIN: {received_pin} | {now_str}"
-                            send_telegram_message_with_photo(message, temp_photo_path)
                             send_serial_command(ser, "FAIL")
                             print("[INFO] Đã gửi lệnh báo thất bại.")
-                            write_activity_log(lock_id, 'FAIL_PIN', name, confidence_percent, log_image_url)
+                            dispatcher.dispatch(RecognitionEvent(
+                                'FAIL_PIN', lock_id, name, confidence_percent, parent=event,
+                                message=f"[❌ PIN sai] {name} - PIN: {received_pin} | {now_str}"), ['storage', 'telegram'])
                             
                             # THÊM: Gửi RECOGNITION_DONE sau khi thất bại
                             time.sleep(2)
@@ -687,33 +793,25 @@ def main():
                     # NGƯỜI LẠ
                     if time_since_last_voice > voice_cooldown:
                         fail_count += 1
-                        cv2.imwrite(temp_photo_path, frame)
-                        
-                        # Upload ảnh log và ghi vào Realtime Database
-                        log_image_url = upload_and_get_url(bucket, temp_photo_path, lock_id)
-                        write_activity_log(lock_id, 'FAIL', 'Unknown', 0, log_image_url)
 
-                        message = f"[CẢNH BÁO] Người lạ (lần {fail_count})"
-                        send_telegram_message_with_photo(message, temp_photo_path)
-                        
-                        if tts_engine:
-                            tts_engine.say("Cảnh báo, phát hiện người lạ.")
-                            tts_engine.runAndWait()
+                        # Upload ảnh log, ghi Realtime Database, Telegram và giọng nói đều chạy nền
+                        dispatcher.dispatch(RecognitionEvent(
+                            'FAIL', lock_id, 'Unknown', 0, frame=frame.copy(),
+                            message=f"[CẢNH BÁO] Người lạ (lần {fail_count})",
+                            speech="Cảnh báo, phát hiện người lạ."), ['storage', 'telegram', 'speech'])
                         last_voice_time = current_time
 
                         if fail_count >= 3:
                             lockout_time = time.perf_counter() + lock_duration
                             fail_count = 0
-                            if tts_engine:
-                                tts_engine.say("Hệ thống tạm khóa.")
-                                tts_engine.runAndWait()
+                            speak_async(dispatcher, lock_id, "Hệ thống tạm khóa.")
 
             # Hiển thị thông tin độ sáng
             cv2.putText(frame, f"Brightness: {brightness:.0f}", (10, frame.shape[0] - 40),
                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 1)
             
             fps = frame_count / (time.perf_counter() - start_time)
-            cv2.putText(frame, f"FPS: {fps:.1f}", (10, frame.shape[0] - 10),
+            cv2.putText(frame, f"FPS: {fps:.1f} | L{scheduler.level_idx}", (10, frame.shape[0] - 10),
                         cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 2)
             cv2.imshow("Face Recognition", frame)
 
@@ -729,13 +827,36 @@ def main():
             pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats()
 
         accuracy = (correct_recognitions / total_recognitions * 100) if total_recognitions > 0 else 0.0
-        avg_processing_time = sum(processing_times) / len(processing_times) if processing_times else 0.0
-        avg_serial_latency = sum(serial_latencies) / len(serial_latencies) if serial_latencies else 0.0
+        avg_processing_time = STAGE_LATENCY.labels('detect').mean * 1000
+        avg_decision_latency = DECISION_LATENCY.mean * 1000
         
         print("\n[THỐNG KÊ]")
         print(f"Độ chính xác: {accuracy:.1f}%")
         print(f"Tốc độ xử lý: {avg_processing_time:.1f} ms/frame")
-        print(f"Độ trễ serial: {avg_serial_latency:.3f} s")
+        if locals().get('ser') is not None:
+            print(f"Serial: {ser.stats()}")
+            logger.info(f"Serial stats: {ser.stats()}")
+        print(f"Độ trễ chụp → quyết định: {avg_decision_latency:.1f} ms")
+        decision_p95 = DECISION_LATENCY.quantile(0.95)
+        if decision_p95 is not None:
+            print(f"Độ trễ chụp → quyết định p95 (ước lượng từ histogram): {decision_p95 * 1000:.1f} ms")
+        if 'capture' in locals():
+            print(f"Frame camera bị bỏ (đã cũ): {capture.dropped}, đọc lỗi: {capture.read_failures}")
+        if 'tracker' in locals():
+            print(f"Tracker: {tracker.stats()}")
+        if locals().get('pipeline') is not None:
+            if pipeline.frame_enhancer is not None:
+                print(f"Frame enhancer: {pipeline.frame_enhancer.stats()}")
+            if pipeline.roi_enhancer is not None:
+                print(f"ROI enhancer: {pipeline.roi_enhancer.stats()}")
+        if 'scheduler' in locals():
+            print(f"Scheduler: {scheduler.metrics()}")
+            logger.info(f"Scheduler metrics: {scheduler.metrics()}")
+        if locals().get('gate') is not None:
+            print(f"Presence gate: {gate.stats()}")
+            logger.info(f"Presence gate stats: {gate.stats()}")
+        if 'capture' in locals():
+            logger.info(f"Capture stats: {capture.stats()}, decision latency avg {avg_decision_latency:.1f} ms")
         print(f"Tổng nhận diện: {total_recognitions}, Đúng: {correct_recognitions}")
 
         print(f"\n[THỐNG KÊ ÁNH SÁNG]")
@@ -747,9 +868,15 @@ def main():
                 os.remove(temp_photo_path)
             except: 
                 pass
+        if 'capture' in locals():
+            capture.stop()
+        if 'dispatcher' in locals():
+            # Chờ các sink gửi nốt log/Telegram đang xếp hàng trước khi thoát
+            dispatcher.stop(timeout=15)
+            logger.info(f"Dispatcher stats: {dispatcher.stats()}")
         if 'cam' in locals(): 
             cam.release()
-        if 'ser' in locals() and ser and ser.is_open: 
+        if locals().get('ser') is not None:
             ser.close()
         cv2.destroyAllWindows()
         print("[INFO] Đã thoát chương trình.")
@@ -0,0 +1,221 @@
+# ann_index.py - Chỉ mục IVF-flat (NumPy) cho gallery lớn: chỉ so khớp với các cụm gần query nhất
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from gallery_store import read_header, load_gallery, GalleryStoreError
+
+# Gallery nhỏ hơn ngưỡng này: so khớp vét cạn (nhanh hơn và chính xác tuyệt đối)
+EXACT_SEARCH_BELOW = 5000
+
+# Số cụm được duyệt cho mỗi query: tăng -> recall cao hơn, chậm hơn
+DEFAULT_NPROBE = 8
+
+INDEX_PATTERN = "ivf.{generation}.npz"
+
+# K-means chỉ huấn luyện trên mẫu con để build nhanh với gallery hàng trăm nghìn vector
+TRAIN_SAMPLE = 50000
+KMEANS_ITERS = 15
+ASSIGN_CHUNK = 8192
+
+
+def _assign(vectors, centroids, c_sq):
+    """
+    Cụm gần nhất (L2) của mỗi vector, tính theo từng khối để giới hạn bộ nhớ.
+    """
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_CHUNK):
+        block = vectors[start:start + ASSIGN_CHUNK]
+        # ||x||^2 không đổi trong một hàng nên bỏ qua khi tìm argmin
+        dist = c_sq[None, :] - 2.0 * (block @ centroids.T)
+        labels[start:start + len(block)] = np.argmin(dist, axis=1)
+    return labels
+
+
+def _kmeans(vectors, nlist, iters, rng):
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iters):
+        labels = _assign(vectors, centroids, np.einsum('ij,ij->i', centroids, centroids))
+        counts = np.bincount(labels, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Cụm rỗng: đặt lại bằng một vector ngẫu nhiên
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+    return centroids
+
+
+class IvfIndex:
+    """
+    IVF-flat: K-means chia gallery thành nlist cụm; mỗi query chỉ xét các hàng thuộc nprobe cụm gần nhất.
+    Lưu: centroids [nlist, D], order (hàng gallery sắp theo cụm) và offsets [nlist + 1].
+    Chỉ trả về hàng ứng viên; khoảng cách chính xác do GalleryMatcher tính.
+    """
+
+    def __init__(self, centroids, order, offsets, count):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.c_sq = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.order = order
+        self.offsets = offsets
+        self.count = int(count)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings, nlist=None, iters=KMEANS_ITERS, seed=0):
+        vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+        n = len(vectors)
+        if nlist is None:
+            # ~4 * sqrt(N) cụm: mỗi cụm vài trăm vector với gallery ~100k
+            nlist = int(4 * np.sqrt(n))
+        nlist = max(1, min(nlist, n))
+        rng = np.random.default_rng(seed)
+        sample = vectors if n <= TRAIN_SAMPLE else vectors[rng.choice(n, TRAIN_SAMPLE, replace=False)]
+        centroids = _kmeans(sample, nlist, iters, rng)
+        labels = _assign(vectors, centroids, np.einsum('ij,ij->i', centroids, centroids))
+        order = np.argsort(labels, kind='stable').astype(np.int32)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=nlist), out=offsets[1:])
+        return cls(centroids, order, offsets, n)
+
+    def candidates(self, query, nprobe=DEFAULT_NPROBE):
+        """
+        Returns: các hàng gallery thuộc nprobe cụm gần query nhất.
+        """
+        q = np.ravel(query).astype(np.float32)
+        dist = self.c_sq - 2.0 * (self.centroids @ q)
+        nprobe = max(1, min(nprobe, self.nlist))
+        if nprobe < self.nlist:
+            probes = np.argpartition(dist, nprobe - 1)[:nprobe]
+        else:
+            probes = np.arange(self.nlist)
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probes])
+
+    def save(self, lock_dir, generation):
+        """
+        Ghi ivf.<generation>.npz (tmp + os.replace) và xóa chỉ mục của các thế hệ cũ.
+        """
+        path = os.path.join(lock_dir, INDEX_PATTERN.format(generation=generation))
+        tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+        try:
+            np.savez(tmp_path, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                     count=np.int64(self.count), generation=np.int64(generation))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        for old in glob.glob(os.path.join(lock_dir, INDEX_PATTERN.format(generation='*'))):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+        return path
+
+
+def load_index(lock_dir):
+    """
+    Mở chỉ mục của thế hệ gallery hiện tại.
+    Returns: IvfIndex hoặc None nếu chưa có / không khớp gallery (khi đó dùng vét cạn).
+    """
+    try:
+        header = read_header(lock_dir)
+    except GalleryStoreError:
+        return None
+    if header is None:
+        return None
+    path = os.path.join(lock_dir, INDEX_PATTERN.format(generation=header['generation']))
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['generation']) != header['generation'] or int(data['count']) != header['count']:
+                return None
+            return IvfIndex(data['centroids'], data['order'], data['offsets'], data['count'])
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[WARNING] Chỉ mục ANN hỏng, dùng so khớp vét cạn: {e}")
+        return None
+
+
+def build_index(lock_dir, min_size=EXACT_SEARCH_BELOW, nlist=None):
+    """
+    Tạo chỉ mục cho gallery hiện tại của khóa nếu đủ lớn (trainer gọi sau khi lưu gallery).
+    Returns: IvfIndex hoặc None nếu gallery nhỏ hơn min_size.
+    """
+    gallery = load_gallery(lock_dir, verify=False, migrate=False)
+    if gallery is None or len(gallery.ids) < min_size:
+        for old in glob.glob(os.path.join(lock_dir, INDEX_PATTERN.format(generation='*'))):
+            os.remove(old)
+        return None
+    start = time.perf_counter()
+    index = IvfIndex.build(gallery.embeddings, nlist=nlist)
+    index.save(lock_dir, gallery.header['generation'])
+    print(f"[ANN] IVF index: {index.count} vectors, {index.nlist} lists, built in {time.perf_counter() - start:.1f}s")
+    return index
+
+
+def recall_report(matcher, index, nprobes=(1, 2, 4, 8, 16, 32), queries=500, seed=0):
+    """
+    So sánh tìm kiếm IVF với vét cạn trên các hàng gallery lấy mẫu (bỏ chính nó, tìm hàng gần nhất còn lại).
+    Returns: dict nprobe -> recall@1 (cùng hàng), đồng thuận danh tính và thời gian mỗi query.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(matcher), min(queries, len(matcher)), replace=False)
+    exact_index = matcher.index
+    matcher.index = None
+    start = time.perf_counter()
+    truth_idx, _ = matcher.search(matcher.embeddings[rows], k=2)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(rows)
+    truth = [r[1] if r[0] == q else r[0] for q, r in zip(rows, truth_idx)]
+
+    report = {'gallery': len(matcher), 'nlist': index.nlist, 'queries': len(rows),
+              'exact_ms_per_query': round(exact_ms, 3), 'nprobe': {}}
+    matcher.index = index
+    try:
+        for nprobe in nprobes:
+            matcher.nprobe = nprobe
+            start = time.perf_counter()
+            found_idx, _ = matcher.search(matcher.embeddings[rows], k=2)
+            ms = (time.perf_counter() - start) * 1000 / len(rows)
+            found = [r[1] if r[0] == q else r[0] for q, r in zip(rows, found_idx)]
+            same_row = sum(f == t for f, t in zip(found, truth))
+            same_id = sum(matcher.ids[f] == matcher.ids[t] for f, t in zip(found, truth) if f >= 0)
+            report['nprobe'][nprobe] = {
+                'recall_at_1': round(same_row / len(rows), 4),
+                'identity_agreement': round(same_id / len(rows), 4),
+                'ms_per_query': round(ms, 3),
+            }
+    finally:
+        matcher.index = exact_index
+    return report
+
+
+if __name__ == "__main__":
+    from gallery_matcher import GalleryMatcher
+
+    parser = argparse.ArgumentParser(description="Tạo chỉ mục IVF cho gallery và đo recall@1 so với vét cạn")
+    parser.add_argument("lock_id")
+    parser.add_argument("--build", action="store_true", help="Tạo lại chỉ mục (bỏ qua ngưỡng kích thước)")
+    parser.add_argument("--nlist", type=int, help="Số cụm (mặc định ~4*sqrt(N))")
+    parser.add_argument("--nprobe", type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    lock_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'dataset', args.lock_id))
+    index = build_index(lock_dir, min_size=0, nlist=args.nlist) if args.build else load_index(lock_dir)
+    if index is None:
+        print(f"[ERROR] Chưa có chỉ mục cho {args.lock_id} (chạy với --build)")
+        sys.exit(1)
+    gallery = load_gallery(lock_dir, migrate=False)
+    matcher = GalleryMatcher(gallery.embeddings, gallery.ids, gallery.names)
+    print(json.dumps(recall_report(matcher, index, args.nprobe, args.queries), indent=2))
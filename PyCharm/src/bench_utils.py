@@ -0,0 +1,61 @@
+# bench_utils.py - Hàm dùng chung cho các script benchmark: thống kê độ trễ và đọc frame từ video/thư mục ảnh
+import glob
+import os
+
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def summarize(values):
+    if not values:
+        return None
+    arr = np.asarray(values, dtype=np.float64)
+    return {
+        'count': len(arr),
+        'mean': round(float(arr.mean()), 3),
+        'p50': round(float(np.percentile(arr, 50)), 3),
+        'p95': round(float(np.percentile(arr, 95)), 3),
+        'p99': round(float(np.percentile(arr, 99)), 3),
+        'max': round(float(arr.max()), 3),
+    }
+
+
+def iter_frames(source, limit=0, size=None):
+    """
+    Đọc frame BGR từ file video, thư mục ảnh hoặc glob ảnh (sắp theo tên).
+    """
+    if os.path.isdir(source):
+        paths = sorted(p for p in glob.glob(os.path.join(source, '*')) if p.lower().endswith(IMAGE_EXTENSIONS))
+    elif any(ch in source for ch in '*?['):
+        paths = sorted(glob.glob(source))
+    else:
+        paths = None
+
+    count = 0
+    if paths is not None:
+        for path in paths:
+            if limit and count >= limit:
+                break
+            frame = cv2.imread(path)
+            if frame is None:
+                print(f"[WARN] Không đọc được ảnh: {path}")
+                continue
+            count += 1
+            yield cv2.resize(frame, size) if size else frame
+        return
+
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        print(f"[ERROR] Không mở được video: {source}")
+        return
+    try:
+        while not limit or count < limit:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            count += 1
+            yield cv2.resize(frame, size) if size else frame
+    finally:
+        cap.release()
@@ -0,0 +1,117 @@
+# benchmark_denoise.py - So sánh chi phí và chất lượng khử nhiễu thiếu sáng: NLM mỗi frame vs trung bình theo thời gian
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from bench_utils import iter_frames, summarize
+from image_enhancement import enhance_image_for_low_light, TemporalDenoiser
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float32) - b.astype(np.float32)) ** 2)
+    return 99.0 if mse == 0 else float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def noise_level(image):
+    # Ước lượng nhiễu còn lại: độ lệch chuẩn Laplacian trên ảnh xám
+    return float(cv2.Laplacian(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), cv2.CV_32F).std())
+
+
+def degrade(frame, darken, noise_sigma, rng):
+    """
+    Giả lập thiếu sáng trên clip sáng bình thường: giảm độ sáng + nhiễu Gauss.
+    """
+    dark = frame.astype(np.float32) * darken
+    if noise_sigma > 0:
+        dark += rng.normal(0.0, noise_sigma, frame.shape).astype(np.float32)
+    return np.clip(dark, 0, 255).astype(np.uint8)
+
+
+def run_clip(source, args):
+    rng = np.random.default_rng(0)
+    denoiser = TemporalDenoiser(alpha=args.alpha, motion_threshold=args.motion_threshold)
+    size = (args.width, args.height) if args.width and args.height else None
+
+    timings = {'none': [], 'nlm': [], 'temporal': []}
+    quality = {'nlm': {'psnr_vs_clean': [], 'noise': [], 'flicker': []},
+               'temporal': {'psnr_vs_clean': [], 'noise': [], 'flicker': [], 'psnr_vs_nlm': []}}
+    previous = {}
+    frames = 0
+
+    for clean in iter_frames(source, args.limit, size):
+        frame = degrade(clean, args.darken, args.noise_sigma, rng) if args.synthetic else clean
+        frames += 1
+
+        start = time.perf_counter()
+        enhance_image_for_low_light(frame, denoise=False)
+        timings['none'].append((time.perf_counter() - start) * 1000)
+
+        outputs = {}
+        if not args.skip_nlm:
+            start = time.perf_counter()
+            outputs['nlm'] = enhance_image_for_low_light(frame, denoise=True)
+            timings['nlm'].append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        outputs['temporal'] = enhance_image_for_low_light(frame, denoise=True, denoiser=denoiser)
+        timings['temporal'].append((time.perf_counter() - start) * 1000)
+
+        reference = enhance_image_for_low_light(degrade(clean, args.darken, 0, rng), denoise=False) \
+            if args.synthetic else None
+        for name, out in outputs.items():
+            q = quality[name]
+            q['noise'].append(noise_level(out))
+            if reference is not None:
+                q['psnr_vs_clean'].append(psnr(out, reference))
+            if name in previous:
+                q['flicker'].append(float(cv2.absdiff(out, previous[name]).mean()))
+            previous[name] = out.copy()
+        if 'nlm' in outputs:
+            quality['temporal']['psnr_vs_nlm'].append(psnr(outputs['temporal'], outputs['nlm']))
+
+    return {
+        'frames': frames,
+        'enhance_ms': {name: summarize(values) for name, values in timings.items()},
+        'quality': {name: {k: summarize(v) for k, v in q.items()} for name, q in quality.items()},
+        'temporal_stats': denoiser.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark khử nhiễu NLM vs theo thời gian trên clip thiếu sáng")
+    parser.add_argument("sources", nargs='+', help="File video hoặc thư mục ảnh theo thứ tự frame")
+    parser.add_argument("--limit", type=int, default=300, help="Số frame tối đa mỗi clip (0 = tất cả)")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--alpha", type=float, default=0.3, help="Trọng số frame mới của TemporalDenoiser")
+    parser.add_argument("--motion_threshold", type=int, default=12)
+    parser.add_argument("--synthetic", action="store_true",
+                        help="Clip sáng bình thường: làm tối + thêm nhiễu để có ảnh sạch làm chuẩn PSNR")
+    parser.add_argument("--darken", type=float, default=0.3)
+    parser.add_argument("--noise_sigma", type=float, default=8.0)
+    parser.add_argument("--skip_nlm", action="store_true", help="Chỉ đo chế độ temporal (NLM rất chậm)")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    results = {}
+    for source in args.sources:
+        if not os.path.exists(source):
+            print(f"[ERROR] Không tìm thấy: {source}")
+            sys.exit(1)
+        print(f"[BENCH] {source}...")
+        results[source] = run_clip(source, args)
+
+    text = json.dumps({'clips': results}, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# benchmark_pipeline.py - So sánh độ trễ và khoảng cách so khớp giữa các chế độ phát hiện + căn chỉnh
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+from model_loader import load_facenet, load_mtcnn, load_metrics
+
+from bench_utils import summarize
+from face_pipeline import (
+    PIPELINE_MODES,
+    load_deep_face_detector,
+    detect_faces_dnn,
+    create_full_frame_mtcnn,
+    detect_and_align_mtcnn,
+    square_crop_faces,
+    align_face_crops,
+    embed_aligned_faces,
+)
+from gallery_matcher import GalleryMatcher
+from gallery_store import load_gallery as open_gallery
+
+
+def list_images(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '**', '*.jpg')
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def load_gallery(lock_id):
+    path = os.path.join(os.path.dirname(__file__), '..', 'dataset', lock_id)
+    gallery = open_gallery(path)
+    if gallery is None:
+        print(f"[WARN] Không tìm thấy gallery: {path}")
+        return None
+    return GalleryMatcher(gallery.embeddings, gallery.ids, gallery.names)
+
+
+def run_mode(mode, images, resnet, device, min_face_size, ssd_net, matcher):
+    """
+    Chạy một chế độ trên toàn bộ ảnh.
+    Returns: (thống kê, {đường dẫn ảnh: (tên khớp, khoảng cách)} cho khuôn mặt lớn nhất)
+    """
+    mtcnn = None
+    mtcnn_full = None
+    if mode == "ssd_mtcnn":
+        mtcnn = load_mtcnn(device, keep_all=False, min_face_size=min(120, min_face_size), thresholds=[0.6, 0.7, 0.7],
+                           post_process=True)
+    elif mode == "mtcnn":
+        mtcnn_full = create_full_frame_mtcnn(device, min_face_size=min(40, min_face_size // 2))
+
+    detect_ms, align_ms, embed_ms, total_ms = [], [], [], []
+    faces_found = 0
+    aligned_ok = 0
+    per_image = {}
+
+    for path in images:
+        frame = cv2.imread(path)
+        if frame is None:
+            continue
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+        start = time.perf_counter()
+        if mode == "mtcnn":
+            scale = 0.5 if min(frame.shape[:2]) >= 2 * min_face_size else 1.0
+            boxes, aligned = detect_and_align_mtcnn(mtcnn_full, frame_rgb, scale=scale, min_face_size=min_face_size)
+            detect_ms.append((time.perf_counter() - start) * 1000)
+            align_ms.append(0.0)
+        else:
+            boxes = detect_faces_dnn(ssd_net, frame, min_face_size=min_face_size)
+            detect_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            if mode == "ssd_crop":
+                aligned = square_crop_faces(frame_rgb, boxes)
+            else:
+                aligned = align_face_crops(mtcnn, [frame_rgb[max(0, y):y + h, max(0, x):x + w] for x, y, w, h in boxes])
+            align_ms.append((time.perf_counter() - start) * 1000)
+
+        faces_found += len(boxes)
+        if not boxes:
+            continue
+        # Chỉ giữ khuôn mặt lớn nhất mỗi ảnh để so sánh giữa các chế độ
+        largest = int(np.argmax([w * h for _, _, w, h in boxes]))
+        if aligned[largest] is None:
+            continue
+        aligned_ok += 1
+
+        start = time.perf_counter()
+        emb = embed_aligned_faces(resnet, [aligned[largest]], device)[0]
+        embed_ms.append((time.perf_counter() - start) * 1000)
+        total_ms.append(detect_ms[-1] + align_ms[-1] + embed_ms[-1])
+        if matcher is not None and len(matcher) > 0:
+            match = matcher.best_match(emb)
+            per_image[path] = (match.name, match.distance)
+
+    distances = [d for _, d in per_image.values()]
+    stats = {
+        'images': len(detect_ms),
+        'faces_found': faces_found,
+        'aligned': aligned_ok,
+        'detect_ms': summarize(detect_ms),
+        'align_ms': summarize(align_ms),
+        'embed_ms': summarize(embed_ms),
+        'detect_align_ms': summarize([a + b for a, b in zip(detect_ms, align_ms)]),
+        'total_ms': summarize(total_ms),
+        'match_distance': summarize(distances),
+    }
+    return stats, per_image
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark các chế độ phát hiện + căn chỉnh")
+    parser.add_argument("--images", default=os.path.join(os.path.dirname(__file__), '..', 'temp'),
+                        help="Thư mục hoặc glob ảnh (mặc định PyCharm/temp)")
+    parser.add_argument("--lock_id", help="Lock có embeddings để đo khoảng cách so khớp")
+    parser.add_argument("--modes", nargs='+', choices=PIPELINE_MODES, default=list(PIPELINE_MODES))
+    parser.add_argument("--min_face_size", type=int, default=150,
+                        help="Kích thước khuôn mặt tối thiểu (giảm khi ảnh là crop nhỏ)")
+    parser.add_argument("--limit", type=int, default=0, help="Chỉ dùng N ảnh đầu tiên")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    images = list_images(args.images)
+    if args.limit:
+        images = images[:args.limit]
+    if not images:
+        print(f"[ERROR] Không có ảnh nào tại {args.images}")
+        sys.exit(1)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    resnet = load_facenet(device)
+    matcher = load_gallery(args.lock_id) if args.lock_id else None
+    ssd_net = None
+    if any(mode != "mtcnn" for mode in args.modes):
+        ssd_net = load_deep_face_detector()
+
+    results = {}
+    per_mode_matches = {}
+    for mode in args.modes:
+        if mode != "mtcnn" and ssd_net is None:
+            print(f"[WARN] Bỏ qua {mode}: thiếu model SSD")
+            continue
+        print(f"[BENCH] {mode} trên {len(images)} ảnh...")
+        results[mode], per_mode_matches[mode] = run_mode(
+            mode, images, resnet, device, args.min_face_size, ssd_net, matcher)
+
+    # Mức đồng thuận danh tính so với chế độ cũ (ssd_mtcnn)
+    reference = per_mode_matches.get("ssd_mtcnn")
+    if reference:
+        for mode, matches in per_mode_matches.items():
+            common = [p for p in matches if p in reference]
+            if common:
+                agree = sum(matches[p][0] == reference[p][0] for p in common)
+                drift = [abs(matches[p][1] - reference[p][1]) for p in common]
+                results[mode]['identity_agreement_vs_ssd_mtcnn'] = round(agree / len(common), 4)
+                results[mode]['distance_drift_vs_ssd_mtcnn'] = summarize(drift)
+
+    report = {'device': str(device), 'images': len(images), 'modes': results, 'models': load_metrics()}
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# camera_capture.py - Luồng đọc camera riêng, luôn trả frame mới nhất cho vòng xử lý
+import threading
+import time
+from collections import deque, namedtuple
+
+import cv2
+
+# timestamp lấy theo time.perf_counter() ngay khi driver trả frame
+CapturedFrame = namedtuple('CapturedFrame', ['frame', 'seq', 'timestamp'])
+
+
+class CaptureThread:
+    """
+    Đọc frame liên tục trong một thread nền vào bộ đệm giới hạn buffer_size slot.
+
+    - Khi bộ đệm đầy, frame cũ nhất bị bỏ (tính vào dropped) thay vì để driver dồn frame.
+    - read(latest=True) trả frame mới nhất và bỏ các frame cũ hơn còn trong bộ đệm.
+    - read(latest=False) trả theo thứ tự FIFO (hữu ích khi cần mọi frame trong bộ đệm).
+
+    source là bất kỳ đối tượng nào có read() -> (ret, frame), ví dụ cv2.VideoCapture.
+    """
+
+    def __init__(self, source, buffer_size=1, flip=False, max_consecutive_failures=None, name="CaptureThread"):
+        if buffer_size < 1:
+            raise ValueError("buffer_size phải >= 1")
+        self.source = source
+        self.flip = flip
+        self.max_consecutive_failures = max_consecutive_failures
+        self._buffer = deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+        self.captured = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.read_failures = 0
+        self.finished = False
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        consecutive_failures = 0
+        seq = 0
+        while not self._stop_event.is_set():
+            ret, frame = self.source.read()
+            timestamp = time.perf_counter()
+            if not ret or frame is None:
+                self.read_failures += 1
+                consecutive_failures += 1
+                if self.max_consecutive_failures is not None and consecutive_failures >= self.max_consecutive_failures:
+                    break
+                time.sleep(0.005)
+                continue
+            consecutive_failures = 0
+
+            if self.flip:
+                frame = cv2.flip(frame, 1)
+            seq += 1
+            with self._cond:
+                if len(self._buffer) == self._buffer.maxlen:
+                    self.dropped += 1
+                self._buffer.append(CapturedFrame(frame, seq, timestamp))
+                self.captured += 1
+                self._cond.notify()
+
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+
+    def read(self, timeout=1.0, latest=True):
+        """
+        Chờ tối đa timeout giây để lấy một frame.
+        Returns: CapturedFrame hoặc None nếu hết thời gian / nguồn đã kết thúc.
+        """
+        with self._cond:
+            if not self._buffer and not self.finished:
+                self._cond.wait_for(lambda: self._buffer or self.finished, timeout=timeout)
+            if not self._buffer:
+                return None
+            if latest:
+                item = self._buffer.pop()
+                self.dropped += len(self._buffer)
+                self._buffer.clear()
+            else:
+                item = self._buffer.popleft()
+            self.delivered += 1
+            return item
+
+    def stop(self, timeout=2.0):
+        self._stop_event.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=timeout)
+
+    def stats(self):
+        return {
+            'captured': self.captured,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'read_failures': self.read_failures,
+        }
@@ -1,19 +1,27 @@
 import os
 import sys
 
-# Xóa tất cả file embeddings.pkl cũ
+from gallery_store import remove_gallery
+
+# Xóa tất cả file embeddings.pkl cũ và gallery đã lưu (gallery.json + .npy)
 dataset_dir = os.path.join(os.path.dirname(__file__), '..', 'dataset')
 
 if os.path.exists(dataset_dir):
     for root, dirs, files in os.walk(dataset_dir):
         for file in files:
-            if file.endswith('.pkl'):
+            if file.endswith('.pkl') or file.endswith('.pkl.migrated'):
                 filepath = os.path.join(root, file)
                 try:
                     os.remove(filepath)
                     print(f"Đã xóa: {filepath}")
                 except Exception as e:
                     print(f"Lỗi khi xóa {filepath}: {e}")
+        if 'gallery.json' in files:
+            try:
+                remove_gallery(root)
+                print(f"Đã xóa gallery: {root}")
+            except Exception as e:
+                print(f"Lỗi khi xóa gallery {root}: {e}")
     print("Hoàn tất xóa cache cũ.")
 else:
     print("Thư mục dataset không tồn tại.")
@@ -0,0 +1,258 @@
+# e2e_latency.py - Đo độ trễ đầu-cuối: khuôn mặt xuất hiện trước camera giả -> lệnh SUCCESS tới ESP32 giả lập
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import torch
+
+from bench_utils import iter_frames, summarize
+from camera_capture import CaptureThread
+from esp32_emulator import Esp32Emulator, Esp32Script
+from event_dispatcher import RecognitionEvent
+from fake_camera import ScriptedCamera, Segment, blank_frame
+from frame_scheduler import AdaptiveScheduler
+from presence_gate import PresenceGate
+from recognition_pipeline import FrameProcessor
+from serial_link import SerialLink
+from replay_benchmark import (
+    add_pipeline_args,
+    build_pipeline,
+    build_stub_dispatcher,
+    build_tracker,
+    environment_info,
+    peak_rss_mb,
+)
+
+DEFAULT_FACES = os.path.join(os.path.dirname(__file__), '..', 'temp', '*.jpg')
+
+# Các bước nằm trong độ trễ đo được (giống vòng lặp Recognize.main qua FrameProcessor)
+STAGES_INCLUDED = ('camera_fps', 'capture_thread', 'presence_gate', 'frame_scheduler', 'preprocess', 'detect',
+                   'align', 'embed', 'match', 'dispatch', 'serial')
+
+
+def _burn(stop_event):
+    # Tải CPU giả lập tiến trình khác trên máy (trình duyệt, trainer...)
+    x = 0
+    while not stop_event.is_set():
+        for _ in range(100000):
+            x = (x * 31 + 7) % 1000003
+
+
+def start_cpu_load(processes):
+    stop_event = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=_burn, args=(stop_event,), daemon=True) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    return stop_event, workers
+
+
+def build_processor(pipeline, args):
+    """
+    Cổng hiện diện + bộ lập lịch mới cho mỗi lần thử, cùng tham số mặc định với Recognize.
+    """
+    gate = None
+    if not args.no_presence_gate:
+        gate = PresenceGate(arm_distance_cm=args.arm_distance, disarm_distance_cm=args.arm_distance * 1.5,
+                            idle_check_every=args.idle_check_every, armed_detect_every=args.armed_detect_every)
+    scheduler = AdaptiveScheduler(frame_budget_ms=args.frame_budget_ms)
+    # --level: mức khởi đầu (Recognize bắt đầu ở mức 0), sau đó bộ lập lịch tự hạ/tăng
+    scheduler.level_idx = args.level
+    return FrameProcessor(pipeline, scheduler, gate)
+
+
+def run_trial(pipeline, args, link, emulator, dispatcher, face_frames, scene):
+    """
+    Một lần thử: cửa trống lead giây rồi người đứng trước camera tối đa face_duration giây.
+    Frame đi qua FrameProcessor như vòng lặp Recognize.main (cổng hiện diện theo DISTANCE từ ESP32 giả lập,
+    bộ lập lịch bỏ/hạ mức frame); scene['camera'] cho ESP32 giả lập biết lúc nào có người.
+    Returns: dict mốc thời gian (ms tính từ frame có người đầu tiên) hoặc với 'error' khi không mở được cửa.
+    """
+    camera = ScriptedCamera([Segment([blank_frame()], args.lead, False, 'blank'),
+                             Segment(face_frames, args.face_duration, True, 'faces')], fps=args.fps)
+    scene['camera'] = camera
+    capture = CaptureThread(camera, buffer_size=1, max_consecutive_failures=1).start()
+    pipeline.tracker = build_tracker(args)
+    processor = build_processor(pipeline, args)
+
+    trial = {'frames': 0, 'frame_status': {}}
+    stage_ms = {}
+    decided = None
+    try:
+        while decided is None:
+            captured = capture.read(timeout=1.0)
+            if captured is None:
+                if capture.finished:
+                    break
+                continue
+            decision = processor.process(captured.frame, link.distance)
+            if not camera.face_onsets:
+                continue
+            onset = camera.face_onsets[-1]
+            trial['frames'] += 1
+            trial['frame_status'][decision.status] = trial['frame_status'].get(decision.status, 0) + 1
+            if decision.status != 'processed':
+                continue
+            analysis = decision.analysis
+            for stage, elapsed_ms in analysis.timings.items():
+                stage_ms.setdefault(stage, []).append(elapsed_ms)
+            now = time.perf_counter()
+            if 'first_processed_ms' not in trial:
+                # Gồm thời gian cổng hiện diện chuyển ARMED và frame bị bộ lập lịch bỏ qua
+                trial['first_processed_ms'] = (now - onset) * 1000
+            if analysis.face_boxes and 'detected_ms' not in trial:
+                trial['detected_ms'] = (now - onset) * 1000
+            if not decision.known:
+                continue
+            match = decision.known[0][1]
+            trial['recognized_ms'] = (now - onset) * 1000
+            trial['capture_age_ms'] = (now - captured.timestamp) * 1000
+            event = RecognitionEvent('SUCCESS', args.lock_id, match.name, match.confidence,
+                                     frame=decision.prepared.frame.copy())
+            # Cùng thứ tự như Recognize.main: lệnh serial trước, tác vụ phụ sau
+            if args.mode == "face_only":
+                link.request("SUCCESS")
+                dispatcher.dispatch(event, ['storage', 'telegram', 'speech'])
+                decided = "SUCCESS"
+            else:
+                dispatcher.dispatch(event, ['storage', 'speech'])
+                pin_start = time.perf_counter()
+                prompt = link.request("PIN_REQUIRED", expect="PIN_PROMPT", timeout=5).result()
+                if prompt is None:
+                    decided = "NO_PROMPT"
+                    break
+                trial['prompt_ms'] = (time.perf_counter() - pin_start) * 1000
+                entered = link.wait_for(('PIN_ENTERED', 'PIN_TIMEOUT'), timeout=35, since=prompt.timestamp)
+                trial['pin_wait_ms'] = (time.perf_counter() - pin_start) * 1000
+                decided = "SUCCESS" if entered is not None and entered.value == args.pin else "FAIL"
+                link.request(decided)
+    finally:
+        capture.stop()
+        scene['camera'] = None
+
+    if processor.gate is not None:
+        trial['gate'] = processor.gate.stats()
+    trial['scheduler'] = processor.scheduler.metrics()
+    if not camera.face_onsets:
+        trial['error'] = "no_face_segment"
+        return trial
+    onset = camera.face_onsets[-1]
+    wire_ts = emulator.wait_for("SUCCESS", since=onset, timeout=2.0) if decided == "SUCCESS" else None
+    if wire_ts is None:
+        trial['error'] = decided or "not_recognized"
+    else:
+        trial['success_on_wire_ms'] = (wire_ts - onset) * 1000
+        if 'pin_wait_ms' in trial:
+            # Phần hệ thống: trừ thời gian người dùng gõ phím
+            trial['system_ms'] = trial['success_on_wire_ms'] - trial['pin_wait_ms'] + trial['prompt_ms']
+    trial['stage_ms'] = {stage: summarize(values) for stage, values in stage_ms.items()}
+    link.request("RECOGNITION_DONE")
+    return trial
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Độ trễ từ khuôn mặt xuất hiện đến SUCCESS trên serial (camera giả + ESP32 giả lập)")
+    add_pipeline_args(parser, reverify_interval=15)
+    parser.add_argument("--faces", default=DEFAULT_FACES, help="Ảnh/video của người đã đăng ký (glob, thư mục, file)")
+    parser.add_argument("--mode", choices=["face_only", "face_pin"], default="face_only")
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--fps", type=float, default=15.0, help="FPS camera giả")
+    parser.add_argument("--lead", type=float, default=1.0, help="Giây cửa trống trước khi có người")
+    parser.add_argument("--face_duration", type=float, default=5.0, help="Giây tối đa người đứng trước camera")
+    parser.add_argument("--pin", default="2828", help="PIN đúng (ESP32 giả lập gõ PIN này)")
+    parser.add_argument("--key_delay", type=float, default=0.2, help="Giây giữa các phím trên keypad giả lập")
+    parser.add_argument("--command_delay", type=float, default=0.0, help="Thời gian ESP32 xử lý mỗi lệnh (giây)")
+    parser.add_argument("--distance_interval", type=float, default=0.05, help="Chu kỳ gửi DISTANCE (giây)")
+    parser.add_argument("--person_distance", type=float, default=50.0,
+                        help="Khoảng cách ESP32 giả lập báo khi có người (cm); cửa trống = OUT_RANGE")
+    parser.add_argument("--no_presence_gate", action="store_true", help="Như Recognize: tắt cổng hiện diện")
+    parser.add_argument("--arm_distance", type=float, default=80.0)
+    parser.add_argument("--idle_check_every", type=int, default=5)
+    parser.add_argument("--armed_detect_every", type=int, default=1)
+    parser.add_argument("--frame_budget_ms", type=float, default=125.0)
+    parser.add_argument("--cpu_load", type=int, default=0, help="Số tiến trình chiếm CPU chạy song song")
+    parser.add_argument("--sink_delay", type=float, default=0.0, help="Độ trễ giả lập mỗi sink mạng (giây)")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    if os.name == "nt":
+        print("[ERROR] ESP32 giả lập cần pseudo-terminal (Linux/macOS); trên Windows dùng cặp COM ảo.")
+        sys.exit(1)
+    if not args.lock_id:
+        print("[ERROR] Cần --lock_id có gallery chứa người trong --faces")
+        sys.exit(1)
+
+    face_frames = list(iter_frames(args.faces, size=(640, 480)))
+    if not face_frames:
+        print(f"[ERROR] Không có frame nào tại {args.faces}")
+        sys.exit(1)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    pipeline = build_pipeline(args, device)
+    dispatcher = build_stub_dispatcher(args.sink_delay)
+    # Cảm biến siêu âm thấy người cùng lúc camera chuyển sang đoạn có người
+    scene = {'camera': None}
+
+    def person_distance(_t):
+        camera = scene['camera']
+        segment = camera.current_segment if camera is not None else None
+        return args.person_distance if segment is not None and segment.face else None
+
+    emulator = Esp32Emulator(Esp32Script(distance=person_distance, distance_interval=args.distance_interval,
+                                         command_delay=args.command_delay, pin=args.pin,
+                                         key_delay=args.key_delay)).start()
+    link = SerialLink.open(emulator.port)
+    if link is None:
+        emulator.stop()
+        sys.exit(1)
+    link.request("SYSTEM_READY")
+    load_stop, load_workers = start_cpu_load(args.cpu_load)
+
+    trials = []
+    try:
+        for i in range(args.trials):
+            trial = run_trial(pipeline, args, link, emulator, dispatcher, face_frames, scene)
+            trials.append(trial)
+            result = f"{trial['success_on_wire_ms']:.0f} ms" if 'success_on_wire_ms' in trial else trial.get('error')
+            print(f"[E2E] Lần {i + 1}/{args.trials}: {result}")
+    finally:
+        load_stop.set()
+        for worker in load_workers:
+            worker.join(timeout=2)
+        link.close()
+        dispatcher.stop(timeout=5)
+        emulator.stop()
+
+    ok = [t for t in trials if 'success_on_wire_ms' in t]
+    report = {
+        'config': {k: v for k, v in vars(args).items() if k != 'output'},
+        'environment': environment_info(device),
+        # Khóa tạm sau nhiều lần sai không xảy ra ở đây: mỗi lần thử là người đã đăng ký
+        'stages_included': [s for s in STAGES_INCLUDED if s != 'presence_gate' or not args.no_presence_gate],
+        'trials': len(trials),
+        'succeeded': len(ok),
+        'latency_ms': {
+            key: summarize([t[key] for t in ok if key in t])
+            for key in ('first_processed_ms', 'detected_ms', 'recognized_ms', 'success_on_wire_ms', 'system_ms',
+                        'capture_age_ms')
+        },
+        'per_trial': trials,
+        'esp32': {'door_opened': emulator.door_opened, 'denied': emulator.denied,
+                  'commands': [entry.line for entry in emulator.commands()]},
+        'serial': link.stats(),
+        'dispatcher': dispatcher.stats(),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False, default=str)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"[INFO] Đã ghi kết quả: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
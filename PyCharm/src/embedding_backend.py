@@ -0,0 +1,295 @@
+# embedding_backend.py - Backend embedding thay thế được: PyTorch (mặc định) hoặc ONNX Runtime CPU (FP32 / INT8)
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from model_loader import (
+    MODELS_DIR,
+    EMBED_INPUT_SHAPE,
+    TORCH_THREADS_ENV_VAR,
+    ModelLoadError,
+    load_facenet,
+    load_registry,
+    save_registry,
+    register_file,
+    record_load,
+    verify_file,
+)
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+ONNX_FILE = "inceptionresnetv1_vggface2.onnx"
+ONNX_INT8_FILE = "inceptionresnetv1_vggface2.int8.onnx"
+ONNX_OPSET = 13
+
+# Ghi vào manifest của trainer: gallery tạo bằng backend khác sẽ được embed lại
+MODEL_VERSIONS = {
+    "torch": "inceptionresnetv1-vggface2-v1",
+    "onnx": "inceptionresnetv1-vggface2-v1",
+    "onnx-int8": "inceptionresnetv1-vggface2-int8-v1",
+}
+
+def embedder_version(embedder):
+    """
+    Phiên bản model của embedder (model torch của load_facenet không có thuộc tính này).
+    """
+    return getattr(embedder, 'model_version', MODEL_VERSIONS["torch"])
+
+
+def gallery_model_version(header):
+    """
+    Phiên bản embedder đã tạo gallery; gallery ghi trước khi header có trường này đều do torch tạo.
+    """
+    return header.get('model_version') or MODEL_VERSIONS["torch"]
+
+
+# Giống Recognize.FACE_MATCH_THRESHOLD
+DEFAULT_MATCH_THRESHOLD = 0.3
+
+
+class OnnxEmbedder:
+    """
+    InceptionResnetV1 chạy bằng onnxruntime (CPUExecutionProvider).
+    Gọi giống module torch: embedder(batch [N, 3, 160, 160]) -> tensor [N, 512],
+    nên dùng được ở mọi chỗ đang gọi resnet(...) (embed_aligned_faces, trainer).
+    """
+
+    def __init__(self, path, model_version, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads or int(os.getenv(TORCH_THREADS_ENV_VAR, "0"))
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.model_version = model_version
+        self.path = path
+
+    def __call__(self, batch):
+        if isinstance(batch, torch.Tensor):
+            batch = batch.detach().cpu().numpy()
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: batch})[0])
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+
+def load_embedder(device, backend="torch", warmup=True):
+    """
+    Trả về embedder theo backend. 'torch' dùng model_loader.load_facenet;
+    'onnx'/'onnx-int8' cần file đã export (python embedding_backend.py --export [--quantize ...]).
+    Raises: ModelLoadError nếu thiếu file hoặc sai hash.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"backend không hợp lệ: {backend}")
+    if backend == "torch":
+        return load_facenet(device, warmup=warmup)
+    if torch.device(device).type != 'cpu':
+        print(f"[WARN] Backend {backend} chỉ chạy trên CPU")
+
+    name = ONNX_INT8_FILE if backend == "onnx-int8" else ONNX_FILE
+    path = os.path.join(MODELS_DIR, name)
+    start = time.perf_counter()
+    verify_file(path, name)
+    embedder = OnnxEmbedder(path, MODEL_VERSIONS[backend])
+    load_s = time.perf_counter() - start
+    warmup_s = 0.0
+    if warmup:
+        warm_start = time.perf_counter()
+        embedder(np.zeros(EMBED_INPUT_SHAPE, dtype=np.float32))
+        warmup_s = time.perf_counter() - warm_start
+    record_load(f"facenet[{backend}]", "onnxruntime", load_s, warmup_s)
+    return embedder
+
+
+def export_onnx():
+    """
+    Export InceptionResnetV1 (state_dict local) sang ONNX, trục batch động.
+    Returns: đường dẫn file .onnx
+    """
+    model = load_facenet('cpu', torchscript=False, warmup=False)
+    path = os.path.join(MODELS_DIR, ONNX_FILE)
+    torch.onnx.export(
+        model, torch.zeros(EMBED_INPUT_SHAPE), path,
+        input_names=['input'], output_names=['embedding'],
+        dynamic_axes={'input': {0: 'batch'}, 'embedding': {0: 'batch'}},
+        opset_version=ONNX_OPSET,
+    )
+    registry = load_registry()
+    register_file(registry, ONNX_FILE, path)
+    save_registry(registry)
+    print(f"[EXPORT] {path}")
+    return path
+
+
+def collect_aligned_faces(dataset_root, lock_id=None, limit=0):
+    """
+    Lấy khuôn mặt đã căn chỉnh (tensor 3x160x160) từ dataset/<lock_id>/ (hoặc mọi khóa)
+    bằng đúng pipeline decode + MTCNN của trainer.
+    Returns: (list tensor, list face_id)
+    """
+    import trainer
+
+    lock_ids = [lock_id] if lock_id else sorted(
+        d for d in os.listdir(dataset_root) if os.path.isdir(os.path.join(dataset_root, d)))
+    items = []
+    for lock in lock_ids:
+        for face_id, filename, path in trainer.iter_local_images(os.path.join(dataset_root, lock)):
+            items.append(trainer.EnrollItem(f"{face_id}/{filename}", path, face_id, face_id, None, "CALIB"))
+    if limit:
+        # Lấy đều qua các người dùng thay vì N ảnh đầu của một người
+        step = max(1, len(items) // limit)
+        items = items[::step][:limit]
+
+    mtcnn = trainer.trainer_mtcnn('cpu')
+    stats = trainer.StageStats(report_every=0)
+    decoded = trainer.decode_images(items, trainer.DEFAULT_DECODE_WORKERS, stats)
+    faces, labels = [], []
+    for item, face in trainer.detect_and_align(decoded, mtcnn, trainer.DEFAULT_DETECT_BATCH, stats):
+        if face is not None:
+            faces.append(face)
+            labels.append(item.face_id)
+    return faces, labels
+
+
+class _CalibrationReader:
+    """
+    CalibrationDataReader cho quantize_static: trả lần lượt từng batch khuôn mặt.
+    """
+
+    def __init__(self, faces, input_name, batch_size=16):
+        self.batches = [
+            {input_name: torch.stack(faces[i:i + batch_size]).numpy().astype(np.float32)}
+            for i in range(0, len(faces), batch_size)
+        ]
+        self._iter = iter(self.batches)
+
+    def get_next(self):
+        return next(self._iter, None)
+
+    def rewind(self):
+        self._iter = iter(self.batches)
+
+
+def quantize(mode, dataset_root, calib_limit=200):
+    """
+    Lượng tử hóa INT8 từ file ONNX FP32.
+    mode='dynamic': trọng số INT8, activation lượng tử hóa lúc chạy (không cần dữ liệu).
+    mode='static': QDQ per-channel, dải activation hiệu chuẩn trên ảnh trong dataset/.
+    Returns: đường dẫn file .int8.onnx
+    """
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    src = os.path.join(MODELS_DIR, ONNX_FILE)
+    dst = os.path.join(MODELS_DIR, ONNX_INT8_FILE)
+    verify_file(src, ONNX_FILE)
+    if mode == "dynamic":
+        quantize_dynamic(src, dst, weight_type=QuantType.QInt8)
+    else:
+        faces, _ = collect_aligned_faces(dataset_root, limit=calib_limit)
+        if not faces:
+            raise ModelLoadError(f"Không có khuôn mặt nào trong {dataset_root} để hiệu chuẩn")
+        print(f"[QUANTIZE] Hiệu chuẩn trên {len(faces)} khuôn mặt")
+        reader = _CalibrationReader(faces, 'input')
+        quantize_static(src, dst, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    registry = load_registry()
+    register_file(registry, ONNX_INT8_FILE, dst)
+    save_registry(registry)
+    print(f"[QUANTIZE] {mode} -> {dst}")
+    return dst
+
+
+def _embed_all(embedder, faces, batch_size=32):
+    outputs = []
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for i in range(0, len(faces), batch_size):
+            outputs.append(embedder(torch.stack(faces[i:i + batch_size])).cpu().numpy())
+    seconds = time.perf_counter() - start
+    return np.concatenate(outputs).astype(np.float32), seconds
+
+
+def parity_check(backend, dataset_root, lock_id=None, limit=200, threshold=DEFAULT_MATCH_THRESHOLD):
+    """
+    So sánh backend với torch trên cùng các khuôn mặt trong dataset/:
+    - drift: khoảng cách L2 / cosine giữa hai embedding của cùng một ảnh
+    - agreement: tỉ lệ quyết định khớp (tên nếu khoảng cách < threshold, ngược lại Unknown) giống nhau
+      khi so với gallery của lock_id (nếu có)
+    Returns: dict báo cáo
+    """
+    from gallery_matcher import GalleryMatcher
+    from gallery_store import load_gallery
+
+    faces, _ = collect_aligned_faces(dataset_root, lock_id=lock_id, limit=limit)
+    if not faces:
+        raise ModelLoadError(f"Không có khuôn mặt nào trong {dataset_root}")
+    reference, ref_s = _embed_all(load_embedder('cpu', "torch"), faces)
+    candidate, cand_s = _embed_all(load_embedder('cpu', backend), faces)
+
+    l2 = np.linalg.norm(reference - candidate, axis=1)
+    cosine = np.einsum('ij,ij->i', reference, candidate) / np.maximum(
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1), 1e-12)
+    report = {
+        'backend': backend,
+        'faces': len(faces),
+        'ms_per_face': {'torch': round(ref_s * 1000 / len(faces), 3),
+                        backend: round(cand_s * 1000 / len(faces), 3)},
+        'l2_drift': {'mean': round(float(l2.mean()), 5), 'p95': round(float(np.percentile(l2, 95)), 5),
+                     'max': round(float(l2.max()), 5)},
+        'cosine': {'mean': round(float(cosine.mean()), 5), 'min': round(float(cosine.min()), 5)},
+    }
+
+    gallery = load_gallery(os.path.join(dataset_root, lock_id)) if lock_id else None
+    if gallery is not None and len(gallery.ids):
+        matcher = GalleryMatcher(gallery.embeddings, gallery.ids, gallery.names)
+
+        def decisions(embeddings):
+            return [m[0].name if m and m[0].distance < threshold else "Unknown" for m in matcher.match(embeddings)]
+
+        ref_dec, cand_dec = decisions(reference), decisions(candidate)
+        agree = sum(a == b for a, b in zip(ref_dec, cand_dec))
+        report['decision_agreement'] = round(agree / len(faces), 4)
+        report['decision_disagreements'] = len(faces) - agree
+        report['threshold'] = threshold
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export/lượng tử hóa embedder sang ONNX và kiểm tra sai lệch")
+    parser.add_argument("--export", action="store_true", help="Export InceptionResnetV1 sang ONNX FP32")
+    parser.add_argument("--quantize", choices=["dynamic", "static"], help="Tạo bản INT8 từ file ONNX FP32")
+    parser.add_argument("--calib_limit", type=int, default=200, help="Số khuôn mặt hiệu chuẩn (static)")
+    parser.add_argument("--parity", choices=BACKENDS[1:], help="So sánh backend với torch")
+    parser.add_argument("--lock_id", help="--parity: gallery dùng để đo mức đồng thuận quyết định")
+    parser.add_argument("--limit", type=int, default=200, help="--parity: số khuôn mặt tối đa")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_MATCH_THRESHOLD)
+    parser.add_argument("--output", help="Ghi báo cáo parity ra file JSON")
+    args = parser.parse_args()
+
+    dataset_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'dataset'))
+    try:
+        if args.export:
+            export_onnx()
+        if args.quantize:
+            quantize(args.quantize, dataset_root, args.calib_limit)
+        if args.parity:
+            result = parity_check(args.parity, dataset_root, args.lock_id, args.limit, args.threshold)
+            text = json.dumps(result, indent=2, ensure_ascii=False)
+            print(text)
+            if args.output:
+                with open(args.output, 'w', encoding='utf-8') as f:
+                    f.write(text)
+    except ModelLoadError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
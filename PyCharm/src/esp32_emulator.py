@@ -0,0 +1,246 @@
+# esp32_emulator.py - Giả lập ESP32 (Arduino/connect-wifi) trên pseudo-terminal để chạy Recognize/Collect không cần phần cứng
+import argparse
+import os
+import threading
+import time
+from collections import namedtuple
+
+# Một dòng trên đường truyền: direction 'rx' (ESP32 nhận từ Python) hoặc 'tx' (ESP32 gửi), timestamp perf_counter
+WireLine = namedtuple('WireLine', ['timestamp', 'direction', 'line'])
+
+
+class Esp32Script:
+    """
+    Kịch bản cho ESP32 giả lập.
+
+    distance: số cm cố định, None (OUT_RANGE) hoặc hàm f(t giây từ lúc start) -> cm/None
+    distance_interval: chu kỳ gửi DISTANCE (firmware gửi mỗi vòng loop)
+    command_delay: thời gian xử lý mỗi lệnh trước khi phản hồi
+    pin: mã nhập trên keypad sau PIN_PROMPT; None = không nhập (sinh PIN_TIMEOUT sau pin_timeout)
+    key_delay: khoảng cách giữa các phím (kể cả '#')
+    fail_block: FAIL làm firmware bận (delay(2000)): không đọc lệnh, không gửi DISTANCE
+    """
+
+    def __init__(self, distance=60.0, distance_interval=0.05, command_delay=0.0, pin="2828", key_delay=0.3,
+                 pin_timeout=30.0, fail_block=2.0, echo_commands=True):
+        self.distance = distance
+        self.distance_interval = distance_interval
+        self.command_delay = command_delay
+        self.pin = pin
+        self.key_delay = key_delay
+        self.pin_timeout = pin_timeout
+        self.fail_block = fail_block
+        self.echo_commands = echo_commands
+
+    def distance_at(self, t):
+        return self.distance(t) if callable(self.distance) else self.distance
+
+
+class Esp32Emulator:
+    """
+    Nói giao thức serial của firmware: nhận PIN_REQUIRED / SUCCESS / FAIL / RECOGNIZING /
+    RECOGNITION_DONE / SYSTEM_READY, gửi [CMD] <lệnh>, PIN_PROMPT, PIN_ENTERED:<pin>, PIN_TIMEOUT, DISTANCE:<cm>.
+
+    Phía Python mở cổng `port` (đầu slave của pty) bằng serial.Serial như với COM4.
+    Mọi dòng gửi/nhận được ghi lại với timestamp để đo độ trễ (wait_for).
+    """
+
+    def __init__(self, script=None):
+        self.script = script or Esp32Script()
+        self.port = None
+        self.wire = []
+        self.door_opened = 0
+        self.denied = 0
+        self._master_fd = None
+        self._slave_fd = None
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._busy_until = 0.0
+        self._pin_deadline = None
+        self._pin_thread = None
+        self._threads = []
+        self._start_time = None
+
+    def start(self):
+        """
+        Tạo pty (POSIX) và chạy các thread đọc lệnh / gửi DISTANCE. Returns: self (đường dẫn cổng ở self.port).
+        """
+        import pty
+        import tty
+
+        self._master_fd, self._slave_fd = pty.openpty()
+        # Không echo, không đổi \n thành \r\n: hành xử như UART thật
+        tty.setraw(self._slave_fd)
+        self.port = os.ttyname(self._slave_fd)
+        self._start_time = time.perf_counter()
+        for target, name in ((self._read_loop, "esp32-rx"), (self._distance_loop, "esp32-distance")):
+            t = threading.Thread(target=target, name=name, daemon=True)
+            t.start()
+            self._threads.append(t)
+        print(f"[ESP32] Giả lập tại {self.port}")
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        for fd in (self._master_fd, self._slave_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._master_fd = self._slave_fd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _record(self, direction, line):
+        with self._cond:
+            self.wire.append(WireLine(time.perf_counter(), direction, line))
+            self._cond.notify_all()
+
+    def send(self, line):
+        """
+        Gửi một dòng tới phía Python (như Serial.println trên ESP32).
+        """
+        if self._master_fd is None:
+            return
+        with self._write_lock:
+            try:
+                os.write(self._master_fd, f"{line}\r\n".encode())
+            except OSError:
+                return
+        self._record('tx', line)
+
+    def _busy(self):
+        return time.perf_counter() < self._busy_until
+
+    def _read_loop(self):
+        buffer = b""
+        while not self._stop_event.is_set():
+            try:
+                chunk = os.read(self._master_fd, 1024)
+            except OSError:
+                break
+            if not chunk:
+                break
+            buffer += chunk
+            while b"\n" in buffer:
+                raw, buffer = buffer.split(b"\n", 1)
+                command = raw.decode('utf-8', errors='ignore').strip()
+                if not command:
+                    continue
+                self._record('rx', command)
+                # Firmware đang delay(): lệnh chờ đến khi loop chạy lại
+                while self._busy() and not self._stop_event.is_set():
+                    time.sleep(0.001)
+                if self.script.command_delay:
+                    time.sleep(self.script.command_delay)
+                self._handle(command)
+
+    def _handle(self, command):
+        if self.script.echo_commands:
+            self.send(f"[CMD] {command}")
+        if command == "PIN_REQUIRED":
+            self._pin_deadline = time.perf_counter() + self.script.pin_timeout
+            self.send("PIN_PROMPT")
+            self._pin_thread = threading.Thread(target=self._enter_pin, args=(self._pin_deadline,),
+                                                name="esp32-keypad", daemon=True)
+            self._pin_thread.start()
+        elif command == "SUCCESS":
+            self.door_opened += 1
+            self._pin_deadline = None
+        elif command == "FAIL":
+            self.denied += 1
+            self._pin_deadline = None
+            self._busy_until = time.perf_counter() + self.script.fail_block
+
+    def _enter_pin(self, deadline):
+        """
+        Gõ PIN theo kịch bản; hết pin_timeout mà chưa gửi thì báo PIN_TIMEOUT như firmware.
+        """
+        keys = list(self.script.pin) + ['#'] if self.script.pin is not None else []
+        typed = ""
+        for key in keys:
+            if self._stop_event.wait(self.script.key_delay) or self._pin_deadline != deadline:
+                return
+            if key == '#':
+                self._pin_deadline = None
+                self.send(f"PIN_ENTERED:{typed}")
+                return
+            typed += key
+            self.send(f"[DEBUG] PIN Input: {typed}")
+            # Mỗi phím gia hạn thời gian chờ
+            deadline = self._pin_deadline = time.perf_counter() + self.script.pin_timeout
+        while not self._stop_event.is_set() and self._pin_deadline == deadline:
+            if time.perf_counter() >= deadline:
+                self._pin_deadline = None
+                self.send("PIN_TIMEOUT")
+                self._busy_until = time.perf_counter() + 2.0
+                return
+            time.sleep(0.01)
+
+    def _distance_loop(self):
+        while not self._stop_event.wait(self.script.distance_interval):
+            if self._busy():
+                continue
+            cm = self.script.distance_at(time.perf_counter() - self._start_time)
+            self.send("DISTANCE:OUT_RANGE" if cm is None else f"DISTANCE:{cm:.1f}")
+
+    def wait_for(self, line, direction='rx', since=None, timeout=10.0):
+        """
+        Chờ một dòng (khớp đầu dòng) sau thời điểm since.
+        Returns: timestamp perf_counter của dòng đó hoặc None nếu hết thời gian.
+        """
+        since = since if since is not None else 0.0
+
+        def find():
+            for entry in reversed(self.wire):
+                if entry.timestamp < since:
+                    return None
+                if entry.direction == direction and entry.line.startswith(line):
+                    return entry.timestamp
+            return None
+
+        with self._cond:
+            found = [None]
+
+            def ready():
+                found[0] = find()
+                return found[0] is not None
+            self._cond.wait_for(ready, timeout=timeout)
+            return found[0]
+
+    def commands(self):
+        return [entry for entry in self.wire if entry.direction == 'rx']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Giả lập ESP32 trên pty; chạy Recognize.py --serial_port <cổng in ra>")
+    parser.add_argument("--distance", type=float, default=60.0, help="Khoảng cách siêu âm (cm), âm = OUT_RANGE")
+    parser.add_argument("--distance_interval", type=float, default=0.05)
+    parser.add_argument("--command_delay", type=float, default=0.0)
+    parser.add_argument("--pin", default="2828", help="PIN gõ sau PIN_PROMPT ('' = không nhập, để PIN_TIMEOUT)")
+    parser.add_argument("--key_delay", type=float, default=0.3)
+    parser.add_argument("--pin_timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    emulator = Esp32Emulator(Esp32Script(distance=args.distance if args.distance >= 0 else None,
+                                         distance_interval=args.distance_interval,
+                                         command_delay=args.command_delay, pin=args.pin or None,
+                                         key_delay=args.key_delay, pin_timeout=args.pin_timeout)).start()
+    try:
+        seen = 0
+        while True:
+            time.sleep(0.2)
+            for entry in emulator.commands()[seen:]:
+                print(f"[ESP32] <- {entry.line}")
+            seen = len(emulator.commands())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+        print(f"[ESP32] Mở cửa: {emulator.door_opened}, từ chối: {emulator.denied}")
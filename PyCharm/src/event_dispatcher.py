@@ -0,0 +1,171 @@
+# event_dispatcher.py - Đẩy các tác vụ phụ (upload, log, Telegram, giọng nói) ra khỏi vòng nhận diện
+import queue
+import threading
+import time
+
+import cv2
+
+from metrics import REGISTRY
+
+SINK_LATENCY = REGISTRY.histogram('smartlock_sink_latency_seconds', 'Thời gian xử lý một sự kiện của sink', ('sink',))
+SINK_EVENTS = REGISTRY.counter('smartlock_sink_events', 'Sự kiện theo sink và kết quả', ('sink', 'result'))
+
+
+class RecognitionEvent:
+    """
+    Bản ghi một sự kiện nhận diện. Vòng xử lý chỉ tạo bản ghi (giữ bản sao frame)
+    và đưa vào dispatcher; việc mã hóa JPEG được làm trễ trong worker và chỉ làm một lần.
+    """
+
+    def __init__(self, event_type, lock_id, name="Unknown", confidence=0.0, message=None,
+                 speech=None, frame=None, parent=None):
+        self.event_type = event_type
+        self.lock_id = lock_id
+        self.name = name
+        self.confidence = confidence
+        self.message = message
+        self.speech = speech
+        self.frame = frame
+        self.parent = parent  # sự kiện gốc để dùng lại ảnh (ví dụ kết quả PIN)
+        self.timestamp = time.time()
+        self.image_url = None
+        self._jpeg = None
+        self._jpeg_lock = threading.Lock()
+
+    def jpeg_bytes(self):
+        """
+        Trả ảnh JPEG của frame (mã hóa một lần, dùng chung cho mọi sink).
+        Nếu sự kiện không có frame thì dùng ảnh của sự kiện gốc.
+        """
+        if self.frame is None:
+            return self.parent.jpeg_bytes() if self.parent is not None else None
+        with self._jpeg_lock:
+            if self._jpeg is None:
+                ok, buf = cv2.imencode('.jpg', self.frame)
+                self._jpeg = buf.tobytes() if ok else b''
+            return self._jpeg or None
+
+    def resolved_image_url(self):
+        if self.image_url is None and self.parent is not None:
+            return self.parent.resolved_image_url()
+        return self.image_url
+
+
+class EventDispatcher:
+    """
+    Mỗi sink có hàng đợi giới hạn và nhóm worker riêng, nên một sink chậm
+    (ví dụ Telegram timeout 5s) không chặn sink khác hay vòng nhận diện.
+    Khi hàng đợi đầy, sự kiện mới bị bỏ và được đếm trong dropped.
+    """
+
+    def __init__(self, default_queue_size=8):
+        self.default_queue_size = default_queue_size
+        self._sinks = {}
+        self._stopping = False
+
+    def register_sink(self, name, handler, workers=1, queue_size=None, init=None):
+        """
+        handler(event, state) được gọi trong worker; init() (nếu có) chạy một lần
+        trong mỗi worker và kết quả được truyền vào handler dưới dạng state.
+        """
+        if name in self._sinks:
+            raise ValueError(f"Sink đã tồn tại: {name}")
+        sink = {
+            'queue': queue.Queue(maxsize=queue_size or self.default_queue_size),
+            'handler': handler,
+            'init': init,
+            'threads': [],
+            'processed': 0,
+            'failed': 0,
+            'dropped': 0,
+            'lock': threading.Lock(),
+            # Chuỗi metric tạo sẵn cho sink, worker chỉ gọi observe/inc
+            'latency_metric': SINK_LATENCY.labels(name),
+            'ok_metric': SINK_EVENTS.labels(name, 'ok'),
+            'failed_metric': SINK_EVENTS.labels(name, 'failed'),
+            'dropped_metric': SINK_EVENTS.labels(name, 'dropped'),
+        }
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, args=(name, sink), name=f"sink-{name}-{i}", daemon=True)
+            sink['threads'].append(t)
+        self._sinks[name] = sink
+        for t in sink['threads']:
+            t.start()
+
+    def _worker(self, name, sink):
+        state = None
+        if sink['init'] is not None:
+            try:
+                state = sink['init']()
+            except Exception as e:
+                print(f"[WARNING] Không thể khởi tạo sink {name}: {e}")
+        while True:
+            event = sink['queue'].get()
+            try:
+                if event is None:
+                    return
+                start = time.perf_counter()
+                sink['handler'](event, state)
+                sink['latency_metric'].observe(time.perf_counter() - start)
+                sink['ok_metric'].inc()
+                with sink['lock']:
+                    sink['processed'] += 1
+            except Exception as e:
+                sink['failed_metric'].inc()
+                with sink['lock']:
+                    sink['failed'] += 1
+                print(f"[ERROR] Sink {name} lỗi: {e}")
+            finally:
+                sink['queue'].task_done()
+
+    def dispatch(self, event, sinks):
+        """
+        Đưa sự kiện vào hàng đợi của từng sink, không bao giờ chặn.
+        Returns: danh sách sink đã nhận sự kiện.
+        """
+        accepted = []
+        if self._stopping:
+            return accepted
+        for name in sinks:
+            sink = self._sinks.get(name)
+            if sink is None:
+                continue
+            try:
+                sink['queue'].put_nowait(event)
+                accepted.append(name)
+            except queue.Full:
+                sink['dropped_metric'].inc()
+                with sink['lock']:
+                    sink['dropped'] += 1
+                print(f"[WARNING] Hàng đợi sink {name} đầy, bỏ sự kiện {event.event_type}")
+        return accepted
+
+    def stop(self, timeout=10.0):
+        """
+        Ngừng nhận sự kiện mới, chờ các sink xử lý hết hàng đợi (tối đa timeout giây).
+        """
+        self._stopping = True
+        deadline = time.monotonic() + timeout
+        for sink in self._sinks.values():
+            for _ in sink['threads']:
+                while True:
+                    try:
+                        sink['queue'].put(None, timeout=max(0.0, deadline - time.monotonic()))
+                        break
+                    except queue.Full:
+                        if time.monotonic() >= deadline:
+                            break
+        for sink in self._sinks.values():
+            for t in sink['threads']:
+                t.join(timeout=max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        return {
+            name: {
+                'queued': sink['queue'].qsize(),
+                'processed': sink['processed'],
+                'failed': sink['failed'],
+                'dropped': sink['dropped'],
+            }
+            for name, sink in self._sinks.items()
+        }
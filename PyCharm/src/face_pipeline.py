@@ -0,0 +1,222 @@
+# face_pipeline.py - Các bước phát hiện, căn chỉnh và trích xuất embedding dùng chung
+import os
+
+import cv2
+import numpy as np
+import torch
+
+from model_loader import load_mtcnn
+
+# Kích thước chung của các crop trước khi đưa vào MTCNN theo batch
+# (MTCNN chỉ xử lý batch khi mọi ảnh có cùng kích thước)
+ALIGN_INPUT_SIZE = 224
+
+# Kích thước đầu vào của InceptionResnetV1
+EMBED_IMAGE_SIZE = 160
+
+# Kích thước khuôn mặt tối thiểu (pixel trên frame gốc)
+MIN_FACE_SIZE = 150
+
+# Các chế độ phát hiện + căn chỉnh:
+# - ssd_mtcnn: SSD tìm box, MTCNN chạy lại trên từng crop để căn chỉnh (cách cũ, hai bộ phát hiện)
+# - ssd_crop: SSD tìm box, cắt vuông + resize 160x160 trực tiếp (bỏ hẳn MTCNN)
+# - mtcnn: MTCNN chạy một lần trên frame thu nhỏ, vừa cho box vừa cho ảnh căn chỉnh (bỏ SSD)
+PIPELINE_MODES = ("ssd_mtcnn", "ssd_crop", "mtcnn")
+
+
+# Tải mô hình DNN
+def get_model_paths():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    cascades_dir = os.path.abspath(os.path.join(base_dir, "..", "cascades"))
+    proto_path = os.path.join(cascades_dir, "deploy.prototxt")
+    model_path = os.path.join(cascades_dir, "res10_300x300_ssd_iter_140000.caffemodel")
+    return proto_path, model_path
+
+def check_model_files():
+    proto_path, model_path = get_model_paths()
+    if not os.path.exists(proto_path):
+        print(f"[ERROR] Không tìm thấy file prototxt tại: {proto_path}")
+        print("Vui lòng tải từ: https://raw.githubusercontent.com/opencv/opencv/master/samples/dnn/face_detector/deploy.prototxt")
+        return False
+    if not os.path.exists(model_path):
+        print(f"[ERROR] Không tìm thấy file model tại: {model_path}")
+        print("Vui lòng tải từ: https://github.com/opencv/opencv_3rdparty/raw/dnn_samples_face_detector_20180205_fp16/res10_300x300_ssd_iter_140000_fp16.caffemodel")
+        return False
+    print("[SUCCESS] Tất cả file mô hình đã sẵn sàng")
+    return True
+
+def load_deep_face_detector():
+    proto_path, model_path = get_model_paths()
+    if not check_model_files():
+        print("[WARNING] Sử dụng Haar Cascade thay thế")
+        return None
+    try:
+        net = cv2.dnn.readNetFromCaffe(proto_path, model_path)
+        print("[INFO] Đã tải thành công DNN model")
+        return net
+    except Exception as e:
+        print(f"[ERROR] Lỗi khi tải DNN model: {str(e)}")
+        return None
+
+def detect_faces_dnn(net, frame, conf_threshold=0.7, input_size=300, min_face_size=MIN_FACE_SIZE):
+    # input_size < 300 giảm chi phí SSD khi máy yếu (bộ lập lịch khung hình điều chỉnh)
+    h, w = frame.shape[:2]
+    blob = cv2.dnn.blobFromImage(cv2.resize(frame, (input_size, input_size)), 1.0,
+                                 (input_size, input_size), (104.0, 177.0, 123.0))
+    net.setInput(blob)
+    detections = net.forward()
+    faces = []
+    for i in range(detections.shape[2]):
+        confidence = detections[0, 0, i, 2]
+        if confidence > conf_threshold:
+            box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
+            (x, y, x2, y2) = box.astype("int")
+            width, height = x2 - x, y2 - y
+            if width >= min_face_size and height >= min_face_size:
+                faces.append((x, y, width, height))
+    return faces
+
+
+def standardize_face(face_rgb):
+    """
+    Chuẩn hóa ảnh khuôn mặt RGB uint8 giống MTCNN(post_process=True): (x - 127.5) / 128.
+    Returns: tensor 3xHxW float32.
+    """
+    tensor = torch.from_numpy(np.ascontiguousarray(face_rgb)).permute(2, 0, 1).float()
+    return (tensor - 127.5) / 128.0
+
+
+def square_crop_images(frame, boxes, image_size=EMBED_IMAGE_SIZE, margin=0.0):
+    """
+    Cắt vùng vuông quanh tâm mỗi box (x, y, w, h), nới thêm margin (tỉ lệ theo cạnh) rồi resize
+    về image_size. Giữ nguyên không gian màu của frame.
+    Returns: list ảnh uint8 SxSx3 hoặc None nếu box nằm ngoài frame.
+    """
+    h_img, w_img = frame.shape[:2]
+    crops = []
+    for (x, y, w, h) in boxes:
+        side = int(max(w, h) * (1.0 + margin))
+        cx, cy = x + w // 2, y + h // 2
+        x1, y1 = max(0, cx - side // 2), max(0, cy - side // 2)
+        x2, y2 = min(w_img, x1 + side), min(h_img, y1 + side)
+        crop = frame[y1:y2, x1:x2]
+        if crop.size == 0:
+            crops.append(None)
+            continue
+        crops.append(cv2.resize(crop, (image_size, image_size), interpolation=cv2.INTER_AREA))
+    return crops
+
+
+def square_crop_faces(frame_rgb, boxes, image_size=EMBED_IMAGE_SIZE, margin=0.0):
+    """
+    Chế độ ssd_crop thay cho MTCNN: cắt vuông + resize + chuẩn hóa.
+    Returns: list tensor 3xSxS hoặc None nếu box nằm ngoài frame.
+    """
+    return [
+        standardize_face(crop) if crop is not None else None
+        for crop in square_crop_images(frame_rgb, boxes, image_size, margin)
+    ]
+
+
+def create_full_frame_mtcnn(device, min_face_size=40):
+    """
+    MTCNN cho chế độ mtcnn: chạy trên frame đã thu nhỏ nên min_face_size nhỏ hơn,
+    keep_all=True để lấy mọi khuôn mặt trong frame.
+    """
+    return load_mtcnn(
+        device,
+        image_size=EMBED_IMAGE_SIZE,
+        keep_all=True,
+        min_face_size=min_face_size,
+        thresholds=[0.6, 0.7, 0.7],
+        post_process=True
+    )
+
+
+def detect_and_align_mtcnn(mtcnn_full, frame_rgb, scale=0.5, min_face_size=MIN_FACE_SIZE, prob_threshold=0.9):
+    """
+    Một bộ phát hiện duy nhất: MTCNN (P/R/O-Net) trên frame thu nhỏ theo scale, sau đó
+    cắt ảnh căn chỉnh 160x160 từ frame gốc theo box đã phóng lại.
+    Returns: (boxes dạng (x, y, w, h) trên frame gốc, list tensor căn chỉnh)
+    """
+    small = cv2.resize(frame_rgb, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale != 1.0 else frame_rgb
+    boxes, probs = mtcnn_full.detect(small)
+    if boxes is None:
+        return [], []
+    keep = []
+    for box, prob in zip(boxes, probs):
+        x1, y1, x2, y2 = box / scale
+        if prob < prob_threshold or (x2 - x1) < min_face_size or (y2 - y1) < min_face_size:
+            continue
+        keep.append([x1, y1, x2, y2])
+    if not keep:
+        return [], []
+    keep = np.array(keep, dtype=np.float32)
+    aligned = mtcnn_full.extract(frame_rgb, keep, None)
+    faces = [(int(x1), int(y1), int(x2 - x1), int(y2 - y1)) for x1, y1, x2, y2 in keep]
+    return faces, list(aligned)
+
+
+def _pad_to_square(img):
+    # Viền đen quanh cạnh ngắn để resize không kéo giãn khuôn mặt
+    h, w = img.shape[:2]
+    if h == w:
+        return img
+    side = max(h, w)
+    top, left = (side - h) // 2, (side - w) // 2
+    return cv2.copyMakeBorder(img, top, side - h - top, left, side - w - left, cv2.BORDER_CONSTANT, value=0)
+
+
+def align_face_crops(mtcnn, face_crops, input_size=ALIGN_INPUT_SIZE):
+    """
+    Căn chỉnh nhiều crop khuôn mặt (RGB) trong một lần gọi MTCNN.
+    Crop được đệm thành hình vuông trước khi resize về input_size (giữ tỉ lệ khuôn mặt).
+    Returns: list cùng độ dài với face_crops, mỗi phần tử là tensor 3x160x160 hoặc None.
+    """
+    if not face_crops:
+        return []
+    resized = []
+    for crop in face_crops:
+        crop = _pad_to_square(crop)
+        resized.append(cv2.resize(crop, (input_size, input_size)) if crop.shape[0] != input_size else crop)
+    aligned = mtcnn(resized)
+    if aligned is None:
+        return [None] * len(face_crops)
+    return list(aligned)
+
+
+def embed_aligned_faces(resnet, face_tensors, device):
+    """
+    Chạy InceptionResnetV1 một lần trên batch các tensor đã căn chỉnh.
+    Returns: list embeddings (numpy 1D) hoặc None, giữ nguyên thứ tự đầu vào.
+    """
+    valid = [i for i, t in enumerate(face_tensors) if t is not None]
+    results = [None] * len(face_tensors)
+    if not valid:
+        return results
+
+    batch = torch.stack([face_tensors[i] for i in valid]).to(device)
+    with torch.inference_mode():
+        embeddings = resnet(batch).cpu().numpy()
+    for i, emb in zip(valid, embeddings):
+        results[i] = emb
+    return results
+
+
+def embed_face_crops(mtcnn, resnet, face_crops, device):
+    """
+    Pipeline batch cho mọi khuôn mặt trong một frame: căn chỉnh chung rồi một forward pass.
+    Returns: list embeddings (numpy 1D) hoặc None cho crop không căn chỉnh được.
+    """
+    return embed_aligned_faces(resnet, align_face_crops(mtcnn, face_crops), device)
+
+
+def stack_embeddings(embeddings):
+    """
+    Gom các embedding hợp lệ thành ma trận để so khớp một lần.
+    Returns: (vị trí trong list gốc, ma trận [N, D])
+    """
+    valid = [i for i, emb in enumerate(embeddings) if emb is not None]
+    if not valid:
+        return valid, np.zeros((0, 512), dtype=np.float32)
+    return valid, np.stack([embeddings[i] for i in valid]).astype(np.float32)
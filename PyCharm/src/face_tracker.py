@@ -0,0 +1,167 @@
+# face_tracker.py - Theo dõi khuôn mặt giữa các frame để không embed lại cùng một người mỗi frame
+import numpy as np
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    IoU giữa hai tập box dạng (x, y, w, h). Returns: ma trận [len(a), len(b)].
+    """
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    ax2, ay2 = a[:, 0] + a[:, 2], a[:, 1] + a[:, 3]
+    bx2, by2 = b[:, 0] + b[:, 2], b[:, 1] + b[:, 3]
+    iw = np.clip(np.minimum(ax2[:, None], bx2[None, :]) - np.maximum(a[:, 0][:, None], b[:, 0][None, :]), 0, None)
+    ih = np.clip(np.minimum(ay2[:, None], by2[None, :]) - np.maximum(a[:, 1][:, None], b[:, 1][None, :]), 0, None)
+    inter = iw * ih
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - inter
+    return inter / np.maximum(union, 1e-6)
+
+
+class Track:
+    """
+    Một khuôn mặt được theo dõi. identity là kết quả so khớp gần nhất (MatchResult hoặc None).
+    """
+
+    def __init__(self, track_id, box, frame_idx):
+        self.track_id = track_id
+        self.box = tuple(int(v) for v in box)
+        self.first_frame = frame_idx
+        self.last_seen = frame_idx
+        self.misses = 0
+        self.hits = 1
+        self.identity = None
+        self.is_known = False
+        self.verified = False
+        self.verified_frame = None
+        self.verified_box = None
+
+    def centroid(self):
+        x, y, w, h = self.box
+        return x + w / 2.0, y + h / 2.0
+
+
+class FaceTracker:
+    """
+    Gán ID ổn định cho các box từ detect_faces_dnn bằng IoU (dự phòng bằng khoảng cách tâm).
+    Danh tính của track được cache và chỉ xác minh lại khi:
+    - đã qua reverify_interval frame (unknown_reverify_interval nếu đang là người lạ), hoặc
+    - hình học box thay đổi nhiều so với lúc xác minh (IoU < min_verified_iou hoặc kích thước đổi > max_scale_change).
+    """
+
+    def __init__(self, iou_threshold=0.3, max_centroid_shift=0.5, max_misses=5,
+                 reverify_interval=15, unknown_reverify_interval=5,
+                 min_verified_iou=0.5, max_scale_change=0.3):
+        self.iou_threshold = iou_threshold
+        self.max_centroid_shift = max_centroid_shift
+        self.max_misses = max_misses
+        self.reverify_interval = reverify_interval
+        self.unknown_reverify_interval = unknown_reverify_interval
+        self.min_verified_iou = min_verified_iou
+        self.max_scale_change = max_scale_change
+
+        self.tracks = []
+        self.frame_idx = 0
+        self._next_id = 1
+
+        self.embed_requests = 0
+        self.cache_hits = 0
+
+    def update(self, boxes):
+        """
+        Cập nhật tracker với các box của frame hiện tại.
+        Returns: list Track tương ứng từng box (cùng thứ tự).
+        """
+        self.frame_idx += 1
+        boxes = [tuple(int(v) for v in b) for b in boxes]
+        assigned = [None] * len(boxes)
+
+        if self.tracks and boxes:
+            iou = box_iou([t.box for t in self.tracks], boxes)
+            # Ghép tham lam theo IoU giảm dần
+            pairs = np.argwhere(iou >= self.iou_threshold)
+            order = np.argsort(-iou[pairs[:, 0], pairs[:, 1]]) if len(pairs) else []
+            used_tracks = set()
+            for k in order:
+                ti, bi = pairs[k]
+                if ti in used_tracks or assigned[bi] is not None:
+                    continue
+                used_tracks.add(ti)
+                assigned[bi] = self.tracks[ti]
+
+            # Box chưa ghép: thử theo khoảng cách tâm (khuôn mặt di chuyển nhanh)
+            for bi, box in enumerate(boxes):
+                if assigned[bi] is not None:
+                    continue
+                bx, by = box[0] + box[2] / 2.0, box[1] + box[3] / 2.0
+                best, best_dist = None, None
+                for ti, track in enumerate(self.tracks):
+                    if ti in used_tracks:
+                        continue
+                    tx, ty = track.centroid()
+                    dist = np.hypot(bx - tx, by - ty) / max(track.box[2], 1)
+                    if dist <= self.max_centroid_shift and (best_dist is None or dist < best_dist):
+                        best, best_dist = ti, dist
+                if best is not None:
+                    used_tracks.add(best)
+                    assigned[bi] = self.tracks[best]
+
+        for bi, box in enumerate(boxes):
+            track = assigned[bi]
+            if track is None:
+                track = Track(self._next_id, box, self.frame_idx)
+                self._next_id += 1
+                self.tracks.append(track)
+                assigned[bi] = track
+            else:
+                track.box = box
+                track.last_seen = self.frame_idx
+                track.misses = 0
+                track.hits += 1
+
+        # Bỏ các track đã mất quá lâu
+        matched = set(id(t) for t in assigned)
+        for track in self.tracks:
+            if id(track) not in matched:
+                track.misses += 1
+        self.tracks = [t for t in self.tracks if t.misses <= self.max_misses]
+        return assigned
+
+    def needs_embedding(self, track):
+        """
+        True nếu track cần chạy lại MTCNN + embedding ở frame này.
+        """
+        if not track.verified or track.identity is None:
+            needed = True
+        else:
+            interval = self.reverify_interval if track.is_known else self.unknown_reverify_interval
+            needed = (self.frame_idx - track.verified_frame) >= interval or self._geometry_changed(track)
+        if needed:
+            self.embed_requests += 1
+        else:
+            self.cache_hits += 1
+        return needed
+
+    def _geometry_changed(self, track):
+        if track.verified_box is None:
+            return True
+        iou = box_iou([track.box], [track.verified_box])[0, 0]
+        scale = track.box[2] / max(track.verified_box[2], 1)
+        return iou < self.min_verified_iou or abs(scale - 1.0) > self.max_scale_change
+
+    def set_identity(self, track, match, is_known):
+        """
+        Lưu kết quả so khớp cho track. match có thể là None (không căn chỉnh được).
+        is_known=False đánh dấu người lạ để xác minh lại sớm hơn.
+        """
+        track.identity = match
+        track.is_known = bool(is_known)
+        track.verified = match is not None
+        track.verified_frame = self.frame_idx
+        track.verified_box = track.box
+
+    def stats(self):
+        return {
+            'active_tracks': len(self.tracks),
+            'embed_requests': self.embed_requests,
+            'cache_hits': self.cache_hits,
+        }
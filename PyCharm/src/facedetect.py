@@ -5,7 +5,7 @@ import cv2
 import firebase_admin
 from firebase_admin import credentials, storage
 from datetime import datetime
-from facenet_pytorch import MTCNN
+from model_loader import load_mtcnn
 import pyttsx3
 import numpy as np
 import logging
@@ -15,6 +15,7 @@ import threading
 import time
 from dotenv import load_dotenv
 from image_enhancement import enhance_image_for_low_light, detect_low_light
+from camera_capture import CaptureThread
 
 # === Cấu hình stdout UTF-8 cho Windows ===
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
@@ -186,7 +187,8 @@ def process_single_image(image_path, face_id, face_name, lock_id, is_pending=Fal
     try:
         import torch
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        mtcnn = MTCNN(keep_all=False, min_face_size=50, device=device)
+        # Dùng chung MTCNN đã tải trong tiến trình thay vì tạo lại cho mỗi ảnh
+        mtcnn = load_mtcnn(device, keep_all=False, min_face_size=50)
         
         frame = cv2.imread(image_path)
         if frame is None:
@@ -303,14 +305,16 @@ def main():
 
     cam.set(3, 640)
     cam.set(4, 480)
+    capture = CaptureThread(cam, buffer_size=1, flip=True).start()
 
     # === MTCNN ===
     try:
-        mtcnn = MTCNN(keep_all=False, min_face_size=80, device='cpu')
+        mtcnn = load_mtcnn('cpu', keep_all=False, min_face_size=80)
         logging.info("MTCNN đã sẵn sàng")
     except Exception as e:
         logging.error(f"MTCNN lỗi: {e}")
         speak("Không thể tải mô hình khuôn mặt.")
+        capture.stop()
         cam.release()
         return
 
@@ -336,11 +340,11 @@ def main():
 
     try:
         while count < sample_limit:
-            ret, frame = cam.read()
-            if not ret:
+            captured = capture.read(timeout=1.0)
+            if captured is None:
                 continue
 
-            frame = cv2.flip(frame, 1)
+            frame = captured.frame
             
             # === XỬ LÝ ÁNH SÁNG YẾU ===
             is_low_light, brightness = detect_low_light(frame)
@@ -423,6 +427,7 @@ def main():
         logging.error(f"Lỗi trong vòng lặp: {e}")
         print(f"ERROR:Đã xảy ra lỗi: {e}")
     finally:
+        capture.stop()
         cam.release()
         cv2.destroyAllWindows()
         final_message = f"Đã thu thập {count} ảnh. Cảm ơn {face_name}!"
@@ -0,0 +1,130 @@
+# fake_camera.py - Camera giả phát frame theo kịch bản (nền trống, ảnh, video) thay cho cv2.VideoCapture
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from bench_utils import iter_frames
+
+# frames: list frame BGR phát lặp vòng trong duration giây; face: đoạn có người trước camera
+Segment = namedtuple('Segment', ['frames', 'duration', 'face', 'label'])
+
+
+def blank_frame(size=(640, 480), level=70):
+    """
+    Khung cửa trống: ảnh xám tĩnh (không có chuyển động để cổng hiện diện giữ trạng thái chờ).
+    """
+    return np.full((size[1], size[0], 3), level, dtype=np.uint8)
+
+
+def parse_script(spec, size=(640, 480)):
+    """
+    Kịch bản dạng "blank:2,../temp/*.jpg:5": các đoạn nguồn:giây, 'blank' là khung cửa trống.
+    Returns: list Segment
+    """
+    segments = []
+    for part in spec.split(','):
+        part = part.strip()
+        source, sep, seconds = part.rpartition(':')
+        try:
+            duration = float(seconds) if sep else None
+        except ValueError:
+            duration = None
+        if duration is None:
+            # Không có thời lượng (hoặc ':' thuộc đường dẫn Windows)
+            source = part
+        if source == "blank":
+            segments.append(Segment([blank_frame(size)], duration or 1.0, False, source))
+            continue
+        frames = list(iter_frames(source, size=size))
+        if not frames:
+            raise ValueError(f"Không có frame nào tại {source}")
+        segments.append(Segment(frames, duration, True, source))
+    return segments
+
+
+class ScriptedCamera:
+    """
+    Thay cho cv2.VideoCapture (read/isOpened/set/get/release), dùng được với CaptureThread.
+
+    Phát các Segment theo thời gian thực ở fps cố định; đoạn không có duration phát mỗi frame một lần.
+    face_onsets: timestamp perf_counter của frame đầu tiên mỗi đoạn có người (mốc đo độ trễ đầu-cuối).
+    """
+
+    def __init__(self, segments, fps=15.0, loop=False, realtime=True):
+        self.segments = list(segments)
+        self.fps = fps
+        self.loop = loop
+        self.realtime = realtime
+        self.face_onsets = []
+        self.frames_read = 0
+        self._segment_idx = 0
+        self._segment_start = None
+        self._frame_idx = 0
+        self._next_due = None
+        self._opened = bool(self.segments)
+
+    @classmethod
+    def from_spec(cls, spec, fps=15.0, size=(640, 480), loop=False):
+        return cls(parse_script(spec, size), fps=fps, loop=loop)
+
+    def isOpened(self):
+        return self._opened
+
+    def set(self, prop, value):
+        return False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        return 0.0
+
+    def release(self):
+        self._opened = False
+
+    @property
+    def current_segment(self):
+        return self.segments[self._segment_idx] if self._opened else None
+
+    def _advance(self, now):
+        """
+        Chuyển đoạn khi hết thời lượng / hết frame. Returns: False khi kịch bản kết thúc.
+        """
+        segment = self.segments[self._segment_idx]
+        elapsed = now - self._segment_start
+        finished = (elapsed >= segment.duration if segment.duration is not None
+                    else self._frame_idx >= len(segment.frames))
+        if not finished:
+            return True
+        self._segment_idx += 1
+        if self._segment_idx >= len(self.segments):
+            if not self.loop:
+                self._opened = False
+                return False
+            self._segment_idx = 0
+        self._segment_start = None
+        self._frame_idx = 0
+        return True
+
+    def read(self):
+        if not self._opened:
+            return False, None
+        if self.realtime:
+            now = time.perf_counter()
+            if self._next_due is not None and now < self._next_due:
+                time.sleep(self._next_due - now)
+            self._next_due = max(self._next_due or 0.0, time.perf_counter() - 1.0 / self.fps) + 1.0 / self.fps
+
+        now = time.perf_counter()
+        if self._segment_start is not None and not self._advance(now):
+            return False, None
+        segment = self.segments[self._segment_idx]
+        if self._segment_start is None:
+            self._segment_start = now
+            if segment.face:
+                self.face_onsets.append(now)
+        frame = segment.frames[self._frame_idx % len(segment.frames)]
+        self._frame_idx += 1
+        self.frames_read += 1
+        return True, frame.copy()
@@ -0,0 +1,173 @@
+# firebase_sync.py - Đồng bộ ảnh khuôn mặt từ Firebase Storage về dataset/<lock_id>/ theo diff (name, generation, md5)
+import base64
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from gallery_store import write_json_atomic
+
+SYNC_FILE = "firebase_sync.json"
+SYNC_VERSION = 1
+
+# Thứ tự ưu tiên khi cùng một file có ở cả hai thư mục: faces/ thắng pending_faces/
+REMOTE_FOLDERS = ("faces", "pending_faces")
+
+DEFAULT_DOWNLOAD_WORKERS = 8
+
+# Chỉ lấy các trường cần cho diff -> mỗi trang list_blobs nhỏ hơn nhiều
+LIST_FIELDS = "items(name,generation,md5Hash,size),nextPageToken"
+
+RemoteBlob = namedtuple('RemoteBlob', ['rel_path', 'name', 'generation', 'md5', 'size', 'blob'])
+SyncPlan = namedtuple('SyncPlan', ['download', 'unchanged', 'gone'])
+
+
+def _local_md5(path):
+    """
+    MD5 của file local theo định dạng md5Hash của GCS (base64 của digest).
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode('ascii')
+
+
+def load_sync_cache(dataset_dir):
+    """
+    Đọc danh sách blob đã đồng bộ lần trước.
+    Returns: dict rel_path -> {name, generation, md5, size, mtime} (rỗng nếu không có / hỏng).
+    """
+    path = os.path.join(dataset_dir, SYNC_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Sync cache hỏng, bỏ qua: {e}")
+        return {}
+    if cache.get('version') != SYNC_VERSION:
+        return {}
+    return cache.get('entries', {})
+
+
+def save_sync_cache(dataset_dir, entries):
+    write_json_atomic(os.path.join(dataset_dir, SYNC_FILE), {
+        'version': SYNC_VERSION,
+        'synced_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'entries': entries,
+    })
+
+
+def list_remote(bucket, lock_id):
+    """
+    Liệt kê ảnh của khóa bằng một list_blobs cho mỗi thư mục trong REMOTE_FOLDERS (không quét
+    locks/<lock_id>/logs/, nơi mỗi sự kiện nhận diện thêm một ảnh), chỉ lấy name/generation/md5/size.
+    Returns: dict rel_path ("<user_id>/<filename>") -> RemoteBlob
+    """
+    remote = {}
+    # Duyệt theo thứ tự ưu tiên: file đã có từ thư mục trước thì giữ nguyên
+    for folder in REMOTE_FOLDERS:
+        for blob in bucket.list_blobs(prefix=f"locks/{lock_id}/{folder}/", fields=LIST_FIELDS):
+            parts = blob.name.split('/')
+            # mong muốn dạng: locks/<lockId>/<folder>/<userId>/<filename>
+            if len(parts) != 5 or not parts[4]:
+                continue
+            rel_path = f"{parts[3]}/{parts[4]}"
+            if rel_path not in remote:
+                remote[rel_path] = RemoteBlob(rel_path, blob.name, blob.generation, blob.md5_hash, blob.size, blob)
+    return remote
+
+
+def plan_sync(remote, cache, dataset_dir):
+    """
+    So sánh danh sách remote với cache và file local:
+    - unchanged: file local còn nguyên (size+mtime khớp cache) và blob cùng generation,
+      hoặc md5 file local trùng md5 của blob (file có sẵn nhưng chưa có trong cache)
+    - download: file local thiếu hoặc blob đã đổi
+    - gone: có trong cache nhưng không còn trên Firebase (file local được giữ lại)
+    Returns: SyncPlan; cache được cập nhật tại chỗ cho các file unchanged.
+    """
+    download, unchanged = [], []
+    for rel_path, item in sorted(remote.items()):
+        local_path = os.path.join(dataset_dir, *rel_path.split('/'))
+        if not os.path.exists(local_path):
+            download.append(item)
+            continue
+        st = os.stat(local_path)
+        entry = cache.get(rel_path)
+        if (entry is not None and entry['generation'] == item.generation
+                and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns):
+            unchanged.append(item)
+            continue
+        if item.md5 and _local_md5(local_path) == item.md5:
+            cache[rel_path] = _cache_entry(item, st)
+            unchanged.append(item)
+            continue
+        download.append(item)
+    gone = [rel_path for rel_path in cache if rel_path not in remote]
+    return SyncPlan(download, unchanged, gone)
+
+
+def _cache_entry(item, st):
+    return {
+        'name': item.name,
+        'generation': item.generation,
+        'md5': item.md5,
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+    }
+
+
+def _download(item, dataset_dir):
+    local_path = os.path.join(dataset_dir, *item.rel_path.split('/'))
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    tmp_path = f"{local_path}.part-{os.getpid()}"
+    try:
+        # Chỉ nhận đúng generation đã list để md5 trong cache khớp nội dung file
+        item.blob.download_to_filename(tmp_path, if_generation_match=item.generation)
+        os.replace(tmp_path, local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return item, os.stat(local_path)
+
+
+def sync_lock(bucket, lock_id, dataset_dir, workers=DEFAULT_DOWNLOAD_WORKERS):
+    """
+    Đồng bộ ảnh của khóa từ Firebase: list một lần, tính diff, tải song song (tối đa workers luồng)
+    chỉ các blob thiếu hoặc đã đổi, rồi ghi lại cache.
+    Returns: tập rel_path vừa được tải về.
+    """
+    start = time.perf_counter()
+    cache = load_sync_cache(dataset_dir)
+    remote = list_remote(bucket, lock_id)
+    listed = time.perf_counter()
+    plan = plan_sync(remote, cache, dataset_dir)
+    print(f"[FIREBASE] {len(remote)} blobs listed in {listed - start:.2f}s: "
+          f"{len(plan.download)} to download, {len(plan.unchanged)} unchanged, {len(plan.gone)} removed remotely")
+
+    for rel_path in plan.gone:
+        del cache[rel_path]
+
+    downloaded = set()
+    if plan.download:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(_download, item, dataset_dir): item for item in plan.download}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    _, st = future.result()
+                except Exception as e:
+                    print(f"[WARN] Không thể download {item.name}: {e}")
+                    continue
+                cache[item.rel_path] = _cache_entry(item, st)
+                downloaded.add(item.rel_path)
+                print(f"[DOWNLOAD] {item.name} -> {item.rel_path}")
+
+    save_sync_cache(dataset_dir, cache)
+    print(f"[FIREBASE] Sync done in {time.perf_counter() - start:.2f}s ({len(downloaded)} downloaded)")
+    return downloaded
@@ -0,0 +1,113 @@
+# frame_scheduler.py - Giữ thời gian xử lý mỗi frame trong ngân sách bằng cách hạ/tăng mức chất lượng
+from collections import namedtuple
+
+# Một mức chất lượng: kích thước đầu vào SSD, mức tăng cường ảnh, xử lý 1 trên mỗi skip_every frame
+QualityLevel = namedtuple('QualityLevel', ['detect_size', 'enhance_tier', 'skip_every'])
+
+DEFAULT_LEVELS = (
+    QualityLevel(300, "full", 1),
+    QualityLevel(300, "fast", 1),
+    QualityLevel(240, "fast", 1),
+    QualityLevel(240, "off", 2),
+    QualityLevel(200, "off", 3),
+)
+
+
+class AdaptiveScheduler:
+    """
+    Theo dõi độ trễ từng bước (EMA) và tổng thời gian mỗi frame được xử lý.
+    - Vượt ngân sách (frame_budget_ms * degrade_ratio) trong degrade_after frame liên tiếp → hạ một mức.
+    - Dưới ngân sách (frame_budget_ms * upgrade_ratio) trong upgrade_after frame liên tiếp → tăng một mức.
+    """
+
+    def __init__(self, frame_budget_ms=125.0, levels=DEFAULT_LEVELS, alpha=0.2,
+                 degrade_ratio=1.1, upgrade_ratio=0.6, degrade_after=5, upgrade_after=30):
+        self.frame_budget_ms = frame_budget_ms
+        self.levels = tuple(levels)
+        self.alpha = alpha
+        self.degrade_ratio = degrade_ratio
+        self.upgrade_ratio = upgrade_ratio
+        self.degrade_after = degrade_after
+        self.upgrade_after = upgrade_after
+
+        self.level_idx = 0
+        self.stage_ema_ms = {}
+        self.frame_ema_ms = None
+        self._over = 0
+        self._under = 0
+        self._frame_idx = 0
+
+        self.frames_skipped = 0
+        self.frames_processed = 0
+        self.degrades = 0
+        self.upgrades = 0
+        self.frames_per_level = [0] * len(self.levels)
+
+    @property
+    def level(self):
+        return self.levels[self.level_idx]
+
+    def should_process(self):
+        """
+        Gọi mỗi frame trước khi xử lý; False nghĩa là bỏ qua frame này (chỉ hiển thị).
+        """
+        self._frame_idx += 1
+        if self._frame_idx % self.level.skip_every != 0:
+            self.frames_skipped += 1
+            return False
+        self.frames_processed += 1
+        self.frames_per_level[self.level_idx] += 1
+        return True
+
+    def record(self, stage, elapsed_ms):
+        prev = self.stage_ema_ms.get(stage)
+        self.stage_ema_ms[stage] = elapsed_ms if prev is None else prev + self.alpha * (elapsed_ms - prev)
+
+    def end_frame(self, frame_ms):
+        """
+        Ghi tổng thời gian frame vừa xử lý và điều chỉnh mức chất lượng nếu cần.
+        """
+        if self.frame_ema_ms is None:
+            self.frame_ema_ms = frame_ms
+        else:
+            self.frame_ema_ms += self.alpha * (frame_ms - self.frame_ema_ms)
+        if not self.frame_budget_ms:
+            return
+
+        if self.frame_ema_ms > self.frame_budget_ms * self.degrade_ratio:
+            self._over += 1
+            self._under = 0
+        elif self.frame_ema_ms < self.frame_budget_ms * self.upgrade_ratio:
+            self._under += 1
+            self._over = 0
+        else:
+            self._over = self._under = 0
+
+        if self._over >= self.degrade_after and self.level_idx < len(self.levels) - 1:
+            self._change_level(self.level_idx + 1)
+            self.degrades += 1
+        elif self._under >= self.upgrade_after and self.level_idx > 0:
+            self._change_level(self.level_idx - 1)
+            self.upgrades += 1
+
+    def _change_level(self, idx):
+        print(f"[SCHED] Mức {self.level_idx} → {idx} {self.levels[idx]} (frame EMA {self.frame_ema_ms:.1f} ms)")
+        self.level_idx = idx
+        self._over = self._under = 0
+        # Tránh dùng EMA cũ để quyết định tiếp ngay sau khi đổi mức
+        self.frame_ema_ms = None
+
+    def metrics(self):
+        return {
+            'level': self.level_idx,
+            'detect_size': self.level.detect_size,
+            'enhance_tier': self.level.enhance_tier,
+            'skip_every': self.level.skip_every,
+            'frame_ema_ms': round(self.frame_ema_ms or 0.0, 2),
+            'stage_ema_ms': {k: round(v, 2) for k, v in self.stage_ema_ms.items()},
+            'frames_processed': self.frames_processed,
+            'frames_skipped': self.frames_skipped,
+            'frames_per_level': list(self.frames_per_level),
+            'degrades': self.degrades,
+            'upgrades': self.upgrades,
+        }
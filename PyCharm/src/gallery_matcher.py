@@ -0,0 +1,159 @@
+# gallery_matcher.py - So khớp embeddings với gallery bằng phép nhân ma trận
+from collections import namedtuple
+from collections.abc import Sequence
+
+import numpy as np
+
+from ann_index import DEFAULT_NPROBE
+
+MatchResult = namedtuple('MatchResult', ['index', 'face_id', 'name', 'distance', 'confidence'])
+
+
+def distance_to_confidence(distances):
+    """
+    Chuyển khoảng cách L2 sang phần trăm tin cậy (cùng công thức cũ trong Recognize.py).
+    """
+    return np.clip((1.0 - np.asarray(distances, dtype=np.float32) / 2.0) * 100.0, 0.0, 100.0)
+
+
+class GalleryMatcher:
+    """
+    Giữ toàn bộ embeddings của một khóa trong một ma trận float32 liên tục
+    và so khớp cả batch query chỉ bằng một phép nhân ma trận.
+
+    metric:
+    - 'l2': khoảng cách Euclid, dùng ||q||^2 + ||g||^2 - 2 q.g với norm đã tính sẵn
+    - 'cosine': tích vô hướng trên vector đã chuẩn hóa L2. Khoảng cách trả về vẫn
+      theo đơn vị L2 (sqrt(2 - 2cos)) để FACE_MATCH_THRESHOLD không phải đổi.
+
+    index: IvfIndex (ann_index) tùy chọn cho gallery lớn; khi có, mỗi query chỉ được so với
+    các hàng trong nprobe cụm gần nhất (khoảng cách vẫn tính chính xác như trên).
+    """
+
+    METRICS = ('l2', 'cosine')
+
+    def __init__(self, embeddings, ids, names, metric='l2', index=None, nprobe=DEFAULT_NPROBE):
+        if metric not in self.METRICS:
+            raise ValueError(f"metric không hợp lệ: {metric}")
+        self.metric = metric
+        # Giữ nguyên các cột nhãn dạng Sequence (vd. LabelColumn của gallery_store) để không tạo list mới
+        self.ids = ids if isinstance(ids, Sequence) else list(ids)
+        self.names = names if isinstance(names, Sequence) else list(names)
+
+        if isinstance(embeddings, np.ndarray) and embeddings.ndim == 2:
+            matrix = embeddings
+        elif len(embeddings) == 0:
+            matrix = np.zeros((0, 512), dtype=np.float32)
+        else:
+            matrix = np.stack([np.ravel(emb) for emb in embeddings])
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+        if len(matrix) != len(self.ids) or len(self.ids) != len(self.names):
+            raise ValueError("Số embeddings, ids và names không khớp nhau")
+
+        if metric == 'cosine':
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = matrix / np.maximum(norms, 1e-12)
+        self.embeddings = matrix
+        self.sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+        if index is not None and index.count != len(matrix):
+            print("[WARNING] Chỉ mục ANN không khớp gallery, dùng so khớp vét cạn")
+            index = None
+        self.index = index
+        self.nprobe = nprobe
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    def distances(self, queries):
+        """
+        Trả về ma trận khoảng cách [số query, số mẫu] theo đơn vị L2.
+        """
+        q = np.ascontiguousarray(np.atleast_2d(queries), dtype=np.float32)
+        if q.shape[0] == 0:
+            return np.zeros((0, len(self)), dtype=np.float32)
+        q = q.reshape(q.shape[0], -1)
+        dots = q @ self.embeddings.T
+        if self.metric == 'cosine':
+            q_norms = np.linalg.norm(q, axis=1, keepdims=True)
+            sq = 2.0 - 2.0 * dots / np.maximum(q_norms, 1e-12)
+        else:
+            q_sq = np.einsum('ij,ij->i', q, q)[:, None]
+            sq = q_sq + self.sq_norms[None, :] - 2.0 * dots
+        np.maximum(sq, 0.0, out=sq)
+        return np.sqrt(sq, out=sq)
+
+    def _search_index(self, queries, k):
+        q = np.ascontiguousarray(np.atleast_2d(queries), dtype=np.float32)
+        k = max(1, min(k, len(self)))
+        if q.shape[0] == 0:
+            return np.zeros((0, k), dtype=np.int64), np.zeros((0, k), dtype=np.float32)
+        q = q.reshape(q.shape[0], -1)
+        indices = np.full((len(q), k), -1, dtype=np.int64)
+        dists = np.full((len(q), k), np.inf, dtype=np.float32)
+        for row, query in enumerate(q):
+            rows = self.index.candidates(query, self.nprobe)
+            if len(rows) == 0:
+                continue
+            dots = self.embeddings[rows] @ query
+            if self.metric == 'cosine':
+                sq = 2.0 - 2.0 * dots / max(float(np.linalg.norm(query)), 1e-12)
+            else:
+                sq = float(query @ query) + self.sq_norms[rows] - 2.0 * dots
+            d = np.sqrt(np.maximum(sq, 0.0))
+            kk = min(k, len(rows))
+            top = np.argpartition(d, kk - 1)[:kk] if kk < len(rows) else np.arange(len(rows))
+            top = top[np.argsort(d[top])]
+            indices[row, :kk] = rows[top]
+            dists[row, :kk] = d[top]
+        return indices, dists
+
+    def search(self, queries, k=1):
+        """
+        Tìm top-k mẫu gần nhất cho mỗi query (qua chỉ mục ANN nếu có).
+        Returns: (indices [Q, k], distances [Q, k]) đã sắp xếp tăng dần theo khoảng cách;
+        với chỉ mục ANN, ô không đủ ứng viên có index -1.
+        """
+        if self.index is not None and len(self):
+            return self._search_index(queries, k)
+        dist = self.distances(queries)
+        n = dist.shape[1]
+        if n == 0:
+            empty = np.zeros((dist.shape[0], 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        k = max(1, min(k, n))
+        if k == 1:
+            idx = np.argmin(dist, axis=1)[:, None]
+        else:
+            part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            order = np.argsort(np.take_along_axis(dist, part, axis=1), axis=1)
+            idx = np.take_along_axis(part, order, axis=1)
+        return idx, np.take_along_axis(dist, idx, axis=1)
+
+    def match(self, queries, k=1):
+        """
+        Trả về danh sách (mỗi query) các MatchResult top-k gồm id, tên, khoảng cách, % tin cậy.
+        Không có query (frame không có mặt nào căn chỉnh được) -> [].
+        """
+        if np.atleast_2d(queries).shape[0] == 0:
+            return []
+        indices, dists = self.search(queries, k)
+        confidences = distance_to_confidence(dists)
+        results = []
+        for row_idx, row_dist, row_conf in zip(indices, dists, confidences):
+            results.append([
+                MatchResult(int(i), self.ids[i], self.names[i], float(d), float(c))
+                for i, d, c in zip(row_idx, row_dist, row_conf) if i >= 0
+            ])
+        return results
+
+    def best_match(self, embedding):
+        """
+        So khớp một embedding duy nhất, trả về MatchResult tốt nhất hoặc None nếu gallery rỗng.
+        """
+        results = self.match(embedding, k=1)[0]
+        return results[0] if results else None
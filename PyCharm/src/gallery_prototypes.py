@@ -0,0 +1,360 @@
+# gallery_prototypes.py - Nén gallery: mỗi người còn vài prototype (tâm theo hướng mặt / k-medoids) + bán kính
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from gallery_matcher import GalleryMatcher, MatchResult, distance_to_confidence
+from gallery_store import read_header, load_gallery, load_manifest, GalleryStoreError
+
+PROTOTYPE_PATTERN = "prototypes.{generation}.npz"
+
+# facedetect.py lưu ảnh dạng <faceId>_<name>_<hướng>_<n>.jpg
+POSES = ("straight", "left", "right", "up", "down")
+_POSE_RE = re.compile(r'_(' + '|'.join(POSES) + r')_\d+\.[A-Za-z]+$')
+
+# Số prototype mỗi người khi ảnh không có hướng trong tên file
+DEFAULT_PROTOTYPES = 5
+KMEDOIDS_ITERS = 10
+
+# Giống Recognize.FACE_MATCH_THRESHOLD
+DEFAULT_MATCH_THRESHOLD = 0.3
+
+MATCH_MODES = ("full", "prototype", "refine")
+
+
+def pose_of(filename):
+    """
+    Hướng mặt lấy từ tên file (straight/left/right/up/down) hoặc None.
+    """
+    m = _POSE_RE.search(filename)
+    return m.group(1) if m else None
+
+
+def _pairwise(vectors):
+    sq = np.einsum('ij,ij->i', vectors, vectors)
+    d2 = sq[:, None] + sq[None, :] - 2.0 * (vectors @ vectors.T)
+    return np.sqrt(np.maximum(d2, 0.0))
+
+
+def _kmedoids(vectors, k):
+    """
+    K-medoids đơn giản cho vài chục vector của một người: khởi tạo xa nhất rồi luân phiên gán / chọn medoid.
+    Returns: chỉ số các medoid trong vectors.
+    """
+    dist = _pairwise(vectors)
+    k = min(k, len(vectors))
+    medoids = [int(np.argmin(dist.sum(axis=1)))]
+    while len(medoids) < k:
+        medoids.append(int(np.argmax(dist[:, medoids].min(axis=1))))
+    medoids = np.array(medoids)
+    for _ in range(KMEDOIDS_ITERS):
+        labels = np.argmin(dist[:, medoids], axis=1)
+        updated = medoids.copy()
+        for c in range(k):
+            members = np.flatnonzero(labels == c)
+            if len(members):
+                updated[c] = members[np.argmin(dist[np.ix_(members, members)].sum(axis=1))]
+        if np.array_equal(updated, medoids):
+            break
+        medoids = updated
+    return medoids
+
+
+def _normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+class PrototypeSet:
+    """
+    Gallery nén theo người:
+    - prototypes [P, D]: tâm (đã chuẩn hóa L2) của từng hướng mặt, hoặc medoid khi không biết hướng
+    - proto_identity [P]: người sở hữu prototype; proto_rows [P]: hàng gallery gần prototype nhất
+    - order/offsets: hàng gallery của từng người (để tinh chỉnh trong người thắng)
+    - radius [I]: khoảng cách lớn nhất từ một mẫu của người đó tới prototype gần nhất của họ
+    """
+
+    def __init__(self, prototypes, proto_identity, proto_rows, identity_ids, identity_names,
+                 order, offsets, radius, count):
+        self.prototypes = np.ascontiguousarray(prototypes, dtype=np.float32)
+        self.proto_identity = proto_identity
+        self.proto_rows = proto_rows
+        self.identity_ids = [str(x) for x in identity_ids]
+        self.identity_names = [str(x) for x in identity_names]
+        self.order = order
+        self.offsets = offsets
+        self.radius = radius
+        self.count = int(count)
+
+    def __len__(self):
+        return len(self.prototypes)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.prototypes, self.proto_identity, self.proto_rows,
+                                      self.order, self.offsets, self.radius))
+
+    def rows_of(self, identity):
+        return self.order[self.offsets[identity]:self.offsets[identity + 1]]
+
+    @classmethod
+    def build(cls, embeddings, ids, names, poses=None, per_identity=DEFAULT_PROTOTYPES):
+        """
+        poses: hướng mặt của từng hàng (None nếu không biết). Người có hướng cho mọi ảnh dùng tâm theo hướng,
+        còn lại dùng k-medoids với per_identity prototype.
+        """
+        matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+        groups = OrderedDict()
+        for row, face_id in enumerate(ids):
+            groups.setdefault(face_id, []).append(row)
+
+        prototypes, proto_identity, proto_rows = [], [], []
+        identity_ids, identity_names, order, offsets, radius = [], [], [], [0], []
+        for identity, (face_id, rows) in enumerate(groups.items()):
+            rows = np.array(rows, dtype=np.int32)
+            vectors = matrix[rows]
+            row_poses = [poses[r] for r in rows] if poses is not None else [None] * len(rows)
+            if all(p is not None for p in row_poses):
+                centers = []
+                for pose in sorted(set(row_poses)):
+                    members = np.array([i for i, p in enumerate(row_poses) if p == pose])
+                    centers.append(vectors[members].mean(axis=0))
+                centers = _normalize(np.stack(centers))
+            else:
+                centers = vectors[_kmedoids(vectors, per_identity)]
+            dist = np.sqrt(np.maximum(
+                np.einsum('ij,ij->i', vectors, vectors)[:, None] + np.einsum('ij,ij->i', centers, centers)[None, :]
+                - 2.0 * (vectors @ centers.T), 0.0))
+            prototypes.append(centers)
+            proto_identity.extend([identity] * len(centers))
+            proto_rows.extend(rows[np.argmin(dist, axis=0)])
+            radius.append(float(dist.min(axis=1).max()))
+            identity_ids.append(face_id)
+            identity_names.append(names[rows[0]])
+            order.extend(rows)
+            offsets.append(len(order))
+
+        dim = matrix.shape[1] if matrix.ndim == 2 else 512
+        return cls(np.concatenate(prototypes) if prototypes else np.zeros((0, dim), dtype=np.float32),
+                   np.array(proto_identity, dtype=np.int32), np.array(proto_rows, dtype=np.int32),
+                   identity_ids, identity_names, np.array(order, dtype=np.int32),
+                   np.array(offsets, dtype=np.int64), np.array(radius, dtype=np.float32), len(matrix))
+
+    def save(self, lock_dir, generation):
+        """
+        Ghi prototypes.<generation>.npz (tmp + os.replace) và xóa file của các thế hệ cũ.
+        """
+        path = os.path.join(lock_dir, PROTOTYPE_PATTERN.format(generation=generation))
+        tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+        try:
+            np.savez(tmp_path, prototypes=self.prototypes, proto_identity=self.proto_identity,
+                     proto_rows=self.proto_rows, identity_ids=np.array(self.identity_ids),
+                     identity_names=np.array(self.identity_names), order=self.order, offsets=self.offsets,
+                     radius=self.radius, count=np.int64(self.count), generation=np.int64(generation))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        for old in glob.glob(os.path.join(lock_dir, PROTOTYPE_PATTERN.format(generation='*'))):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+        return path
+
+
+def load_prototypes(lock_dir):
+    """
+    Returns: PrototypeSet của thế hệ gallery hiện tại, hoặc None nếu chưa có / không khớp.
+    """
+    try:
+        header = read_header(lock_dir)
+    except GalleryStoreError:
+        return None
+    if header is None:
+        return None
+    path = os.path.join(lock_dir, PROTOTYPE_PATTERN.format(generation=header['generation']))
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['generation']) != header['generation'] or int(data['count']) != header['count']:
+                return None
+            return PrototypeSet(data['prototypes'], data['proto_identity'], data['proto_rows'],
+                                data['identity_ids'], data['identity_names'], data['order'],
+                                data['offsets'], data['radius'], data['count'])
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[WARNING] File prototype hỏng, dùng gallery đầy đủ: {e}")
+        return None
+
+
+def gallery_poses(lock_dir, count):
+    """
+    Hướng mặt của từng hàng gallery, lấy từ manifest của trainer (None nếu không biết).
+    """
+    poses = [None] * count
+    manifest = load_manifest(lock_dir) or {}
+    for rel_path, entry in manifest.get('entries', {}).items():
+        row = entry.get('row')
+        if row is not None and row < count:
+            poses[row] = pose_of(os.path.basename(rel_path))
+    return poses
+
+
+def build_prototypes(lock_dir, per_identity=DEFAULT_PROTOTYPES):
+    """
+    Tạo và lưu prototype cho gallery hiện tại của khóa (trainer gọi với --prototypes).
+    Returns: PrototypeSet hoặc None nếu chưa có gallery.
+    """
+    gallery = load_gallery(lock_dir, verify=False, migrate=False)
+    if gallery is None or len(gallery.ids) == 0:
+        return None
+    start = time.perf_counter()
+    protos = PrototypeSet.build(gallery.embeddings, gallery.ids, gallery.names,
+                                poses=gallery_poses(lock_dir, len(gallery.ids)), per_identity=per_identity)
+    protos.save(lock_dir, gallery.header['generation'])
+    print(f"[PROTOTYPES] {protos.count} samples -> {len(protos)} prototypes "
+          f"for {len(protos.identity_ids)} identities in {time.perf_counter() - start:.2f}s")
+    return protos
+
+
+class PrototypeMatcher:
+    """
+    So khớp hai bước, cùng giao diện match() với GalleryMatcher:
+    1) so với prototype để tìm người thắng;
+    2) refine=True: so chính xác với các mẫu của người đó (mmap chỉ đọc các hàng này).
+    Nếu khoảng cách tới prototype trừ bán kính của người thắng >= reject_distance thì không mẫu nào
+    của họ có thể đạt ngưỡng (bất đẳng thức tam giác) nên bỏ qua bước 2.
+    """
+
+    def __init__(self, prototypes, embeddings=None, metric='l2', refine=True,
+                 reject_distance=DEFAULT_MATCH_THRESHOLD):
+        self.prototypes = prototypes
+        self.refine = refine and embeddings is not None
+        self.reject_distance = reject_distance
+        self.embeddings = embeddings
+        self.metric = metric
+        self.index = None
+        owners = prototypes.proto_identity
+        self.proto_matcher = GalleryMatcher(
+            prototypes.prototypes, [prototypes.identity_ids[i] for i in owners],
+            [prototypes.identity_names[i] for i in owners], metric=metric)
+
+    def __len__(self):
+        return len(self.prototypes)
+
+    def match(self, queries, k=1):
+        """
+        Returns: danh sách (mỗi query) gồm MatchResult tốt nhất (k chỉ để tương thích, luôn trả top-1).
+        """
+        q = np.ascontiguousarray(np.atleast_2d(queries), dtype=np.float32)
+        if q.shape[0] == 0:
+            return []
+        q = q.reshape(q.shape[0], -1)
+        results = []
+        for query, top in zip(q, self.proto_matcher.match(q, k=1)):
+            if not top:
+                results.append([])
+                continue
+            best = top[0]
+            identity = int(self.prototypes.proto_identity[best.index])
+            row = int(self.prototypes.proto_rows[best.index])
+            distance = best.distance
+            if self.refine and distance - self.prototypes.radius[identity] < self.reject_distance:
+                rows = self.prototypes.rows_of(identity)
+                sample = np.asarray(self.embeddings[rows], dtype=np.float32)
+                if self.metric == 'cosine':
+                    sample = sample / np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-12)
+                    dist = np.sqrt(np.maximum(2.0 - 2.0 * (sample @ query) / max(float(np.linalg.norm(query)), 1e-12), 0.0))
+                else:
+                    dist = np.linalg.norm(sample - query[None, :], axis=1)
+                j = int(np.argmin(dist))
+                row, distance = int(rows[j]), float(dist[j])
+            results.append([MatchResult(row, best.face_id, best.name, distance,
+                                        float(distance_to_confidence(distance)))])
+        return results
+
+
+def accuracy_report(embeddings, ids, names, poses=None, per_identity=DEFAULT_PROTOTYPES,
+                    threshold=DEFAULT_MATCH_THRESHOLD, holdout=0.2, seed=0):
+    """
+    Giữ lại holdout mẫu của mỗi người làm query, dựng gallery + prototype từ phần còn lại và so
+    quyết định (tên nếu khoảng cách < threshold, ngược lại Unknown) với gallery đầy đủ.
+    Returns: dict báo cáo bộ nhớ, thời gian và mức đồng thuận của từng chế độ.
+    """
+    matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    by_id = OrderedDict()
+    for row, face_id in enumerate(ids):
+        by_id.setdefault(face_id, []).append(row)
+    query_rows, keep_rows = [], []
+    for rows in by_id.values():
+        rows = rng.permutation(rows)
+        n_query = int(len(rows) * holdout) if len(rows) > 1 else 0
+        query_rows.extend(rows[:n_query])
+        keep_rows.extend(rows[n_query:])
+    keep_rows = np.sort(np.array(keep_rows, dtype=np.int64))
+    query_rows = np.array(query_rows, dtype=np.int64)
+    if len(query_rows) == 0:
+        return {'error': 'Không đủ mẫu để tách query'}
+
+    kept = matrix[keep_rows]
+    kept_ids = [ids[r] for r in keep_rows]
+    kept_names = [names[r] for r in keep_rows]
+    kept_poses = [poses[r] for r in keep_rows] if poses is not None else None
+    queries = matrix[query_rows]
+
+    def decide(matcher):
+        start = time.perf_counter()
+        matches = matcher.match(queries)
+        ms = (time.perf_counter() - start) * 1000 / len(queries)
+        return [m[0].face_id if m and m[0].distance < threshold else None for m in matches], ms
+
+    full = GalleryMatcher(kept, kept_ids, kept_names)
+    reference, full_ms = decide(full)
+    truth = [ids[r] for r in query_rows]
+    protos = PrototypeSet.build(kept, kept_ids, kept_names, poses=kept_poses, per_identity=per_identity)
+    report = {
+        'samples': len(kept), 'queries': len(queries), 'identities': len(protos.identity_ids),
+        'prototypes': len(protos), 'threshold': threshold,
+        'full': {'bytes': int(kept.nbytes), 'ms_per_query': round(full_ms, 4),
+                 'accept_correct': round(sum(d == t for d, t in zip(reference, truth)) / len(truth), 4)},
+    }
+    for mode in MATCH_MODES[1:]:
+        decisions, ms = decide(PrototypeMatcher(protos, kept, refine=(mode == "refine"), reject_distance=threshold))
+        report[mode] = {
+            'bytes': int(protos.nbytes + (kept.nbytes if mode == "refine" else 0)),
+            'ms_per_query': round(ms, 4),
+            'decision_agreement_vs_full': round(sum(a == b for a, b in zip(decisions, reference)) / len(truth), 4),
+            'accept_correct': round(sum(d == t for d, t in zip(decisions, truth)) / len(truth), 4),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nén gallery thành prototype theo người và đo độ chính xác")
+    parser.add_argument("lock_id")
+    parser.add_argument("--build", action="store_true", help="Tạo/lưu prototype cho gallery hiện tại")
+    parser.add_argument("--per_identity", type=int, default=DEFAULT_PROTOTYPES)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_MATCH_THRESHOLD)
+    args = parser.parse_args()
+
+    lock_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'dataset', args.lock_id))
+    gallery = load_gallery(lock_dir, migrate=False)
+    if gallery is None:
+        print(f"[ERROR] Chưa có gallery cho {args.lock_id}")
+        sys.exit(1)
+    if args.build:
+        build_prototypes(lock_dir, args.per_identity)
+    ids = list(gallery.ids)
+    names = list(gallery.names)
+    poses = gallery_poses(lock_dir, len(ids))
+    print(json.dumps(accuracy_report(gallery.embeddings, ids, names, poses, args.per_identity, args.threshold),
+                     indent=2, ensure_ascii=False))
@@ -0,0 +1,290 @@
+# gallery_store.py - Lưu embeddings của một khóa: header JSON có phiên bản + ma trận .npy (mmap) + nhãn gọn
+import glob
+import hashlib
+import json
+import os
+import pickle
+import time
+from collections import namedtuple
+from collections.abc import Sequence
+
+import numpy as np
+
+FORMAT_NAME = "smartlock-gallery"
+FORMAT_VERSION = 1
+
+HEADER_FILE = "gallery.json"
+LEGACY_PICKLE = "embeddings.pkl"
+
+# Manifest của trainer: ảnh nguồn -> hàng trong gallery (xem trainer.py)
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Mọi file đánh số theo thế hệ gallery: ma trận/nhãn (save_gallery), chỉ mục IVF (ann_index.INDEX_PATTERN),
+# prototype (gallery_prototypes.PROTOTYPE_PATTERN)
+GENERATION_FILE_PATTERNS = ("embeddings.*.npy", "labels.*.npy", "ivf.*.npz", "prototypes.*.npz")
+
+Gallery = namedtuple('Gallery', ['embeddings', 'ids', 'names', 'header'])
+
+
+class GalleryStoreError(Exception):
+    """
+    File gallery thiếu, sai phiên bản hoặc sai checksum.
+    """
+
+
+class LabelColumn(Sequence):
+    """
+    Cột nhãn (id hoặc tên) không tạo object Python cho từng mẫu:
+    bảng giá trị duy nhất + mảng mã int32 [N].
+    """
+
+    def __init__(self, table, codes):
+        self.table = list(table)
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.table[c] for c in self.codes[i]]
+        return self.table[self.codes[i]]
+
+
+def sha256_file(path):
+    """
+    SHA-256 (hex) của file, đọc theo khối 1 MB để không nạp cả file vào RAM.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _encode_labels(values):
+    table = []
+    index = {}
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(table)
+            table.append(value)
+        codes[i] = code
+    return table, codes
+
+
+def _atomic_write(path, write_fn):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_json_atomic(path, data):
+    payload = json.dumps(data, ensure_ascii=False, indent=1).encode('utf-8')
+    _atomic_write(path, lambda f: f.write(payload))
+
+
+def read_header(lock_dir):
+    path = os.path.join(lock_dir, HEADER_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            header = json.load(f)
+    except (OSError, ValueError) as e:
+        raise GalleryStoreError(f"Không đọc được {path}: {e}")
+    if header.get('format') != FORMAT_NAME:
+        raise GalleryStoreError(f"{path} không phải file gallery")
+    if header.get('version', 0) > FORMAT_VERSION:
+        raise GalleryStoreError(f"Phiên bản gallery {header.get('version')} mới hơn bản hỗ trợ ({FORMAT_VERSION})")
+    return header
+
+
+def save_gallery(lock_dir, embeddings, ids, names, extra=None, model_version=None):
+    """
+    Ghi gallery theo kiểu nguyên tử:
+    1) ghi ma trận và nhãn ra file mới có số thế hệ (generation) trong tên,
+    2) thay header bằng os.replace (điểm chuyển đổi duy nhất),
+    3) xóa file của thế hệ cũ.
+    Người đọc luôn thấy hoặc toàn bộ gallery cũ hoặc toàn bộ gallery mới.
+    model_version: phiên bản embedder đã tạo embeddings (embedding_backend.MODEL_VERSIONS),
+    để người đọc không so khớp embedding của backend khác với gallery này.
+    Returns: header đã ghi.
+    """
+    os.makedirs(lock_dir, exist_ok=True)
+    if isinstance(embeddings, np.ndarray) and embeddings.ndim == 2:
+        matrix = embeddings
+    elif len(embeddings) == 0:
+        matrix = np.zeros((0, 512), dtype=np.float32)
+    else:
+        matrix = np.stack([np.ravel(emb) for emb in embeddings])
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    if len(matrix) != len(ids) or len(ids) != len(names):
+        raise ValueError("Số embeddings, ids và names không khớp nhau")
+
+    try:
+        previous = read_header(lock_dir)
+    except GalleryStoreError:
+        previous = None
+    generation = (previous or {}).get('generation', 0) + 1
+
+    id_table, id_codes = _encode_labels(list(ids))
+    name_table, name_codes = _encode_labels(list(names))
+    labels = np.stack([id_codes, name_codes], axis=1) if len(id_codes) else np.zeros((0, 2), dtype=np.int32)
+
+    matrix_file = f"embeddings.{generation}.npy"
+    labels_file = f"labels.{generation}.npy"
+    matrix_path = os.path.join(lock_dir, matrix_file)
+    labels_path = os.path.join(lock_dir, labels_file)
+    _atomic_write(matrix_path, lambda f: np.save(f, matrix, allow_pickle=False))
+    _atomic_write(labels_path, lambda f: np.save(f, labels, allow_pickle=False))
+
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'generation': generation,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'count': int(matrix.shape[0]),
+        'dim': int(matrix.shape[1]),
+        'dtype': 'float32',
+        'matrix': matrix_file,
+        'labels': labels_file,
+        'id_table': id_table,
+        'name_table': name_table,
+        'sha256': {matrix_file: sha256_file(matrix_path), labels_file: sha256_file(labels_path)},
+        # size + mtime lúc ghi: load_gallery mặc định chỉ so stat, không đọc lại toàn bộ file để hash
+        'stat': {name: _stat_key(os.path.join(lock_dir, name)) for name in (matrix_file, labels_file)},
+    }
+    if model_version:
+        header['model_version'] = model_version
+    if extra:
+        header['extra'] = extra
+    write_json_atomic(os.path.join(lock_dir, HEADER_FILE), header)
+
+    if previous:
+        for old in (previous.get('matrix'), previous.get('labels')):
+            if old and old not in (matrix_file, labels_file):
+                try:
+                    os.remove(os.path.join(lock_dir, old))
+                except OSError:
+                    pass
+    return header
+
+
+def load_gallery(lock_dir, verify=False, migrate=True):
+    """
+    Mở gallery của một khóa. Ma trận được mở bằng np.load(mmap_mode='r'), nhãn giữ dạng mã int32.
+    Nếu chưa có gallery mà có embeddings.pkl (3 phần tử) thì chuyển đổi một lần.
+    Checksum được tính lúc ghi; khi mở chỉ so size + mtime với header (như model_loader.verify_file),
+    file đã đổi từ lúc ghi (hoặc header cũ chưa có stat) mới bị hash lại. verify=True: luôn hash toàn bộ.
+    Returns: Gallery hoặc None nếu khóa chưa có dữ liệu. Raises: GalleryStoreError nếu file hỏng.
+    """
+    header = read_header(lock_dir)
+    if header is None:
+        if migrate and os.path.exists(os.path.join(lock_dir, LEGACY_PICKLE)):
+            migrate_pickle(lock_dir)
+            header = read_header(lock_dir)
+        if header is None:
+            return None
+
+    matrix_path = os.path.join(lock_dir, header['matrix'])
+    labels_path = os.path.join(lock_dir, header['labels'])
+    for path in (matrix_path, labels_path):
+        if not os.path.exists(path):
+            raise GalleryStoreError(f"Thiếu file gallery: {path}")
+        name = os.path.basename(path)
+        recorded = header.get('stat', {}).get(name)
+        if not verify and recorded is not None and _stat_key(path) == recorded:
+            continue
+        if sha256_file(path) != header['sha256'].get(name):
+            raise GalleryStoreError(f"Sai checksum: {path}")
+
+    embeddings = np.load(matrix_path, mmap_mode='r', allow_pickle=False)
+    labels = np.load(labels_path, allow_pickle=False)
+    if embeddings.shape != (header['count'], header['dim']) or labels.shape[0] != header['count']:
+        raise GalleryStoreError(f"Kích thước gallery không khớp header: {embeddings.shape}")
+    ids = LabelColumn(header['id_table'], labels[:, 0])
+    names = LabelColumn(header['name_table'], labels[:, 1])
+    return Gallery(embeddings, ids, names, header)
+
+
+def migrate_pickle(lock_dir):
+    """
+    Chuyển embeddings.pkl (embeddings, ids, names) sang định dạng mới và đổi tên file cũ
+    thành embeddings.pkl.migrated để không chuyển lại.
+    Returns: True nếu đã chuyển đổi.
+    """
+    pickle_path = os.path.join(lock_dir, LEGACY_PICKLE)
+    try:
+        with open(pickle_path, 'rb') as f:
+            data = pickle.load(f)
+    except Exception as e:
+        print(f"[WARNING] Không đọc được {pickle_path}: {e}")
+        return False
+    if len(data) != 3:
+        # Định dạng cũ hơn (4 phần tử) không chuyển được, cần chạy lại trainer
+        print(f"[WARNING] {pickle_path} có định dạng cũ ({len(data)} phần tử), bỏ qua chuyển đổi")
+        return False
+
+    known_embeddings, known_ids, known_names = data
+    save_gallery(lock_dir, known_embeddings, known_ids, known_names, extra={'migrated_from': LEGACY_PICKLE})
+    os.replace(pickle_path, pickle_path + ".migrated")
+    print(f"[INFO] Đã chuyển {len(known_ids)} embeddings từ {LEGACY_PICKLE} sang gallery store")
+    return True
+
+
+def load_manifest(lock_dir):
+    """
+    Đọc manifest của trainer. Returns: dict hoặc None nếu không có / hỏng / sai phiên bản.
+    """
+    path = os.path.join(lock_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARNING] Manifest hỏng, bỏ qua: {e}")
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(lock_dir, manifest):
+    manifest = dict(manifest, version=MANIFEST_VERSION)
+    write_json_atomic(os.path.join(lock_dir, MANIFEST_FILE), manifest)
+
+
+def remove_gallery(lock_dir):
+    """
+    Xóa header, manifest và mọi file theo thế hệ (ma trận, nhãn, chỉ mục IVF, prototype)
+    của gallery (dùng trước khi tạo lại từ đầu).
+    """
+    try:
+        header = read_header(lock_dir)
+    except GalleryStoreError:
+        header = None
+    paths = [os.path.join(lock_dir, HEADER_FILE), os.path.join(lock_dir, MANIFEST_FILE)]
+    if header:
+        paths += [os.path.join(lock_dir, name) for name in (header.get('matrix'), header.get('labels')) if name]
+    for pattern in GENERATION_FILE_PATTERNS:
+        paths += glob.glob(os.path.join(lock_dir, pattern))
+    for path in dict.fromkeys(paths):
+        if os.path.exists(path):
+            os.remove(path)
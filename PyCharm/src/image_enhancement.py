@@ -1,7 +1,48 @@
 # image_enhancement.py (phiên bản cải thiện để xử lý lóa tốt hơn)
+import threading
+
 import cv2
 import numpy as np
 
+from face_tracker import box_iou
+
+# Các mức xử lý, từ đắt nhất đến rẻ nhất (dùng bởi bộ lập lịch khung hình)
+ENHANCE_TIERS = ("full", "fast", "off")
+
+# Bước lượng tử hóa gamma cho bộ LUT dùng lại (0.05 -> tối đa vài chục bảng 256 phần tử)
+GAMMA_STEP = 0.05
+_gamma_luts = {}
+_clahe_local = threading.local()
+
+def gamma_lut(gamma):
+    """
+    Trả bảng LUT 256 phần tử cho gamma (đã lượng tử theo GAMMA_STEP), tính một lần rồi dùng lại.
+    """
+    key = int(round(gamma / GAMMA_STEP))
+    table = _gamma_luts.get(key)
+    if table is None:
+        inv_gamma = 1.0 / max(key * GAMMA_STEP, GAMMA_STEP)
+        table = (np.power(np.arange(256) / 255.0, inv_gamma) * 255).astype("uint8")
+        _gamma_luts[key] = table
+    return table
+
+def get_clahe(clip_limit, tile_grid_size=(8, 8)):
+    """
+    Dùng lại đối tượng CLAHE thay vì tạo mới mỗi frame (mỗi thread một bộ riêng).
+    """
+    cache = getattr(_clahe_local, 'cache', None)
+    if cache is None:
+        cache = _clahe_local.cache = {}
+    key = (clip_limit, tile_grid_size)
+    clahe = cache.get(key)
+    if clahe is None:
+        clahe = cache[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+    return clahe
+
+def gamma_for_brightness(mean_brightness):
+    # Map độ sáng [0,255] sang gamma [2.2, 1.2, 0.8]
+    return float(np.interp(mean_brightness, [0, 128, 255], [2.2, 1.2, 0.8]))
+
 def detect_low_light(image, threshold=60):
     """
     Phát hiện ảnh có ánh sáng yếu dựa trên độ sáng trung bình.
@@ -29,30 +70,28 @@ def detect_glare(image, bright_threshold=230, percent_threshold=2):  # MỚI: Ph
     glare_percent = np.sum(gray > bright_threshold) / gray.size * 100
     return glare_percent > percent_threshold, glare_percent
 
-def reduce_glare(image):
+def reduce_glare(image, smooth=True):
     """
     Giảm lóa và cân bằng lại ảnh bị sáng gắt (cải thiện: thêm gamma + bilateral filter).
+    smooth=False bỏ bilateral filter (mức "fast").
     """
     # Chuyển sang HSV để xử lý Value (độ sáng)
     hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
     h, s, v = cv2.split(hsv)
 
     # CLAHE trên V với clipLimit=2.0 để giảm chênh lệch sáng/tối
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    v = clahe.apply(v)
+    v = get_clahe(2.0).apply(v)
 
     # Gộp lại và chuyển về BGR
     hsv = cv2.merge([h, s, v])
     enhanced = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
 
     # Áp dụng gamma >1 để làm tối highlight tự nhiên
-    gamma = 1.2
-    inv_gamma = 1.0 / gamma
-    table = np.array([(i / 255.0) ** inv_gamma * 255 for i in np.arange(256)]).astype("uint8")
-    enhanced = cv2.LUT(enhanced, table)
+    enhanced = cv2.LUT(enhanced, gamma_lut(1.2))
 
     # Thêm bilateral filter để giảm nhiễu lóa mà giữ cạnh khuôn mặt
-    enhanced = cv2.bilateralFilter(enhanced, d=9, sigmaColor=75, sigmaSpace=75)
+    if smooth:
+        enhanced = cv2.bilateralFilter(enhanced, d=9, sigmaColor=75, sigmaSpace=75)
 
     return enhanced
 
@@ -62,48 +101,131 @@ def auto_gamma(image):
     """
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     mean_brightness = np.mean(gray)
-    
-    # Map độ sáng [0,255] sang gamma [2.2, 1.2, 0.8]
-    gamma = np.interp(mean_brightness, [0, 128, 255], [2.2, 1.2, 0.8])
-    inv_gamma = 1.0 / gamma
-
-    table = np.array([(i / 255.0) ** inv_gamma * 255 for i in np.arange(256)]).astype("uint8")
-    return cv2.LUT(image, table)
+    return cv2.LUT(image, gamma_lut(gamma_for_brightness(mean_brightness)))
 
-def enhance_image_for_low_light(image):
+def enhance_image_for_low_light(image, denoise=True, gamma_fn=None, denoiser=None):
     """
     Cải thiện ảnh trong điều kiện ánh sáng yếu (sử dụng phiên bản mạnh).
+    denoise=False bỏ fastNlMeansDenoisingColored (bước tốn nhất, mức "fast").
+    gamma_fn thay cho auto_gamma ở bước cuối nếu được truyền vào.
+    denoiser (vd. TemporalDenoiser) thay cho NLM khi denoise=True; chạy trên frame gốc,
+    trước khi CLAHE khuếch đại nhiễu.
     """
+    if denoise and denoiser is not None:
+        image = denoiser.denoise(image)
+
     lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
     l, a, b = cv2.split(lab)
 
     # CLAHE mạnh hơn cho low light
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-    l = clahe.apply(l)
+    l = get_clahe(3.0).apply(l)
 
     lab = cv2.merge([l, a, b])
     enhanced = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
 
     # Giảm nhiễu
-    enhanced = cv2.fastNlMeansDenoisingColored(enhanced, None, 10, 10, 7, 21)
+    if denoise and denoiser is None:
+        enhanced = cv2.fastNlMeansDenoisingColored(enhanced, None, 10, 10, 7, 21)
 
     # Làm sắc nét
     gaussian = cv2.GaussianBlur(enhanced, (0, 0), 3)
     enhanced = cv2.addWeighted(enhanced, 1.5, gaussian, -0.5, 0)
 
     # Auto gamma
-    enhanced = auto_gamma(enhanced)
+    enhanced = (gamma_fn or auto_gamma)(enhanced)
 
     return enhanced
 
+DENOISE_MODES = ("temporal", "nlm")
+
+class TemporalDenoiser:
+    """
+    Khử nhiễu theo thời gian thay cho fastNlMeansDenoisingColored trên từng frame:
+    trung bình trọng số chạy acc = (1 - alpha) * acc + alpha * frame.
+    - Pixel lệch khỏi trung bình hơn motion_threshold (ảnh xám của độ lệch, làm mượt blur_size để
+      nhiễu không bị coi là chuyển động) được đặt lại bằng frame hiện tại để tránh bóng mờ.
+    - Khi tỉ lệ pixel chuyển động vượt reset_fraction (hoặc đổi kích thước frame) thì đặt lại toàn bộ.
+    Mọi bộ đệm được cấp phát một lần theo kích thước frame. Kết quả trả về là bộ đệm dùng lại,
+    hãy copy nếu cần giữ qua frame sau.
+    """
+
+    def __init__(self, alpha=0.3, motion_threshold=12, reset_fraction=0.25, blur_size=5):
+        self.alpha = alpha
+        self.blur_size = (blur_size, blur_size)
+        self.motion_threshold = motion_threshold
+        self.reset_fraction = reset_fraction
+        self._shape = None
+        self.frames = 0
+        self.resets = 0
+        self.last_motion_fraction = 0.0
+
+    def _allocate(self, image):
+        h, w = image.shape[:2]
+        self._shape = image.shape
+        self._acc = np.empty(image.shape, dtype=np.float32)
+        self._out = np.empty(image.shape, dtype=np.uint8)
+        self._diff = np.empty(image.shape, dtype=np.uint8)
+        self._diff_gray = np.empty((h, w), dtype=np.uint8)
+        self._diff_blur = np.empty((h, w), dtype=np.uint8)
+        self._moving = np.empty((h, w), dtype=np.uint8)
+        self._still = np.empty((h, w), dtype=np.uint8)
+
+    def reset(self):
+        self._shape = None
+
+    def _restart(self, image):
+        self._acc[...] = image
+        self._out[...] = image
+        self.resets += 1
+        return self._out
+
+    def denoise(self, image):
+        self.frames += 1
+        if self._shape != image.shape:
+            self._allocate(image)
+            return self._restart(image)
+
+        cv2.absdiff(image, self._out, dst=self._diff)
+        cv2.cvtColor(self._diff, cv2.COLOR_BGR2GRAY, dst=self._diff_gray)
+        cv2.blur(self._diff_gray, self.blur_size, dst=self._diff_blur)
+        cv2.threshold(self._diff_blur, self.motion_threshold, 255, cv2.THRESH_BINARY, dst=self._moving)
+        moving = cv2.countNonZero(self._moving) / float(self._moving.size)
+        self.last_motion_fraction = moving
+        if moving > self.reset_fraction:
+            return self._restart(image)
+
+        # Vùng chuyển động: lấy frame hiện tại; vùng tĩnh: cộng dồn có trọng số
+        cv2.bitwise_not(self._moving, dst=self._still)
+        cv2.accumulateWeighted(image, self._acc, 1.0, mask=self._moving)
+        cv2.accumulateWeighted(image, self._acc, self.alpha, mask=self._still)
+        cv2.convertScaleAbs(self._acc, dst=self._out)
+        return self._out
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'resets': self.resets,
+            'last_motion_fraction': round(self.last_motion_fraction, 4),
+        }
+
 def auto_brightness_contrast(image, clip_hist_percent=1.5):  # TĂNG LÊN 1.5 ĐỂ CLIP MẠNH HƠN, GIẢM LÓA NHẸ
     """
     Tự động điều chỉnh độ sáng & tương phản cho ảnh bình thường.
     """
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     hist = cv2.calcHist([gray], [0], None, [256], [0, 256])
-    hist_size = len(hist)
+    params = contrast_stretch_params(hist, clip_hist_percent)
+    if params is None:
+        return image
+
+    alpha, beta = params
+    auto_result = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
+    return auto_result
 
+def contrast_stretch_params(hist, clip_hist_percent=1.5):
+    """
+    Tính (alpha, beta) kéo giãn tương phản từ histogram 256 bin; None nếu ảnh phẳng.
+    """
     accumulator = np.cumsum(hist)
 
     maximum = accumulator[-1]
@@ -114,38 +236,248 @@ def auto_brightness_contrast(image, clip_hist_percent=1.5):  # TĂNG LÊN 1.5 Đ
     maximum_gray = np.searchsorted(accumulator, maximum - clip_hist_percent)
 
     if maximum_gray - minimum_gray == 0:
-        return image
+        return None
 
     alpha = 255 / (maximum_gray - minimum_gray)
     beta = -minimum_gray * alpha
+    return alpha, beta
 
-    auto_result = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
-    return auto_result
-
-def preprocess_image(image):
+def preprocess_image(image, tier="full"):
     """
     Pipeline tiền xử lý hoàn chỉnh:
     - Tự phát hiện low light, high light, glare, hoặc bình thường
     - Áp dụng xử lý tương ứng
+    tier: "full" (mặc định), "fast" (bỏ khử nhiễu NLM và bilateral), "off" (giữ nguyên ảnh)
     """
+    if tier == "off":
+        return image
+    fast = tier == "fast"
+
     low_light, brightness = detect_low_light(image)
     high_light, brightness_high = detect_high_light(image)
     glare, glare_percent = detect_glare(image)
 
     if low_light:
         print(f"[INFO] Ảnh ánh sáng yếu (brightness={brightness:.2f}) → Tăng sáng...")
-        processed = enhance_image_for_low_light(image)
+        processed = enhance_image_for_low_light(image, denoise=not fast)
     elif high_light or glare:
         print(f"[INFO] Ảnh lóa/gắt (brightness={brightness_high:.2f}, glare={glare_percent:.1f}%) → Giảm lóa...")
-        processed = reduce_glare(image)
+        processed = reduce_glare(image, smooth=not fast)
     else:
         print(f"[INFO] Ảnh bình thường (brightness={brightness:.2f}) → Cân bằng...")
         processed = auto_brightness_contrast(image)
 
     return processed
 
+def prepare_frame_for_detection(image, threshold=60):
+    """
+    Kiểm tra toàn cục rẻ cho chế độ ROI: chỉ một lần chuyển xám + median,
+    nếu thiếu sáng thì áp auto_gamma (một LUT) để bộ phát hiện vẫn thấy khuôn mặt.
+    Các bước đắt (CLAHE, khử nhiễu, làm nét) để dành cho vùng khuôn mặt.
+    Returns: (ảnh cho bộ phát hiện, is_low_light, brightness)
+    """
+    is_low_light, brightness = detect_low_light(image, threshold)
+    if is_low_light:
+        return auto_gamma(image), True, brightness
+    return image, False, brightness
+
+def enhance_face_roi(face_bgr, tier="full"):
+    """
+    Áp dụng pipeline tăng cường đầy đủ chỉ trên crop khuôn mặt (BGR).
+    """
+    if face_bgr is None or face_bgr.size == 0:
+        return face_bgr
+    return preprocess_image(face_bgr, tier=tier)
+
+class RoiEnhancer:
+    """
+    Tăng cường ảnh theo từng vùng khuôn mặt, cache kết quả theo track ID.
+    Nếu box của track gần như không đổi (IoU với box lúc cache >= box_iou_threshold, vì box SSD
+    rung vài pixel mỗi frame) và nội dung crop gần như không đổi (so bằng thumbnail 8x8),
+    dùng lại crop đã tăng cường thay vì xử lý lại.
+    """
+
+    def __init__(self, tier="full", signature_tolerance=3.0, max_entries=32, box_iou_threshold=0.85):
+        self.tier = tier
+        self.signature_tolerance = signature_tolerance
+        self.box_iou_threshold = box_iou_threshold
+        self.max_entries = max_entries
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _signature(face_bgr):
+        gray = cv2.cvtColor(face_bgr, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, (8, 8), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def _same_box(self, cached_box, box):
+        if cached_box is None or box is None:
+            return cached_box is box
+        return float(box_iou(cached_box, box)[0, 0]) >= self.box_iou_threshold
+
+    def enhance(self, face_bgr, track_id=None, box=None, tier=None):
+        tier = tier or self.tier
+        if track_id is None or face_bgr is None or face_bgr.size == 0:
+            self.misses += 1
+            return enhance_face_roi(face_bgr, tier)
+
+        signature = self._signature(face_bgr)
+        cached = self._cache.get(track_id)
+        if cached is not None:
+            cached_box, cached_tier, cached_sig, cached_result = cached
+            if (cached_tier == tier and self._same_box(cached_box, box)
+                    and float(np.mean(np.abs(cached_sig - signature))) <= self.signature_tolerance):
+                self.hits += 1
+                return cached_result
+
+        self.misses += 1
+        result = enhance_face_roi(face_bgr, tier)
+        if len(self._cache) >= self.max_entries and track_id not in self._cache:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[track_id] = (box, tier, signature, result)
+        return result
+
+    def prune(self, active_track_ids):
+        """
+        Xóa cache của các track đã biến mất.
+        """
+        active = set(active_track_ids)
+        for track_id in [t for t in self._cache if t not in active]:
+            del self._cache[track_id]
+
+    def stats(self):
+        return {'entries': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+STRATEGY_NORMAL = "normal"
+STRATEGY_LOW_LIGHT = "low_light"
+STRATEGY_GLARE = "glare"
+
+class FrameEnhancer:
+    """
+    Bộ tăng cường có trạng thái cho luồng video:
+    - Mỗi frame chỉ tính một histogram độ sáng trên ảnh thu nhỏ, từ đó suy ra cả ba quyết định
+      (thiếu sáng, quá sáng, lóa) thay cho ba lần cvtColor + median trên frame đầy đủ.
+    - Dùng lại LUT gamma đã lượng tử và đối tượng CLAHE.
+    - Giữ chiến lược đã chọn qua các frame (ngưỡng trễ + số frame xác nhận) thay vì quyết định lại mỗi frame.
+    """
+
+    def __init__(self, low_threshold=60, low_exit_threshold=70, high_threshold=170, high_exit_threshold=160,
+                 glare_bright=230, glare_percent=2.0, glare_exit_percent=1.0, hold_frames=5,
+                 stats_size=(160, 120), clip_hist_percent=1.5, denoise="nlm", verbose=False):
+        self.low_threshold = low_threshold
+        self.low_exit_threshold = low_exit_threshold
+        self.high_threshold = high_threshold
+        self.high_exit_threshold = high_exit_threshold
+        self.glare_bright = glare_bright
+        self.glare_percent = glare_percent
+        self.glare_exit_percent = glare_exit_percent
+        self.hold_frames = hold_frames
+        self.stats_size = stats_size
+        self.clip_hist_percent = clip_hist_percent
+        self.verbose = verbose
+        if denoise not in DENOISE_MODES:
+            raise ValueError(f"denoise phải là một trong {DENOISE_MODES}")
+        self.denoise = denoise
+        self.denoiser = TemporalDenoiser() if denoise == "temporal" else None
+
+        self.strategy = STRATEGY_NORMAL
+        self._candidate = None
+        self._candidate_frames = 0
+        self.last_stats = {'median': 0.0, 'mean': 0.0, 'glare_percent': 0.0}
+        self.strategy_frames = {STRATEGY_NORMAL: 0, STRATEGY_LOW_LIGHT: 0, STRATEGY_GLARE: 0}
+        self.switches = 0
+
+    def analyze(self, image):
+        """
+        Thống kê độ sáng từ một histogram trên ảnh xám thu nhỏ.
+        Returns: (hist, dict median/mean/glare_percent)
+        """
+        small = cv2.resize(image, self.stats_size, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+        total = hist.sum()
+        cumulative = np.cumsum(hist)
+        stats = {
+            'median': float(np.searchsorted(cumulative, total / 2.0)),
+            'mean': float(np.dot(hist, np.arange(256)) / total),
+            'glare_percent': float(hist[self.glare_bright + 1:].sum() / total * 100),
+        }
+        self.last_stats = stats
+        return hist, stats
+
+    def _classify(self, stats):
+        # Ngưỡng vào/ra khác nhau tùy chiến lược hiện tại (hysteresis)
+        current = self.strategy
+        low_limit = self.low_exit_threshold if current == STRATEGY_LOW_LIGHT else self.low_threshold
+        if stats['median'] < low_limit:
+            return STRATEGY_LOW_LIGHT
+        high_limit = self.high_exit_threshold if current == STRATEGY_GLARE else self.high_threshold
+        glare_limit = self.glare_exit_percent if current == STRATEGY_GLARE else self.glare_percent
+        if stats['median'] > high_limit or stats['glare_percent'] > glare_limit:
+            return STRATEGY_GLARE
+        return STRATEGY_NORMAL
+
+    def _update_strategy(self, proposed):
+        if proposed == self.strategy:
+            self._candidate = None
+            self._candidate_frames = 0
+            return
+        if proposed != self._candidate:
+            self._candidate = proposed
+            self._candidate_frames = 0
+        self._candidate_frames += 1
+        if self._candidate_frames >= self.hold_frames:
+            if self.verbose:
+                print(f"[INFO] Đổi chiến lược ánh sáng: {self.strategy} → {proposed} ({self.last_stats})")
+            self.strategy = proposed
+            self.switches += 1
+            if self.denoiser is not None:
+                # Bộ đệm cũ thuộc chiến lược khác, bắt đầu lại khi quay về low light
+                self.denoiser.reset()
+            self._candidate = None
+            self._candidate_frames = 0
+
+    def _auto_gamma(self, image):
+        small = cv2.resize(image, self.stats_size, interpolation=cv2.INTER_AREA)
+        # Độ sáng theo ảnh xám như auto_gamma, để cùng một frame ra cùng gamma ở mọi nhánh
+        brightness = float(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).mean())
+        return cv2.LUT(image, gamma_lut(gamma_for_brightness(brightness)))
+
+    def process(self, image, tier="full"):
+        """
+        Tăng cường một frame theo chiến lược đang giữ. tier giống preprocess_image.
+        """
+        hist, stats = self.analyze(image)
+        self._update_strategy(self._classify(stats))
+        self.strategy_frames[self.strategy] += 1
+        if tier == "off":
+            return image
+        fast = tier == "fast"
+
+        if self.strategy == STRATEGY_LOW_LIGHT:
+            # Khử nhiễu theo thời gian đủ rẻ để giữ cả ở mức "fast"
+            denoise = self.denoiser is not None or not fast
+            return enhance_image_for_low_light(image, denoise=denoise, gamma_fn=self._auto_gamma,
+                                               denoiser=self.denoiser)
+        if self.strategy == STRATEGY_GLARE:
+            return reduce_glare(image, smooth=not fast)
+        params = contrast_stretch_params(hist, self.clip_hist_percent)
+        if params is None:
+            return image
+        alpha, beta = params
+        return cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
+
+    def stats(self):
+        return {
+            'strategy': self.strategy,
+            'switches': self.switches,
+            'strategy_frames': dict(self.strategy_frames),
+            'lut_bank_size': len(_gamma_luts),
+            'denoise': self.denoise,
+            'denoiser': self.denoiser.stats() if self.denoiser is not None else None,
+        }
+
 # Hàm cũ để tương thích
 def adjust_gamma(image, gamma=1.5):
-    inv_gamma = 1.0 / gamma
-    table = np.array([((i / 255.0) ** inv_gamma) * 255 for i in np.arange(0, 256)]).astype("uint8")
-    return cv2.LUT(image, table)
\ No newline at end of file
+    return cv2.LUT(image, gamma_lut(gamma))
\ No newline at end of file
@@ -0,0 +1,252 @@
+# metrics.py - Counter/gauge/histogram bucket cố định, xuất dạng văn bản Prometheus qua HTTP hoặc Unix socket
+import bisect
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Bucket (giây) cho độ trễ từng bước: 0.5 ms -> 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_METRICS_PORT = 9108
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Chỉ tăng. inc() chỉ cộng vào một số dưới khóa, không cấp phát trên đường nóng.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name + "_total", labels, self.value)]
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Histogram:
+    """
+    Histogram bucket cố định: mảng đếm cấp phát một lần khi tạo, observe() chỉ tìm bucket (bisect) và cộng.
+    Đơn vị theo tên metric (giây cho *_seconds); observe_ms() nhận mili-giây cho tiện ở vòng xử lý.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def observe_ms(self, elapsed_ms):
+        self.observe(elapsed_ms / 1000.0)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """
+        Ước lượng phân vị từ bucket (nội suy tuyến tính trong bucket, như histogram_quantile).
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if total == 0:
+            return None
+        rank = q * total
+        cumulative = 0
+        for idx, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if idx == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[idx - 1] if idx > 0 else 0.0
+                return lower + (self.bounds[idx] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.bounds[-1]
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total, value_sum = self.count, self.sum
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            result.append((name + "_bucket", labels + (("le", _format_value(float(bound))),), cumulative))
+        result.append((name + "_sum", labels, value_sum))
+        result.append((name + "_count", labels, total))
+        return result
+
+
+class MetricFamily:
+    """
+    Một tên metric với nhiều chuỗi theo nhãn. labels(...) tạo chuỗi một lần (lúc khởi tạo),
+    vòng xử lý giữ lại đối tượng trả về và gọi inc/set/observe trực tiếp (không tra dict, không tạo tuple).
+    """
+
+    def __init__(self, name, help_text, kind, factory, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.factory = factory
+        self.label_names = tuple(label_names)
+        self.children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self.children[()] = factory()
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.label_names)
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} cần nhãn {self.label_names}")
+        key = tuple(str(v) for v in values)
+        child = self.children.get(key)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(key, self.factory())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in list(self.children.items()):
+            labels = tuple(zip(self.label_names, key))
+            for sample_name, sample_labels, value in child.samples(self.name, labels):
+                lines.append(f"{sample_name}{_format_labels(sample_labels)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _register(self, name, help_text, kind, factory, label_names):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = MetricFamily(name, help_text, kind, factory, label_names)
+            elif family.kind != kind or family.label_names != tuple(label_names):
+                raise ValueError(f"Metric {name} đã đăng ký với kiểu/nhãn khác")
+        # Metric không nhãn trả thẳng chuỗi duy nhất để gọi inc/set/observe
+        return family if family.label_names else family.children[()]
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(name, help_text, "counter", Counter, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(name, help_text, "gauge", Gauge, label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._register(name, help_text, "histogram", lambda: Histogram(buckets), label_names)
+
+    def render(self):
+        """
+        Returns: văn bản Prometheus exposition format 0.0.4.
+        """
+        with self._lock:
+            families = list(self._families.values())
+        lines = []
+        for family in families:
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+# Registry mặc định của tiến trình
+REGISTRY = MetricsRegistry()
+
+
+def _handler_for(registry):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler cần client_address dạng (host, port)
+        return request, ("unix", 0)
+
+
+def start_http_server(port=DEFAULT_METRICS_PORT, host="127.0.0.1", registry=REGISTRY):
+    """
+    Phục vụ GET /metrics trong thread nền. Returns: server (gọi shutdown() để dừng).
+    """
+    server = ThreadingHTTPServer((host, port), _handler_for(registry))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"[INFO] Metrics Prometheus tại http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def start_unix_server(path, registry=REGISTRY):
+    """
+    Như start_http_server nhưng trên Unix socket (POSIX), vd. curl --unix-socket <path> http://localhost/metrics
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    server = _UnixHTTPServer(path, _handler_for(registry))
+    threading.Thread(target=server.serve_forever, name="metrics-unix", daemon=True).start()
+    print(f"[INFO] Metrics Prometheus tại unix:{path}")
+    return server
@@ -0,0 +1,337 @@
+# model_loader.py - Tải InceptionResnetV1/MTCNN dùng chung: trọng số local có kiểm tra hash, TorchScript, warm-up, đo thời gian
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+import facenet_pytorch
+from facenet_pytorch import MTCNN, InceptionResnetV1
+
+from gallery_store import write_json_atomic, sha256_file
+
+MODELS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'models', 'facenet'))
+REGISTRY_FILE = "weights.json"
+
+# state_dict vggface2 đã bỏ lớp logits (không dùng khi chỉ lấy embedding)
+FACENET_WEIGHTS = "inceptionresnetv1_vggface2.pt"
+# Bản TorchScript đã freeze (chỉ dùng trên CPU, tạo bằng: python model_loader.py --prepare --torchscript)
+FACENET_TORCHSCRIPT = "inceptionresnetv1_vggface2.ts"
+
+# Checkpoint vggface2 mà facenet_pytorch tự tải vào cache torch hub (InceptionResnetV1(pretrained='vggface2'))
+HUB_CHECKPOINT = "20180402-114759-vggface2.pt"
+
+# Trọng số P/R/O-Net đi kèm package facenet_pytorch
+MTCNN_WEIGHTS = ("pnet.pt", "rnet.pt", "onet.pt")
+MTCNN_DATA_DIR = os.path.join(os.path.dirname(facenet_pytorch.__file__), 'data')
+
+# Cho phép tải vggface2 từ Internet khi chưa có file local (mặc định: không)
+ALLOW_DOWNLOAD_ENV_VAR = "MODEL_ALLOW_DOWNLOAD"
+TORCH_THREADS_ENV_VAR = "TORCH_NUM_THREADS"
+
+EMBED_INPUT_SHAPE = (1, 3, 160, 160)
+
+
+class ModelLoadError(Exception):
+    """
+    Thiếu file trọng số local hoặc file không khớp hash đã đăng ký.
+    """
+
+
+_lock = threading.Lock()
+_cache = {}
+_metrics = {}
+_torch_configured = False
+
+
+def configure_torch(num_threads=None, interop_threads=1):
+    """
+    Đặt số thread của torch một lần cho cả tiến trình (mặc định: biến TORCH_NUM_THREADS hoặc số CPU).
+    Gọi lại lần sau không có tác dụng.
+    """
+    global _torch_configured
+    if _torch_configured:
+        return
+    _torch_configured = True
+    if num_threads is None:
+        num_threads = int(os.getenv(TORCH_THREADS_ENV_VAR, "0")) or (os.cpu_count() or 1)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # Chỉ đặt được trước khi torch chạy tác vụ song song đầu tiên
+        pass
+
+
+def load_registry():
+    """
+    Returns: dict tên file -> {sha256, size, mtime} từ models/facenet/weights.json (rỗng nếu chưa có).
+    """
+    path = os.path.join(MODELS_DIR, REGISTRY_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise ModelLoadError(f"Không đọc được {path}: {e}")
+
+
+def save_registry(registry):
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    write_json_atomic(os.path.join(MODELS_DIR, REGISTRY_FILE), registry)
+
+
+def verify_file(path, name, registry=None):
+    """
+    Kiểm tra file với sha256 trong weights.json. Nếu size + mtime khớp lần kiểm tra trước thì
+    không tính lại hash (tránh đọc ~100MB mỗi lần khởi động).
+    Raises: ModelLoadError nếu thiếu file, chưa đăng ký hoặc sai hash.
+    """
+    registry = load_registry() if registry is None else registry
+    entry = registry.get(name)
+    if not os.path.exists(path):
+        raise ModelLoadError(f"Thiếu file model: {path} (chạy: python model_loader.py --prepare)")
+    if entry is None:
+        raise ModelLoadError(f"{name} chưa được đăng ký trong {REGISTRY_FILE} (chạy: python model_loader.py --prepare)")
+    st = os.stat(path)
+    if entry.get('size') == st.st_size and entry.get('mtime') == st.st_mtime_ns:
+        return
+    if sha256_file(path) != entry['sha256']:
+        raise ModelLoadError(f"Sai hash: {path}")
+    entry['size'], entry['mtime'] = st.st_size, st.st_mtime_ns
+    try:
+        save_registry(registry)
+    except OSError:
+        pass
+
+
+def register_file(registry, name, path):
+    st = os.stat(path)
+    registry[name] = {'sha256': sha256_file(path), 'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+
+def record_load(name, source, load_s, warmup_s):
+    _metrics[name] = {'source': source, 'load_ms': round(load_s * 1000, 1), 'warmup_ms': round(warmup_s * 1000, 1)}
+    print(f"[MODEL] {name}: {source}, load {load_s * 1000:.0f}ms, warm-up {warmup_s * 1000:.0f}ms")
+
+
+def load_metrics():
+    """
+    Returns: dict tên model -> {source, load_ms, warmup_ms} của các model đã tải trong tiến trình.
+    """
+    return {name: dict(values) for name, values in _metrics.items()}
+
+
+def _allow_download():
+    return os.getenv(ALLOW_DOWNLOAD_ENV_VAR, "false").lower() in ("1", "true", "yes")
+
+
+def _save_facenet_weights(state_dict, registry):
+    """
+    Lưu state_dict vggface2 đã bỏ lớp logits vào models/facenet/ và đăng ký hash (chưa ghi registry).
+    Returns: state_dict đã lưu.
+    """
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    state_dict = {k: v for k, v in state_dict.items() if not k.startswith('logits.')}
+    weights_path = os.path.join(MODELS_DIR, FACENET_WEIGHTS)
+    torch.save(state_dict, weights_path)
+    register_file(registry, FACENET_WEIGHTS, weights_path)
+    return state_dict
+
+
+def hub_checkpoint_path():
+    from facenet_pytorch.models.inception_resnet_v1 import get_torch_home
+    return os.path.join(get_torch_home(), 'checkpoints', HUB_CHECKPOINT)
+
+
+def adopt_hub_checkpoint(registry):
+    """
+    Máy chưa chạy --prepare nhưng facenet_pytorch đã tải vggface2 trước đây (bản cũ của Recognize/trainer):
+    dùng checkpoint trong cache torch hub làm trọng số local (bỏ logits, lưu, đăng ký hash), không cần Internet.
+    Returns: True nếu đã tạo FACENET_WEIGHTS.
+    """
+    path = hub_checkpoint_path()
+    if not os.path.exists(path):
+        return False
+    try:
+        _save_facenet_weights(torch.load(path, map_location='cpu'), registry)
+    except (OSError, RuntimeError) as e:
+        print(f"[WARN] Không dùng được checkpoint vggface2 trong cache {path}: {e}")
+        return False
+    registry[FACENET_WEIGHTS]['source'] = {'file': path, 'sha256': sha256_file(path)}
+    save_registry(registry)
+    print(f"[MODEL] Đã dùng checkpoint vggface2 trong cache torch hub: {path} -> {FACENET_WEIGHTS}")
+    return True
+
+
+def _warmup_facenet(model, device, runs):
+    start = time.perf_counter()
+    with torch.inference_mode():
+        dummy = torch.zeros(EMBED_INPUT_SHAPE, device=device)
+        for _ in range(runs):
+            model(dummy)
+    return time.perf_counter() - start
+
+
+def load_facenet(device, torchscript=True, warmup=True):
+    """
+    InceptionResnetV1 (vggface2) ở chế độ eval, dùng chung trong tiến trình.
+    Thứ tự: TorchScript đã freeze (chỉ CPU) -> state_dict local -> checkpoint vggface2 trong cache torch hub
+    (lần chạy đầu, được chép thành state_dict local) -> tải từ Internet nếu MODEL_ALLOW_DOWNLOAD=true.
+    Raises: ModelLoadError nếu không có trọng số local hợp lệ.
+    """
+    device = torch.device(device)
+    key = ('facenet', str(device), bool(torchscript))
+    with _lock:
+        if key in _cache:
+            return _cache[key]
+        configure_torch()
+        registry = load_registry()
+        start = time.perf_counter()
+        script_path = os.path.join(MODELS_DIR, FACENET_TORCHSCRIPT)
+        weights_path = os.path.join(MODELS_DIR, FACENET_WEIGHTS)
+        if torchscript and device.type == 'cpu' and FACENET_TORCHSCRIPT in registry:
+            verify_file(script_path, FACENET_TORCHSCRIPT, registry)
+            model = torch.jit.load(script_path, map_location=device)
+            source = "torchscript"
+        elif (os.path.exists(weights_path) or adopt_hub_checkpoint(registry)
+              or not _allow_download()):
+            verify_file(weights_path, FACENET_WEIGHTS, registry)
+            model = InceptionResnetV1(pretrained=None, classify=False)
+            model.load_state_dict(torch.load(weights_path, map_location='cpu'))
+            model = model.eval().to(device)
+            source = "state_dict"
+        else:
+            print(f"[WARN] Chưa có {FACENET_WEIGHTS} local, tải vggface2 từ Internet ({ALLOW_DOWNLOAD_ENV_VAR}=true)")
+            model = InceptionResnetV1(pretrained='vggface2').eval().to(device)
+            source = "download"
+        load_s = time.perf_counter() - start
+        # TorchScript cần 2 lượt để profiling executor tối ưu đồ thị
+        warmup_s = _warmup_facenet(model, device, 2 if source == "torchscript" else 1) if warmup else 0.0
+        record_load('facenet', source, load_s, warmup_s)
+        _cache[key] = model
+        return model
+
+
+def load_mtcnn(device, warmup=True, **options):
+    """
+    MTCNN với tham số options (keep_all, min_face_size, thresholds...), dùng chung trong tiến trình
+    cho cùng device + options. Trọng số P/R/O-Net của package được kiểm tra hash nếu đã đăng ký.
+    """
+    device = torch.device(device)
+    key = ('mtcnn', str(device), json.dumps(options, sort_keys=True))
+    with _lock:
+        if key in _cache:
+            return _cache[key]
+        configure_torch()
+        registry = load_registry()
+        start = time.perf_counter()
+        for name in MTCNN_WEIGHTS:
+            if name in registry:
+                verify_file(os.path.join(MTCNN_DATA_DIR, name), name, registry)
+        mtcnn = MTCNN(device=device, **options)
+        load_s = time.perf_counter() - start
+        warmup_s = 0.0
+        if warmup:
+            warm_start = time.perf_counter()
+            mtcnn.detect(np.zeros((120, 160, 3), dtype=np.uint8))
+            warmup_s = time.perf_counter() - warm_start
+        record_load(f"mtcnn(min_face_size={mtcnn.min_face_size})", "package", load_s, warmup_s)
+        _cache[key] = mtcnn
+        return mtcnn
+
+
+def prepare_artifacts(torchscript=False):
+    """
+    Chuẩn bị models/facenet/ (cần Internet một lần): lưu state_dict vggface2 không có logits,
+    tùy chọn tạo bản TorchScript đã freeze, và ghi sha256 của mọi file (cả P/R/O-Net) vào weights.json.
+    """
+    registry = load_registry()
+    model = InceptionResnetV1(pretrained='vggface2').eval()
+    state_dict = _save_facenet_weights(model.state_dict(), registry)
+    print(f"[PREPARE] {os.path.join(MODELS_DIR, FACENET_WEIGHTS)}")
+
+    if torchscript:
+        embedder = InceptionResnetV1(pretrained=None, classify=False)
+        embedder.load_state_dict(state_dict)
+        embedder.eval()
+        with torch.inference_mode():
+            traced = torch.jit.trace(embedder, torch.zeros(EMBED_INPUT_SHAPE))
+        frozen = torch.jit.freeze(traced)
+        script_path = os.path.join(MODELS_DIR, FACENET_TORCHSCRIPT)
+        frozen.save(script_path)
+        register_file(registry, FACENET_TORCHSCRIPT, script_path)
+        print(f"[PREPARE] {script_path}")
+    elif FACENET_TORCHSCRIPT in registry:
+        # Bản TorchScript cũ không còn khớp state_dict mới
+        del registry[FACENET_TORCHSCRIPT]
+
+    for name in MTCNN_WEIGHTS:
+        register_file(registry, name, os.path.join(MTCNN_DATA_DIR, name))
+    save_registry(registry)
+    print(f"[PREPARE] Registry: {os.path.join(MODELS_DIR, REGISTRY_FILE)}")
+
+
+def measure_cold_start(runs, device='cpu'):
+    """
+    Khởi động lạnh như lúc bật khóa: mỗi lần là một tiến trình Python mới chạy model_loader.py.
+    - startup_ms: từ lúc tạo tiến trình đến khi vào main (trình thông dịch + import torch/facenet_pytorch)
+    - load_ms: tải + kiểm tra hash + warm-up InceptionResnetV1 và MTCNN
+    - process_ms: tổng thời gian tiến trình con
+    Lần đầu thường chậm hơn vì file chưa nằm trong page cache của hệ điều hành.
+    Returns: dict {'runs': [...], 'first': {...}, 'warm_median': {...}}
+    """
+    results = []
+    for _ in range(runs):
+        spawned_at = time.time()
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--device", str(device),
+                              "--json", "--spawned_at", repr(spawned_at)], capture_output=True, text=True)
+        process_ms = (time.perf_counter() - start) * 1000
+        if out.returncode != 0:
+            raise ModelLoadError(f"Tiến trình đo khởi động lỗi: {(out.stdout + out.stderr).strip()[-500:]}")
+        child = json.loads(out.stdout.strip().splitlines()[-1])
+        results.append({'startup_ms': child['startup_ms'], 'load_ms': child['total_ms'],
+                        'process_ms': round(process_ms, 1), 'sources': {k: v['source'] for k, v in child['models'].items()}})
+    keys = ('startup_ms', 'load_ms', 'process_ms')
+    warm = results[1:] or results
+    return {
+        'runs': results,
+        'first': {k: results[0][k] for k in keys},
+        'warm_median': {k: round(float(np.median([r[k] for r in warm])), 1) for k in keys},
+    }
+
+
+if __name__ == "__main__":
+    main_at = time.time()
+    parser = argparse.ArgumentParser(description="Chuẩn bị và đo thời gian tải model nhận diện")
+    parser.add_argument("--prepare", action="store_true", help="Lưu trọng số local và ghi hash (cần Internet)")
+    parser.add_argument("--torchscript", action="store_true", help="--prepare: tạo thêm bản TorchScript đã freeze")
+    parser.add_argument("--device", default='cpu')
+    parser.add_argument("--cold_start", type=int, default=0,
+                        help="Đo khởi động lạnh qua N tiến trình mới (import + tải + warm-up)")
+    parser.add_argument("--json", action="store_true", help="In kết quả trên một dòng JSON (dùng bởi --cold_start)")
+    parser.add_argument("--spawned_at", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.prepare:
+        prepare_artifacts(torchscript=args.torchscript)
+    try:
+        if args.cold_start:
+            print(json.dumps(measure_cold_start(args.cold_start, args.device), indent=2))
+            sys.exit(0)
+        start = time.perf_counter()
+        load_facenet(args.device)
+        load_mtcnn(args.device, keep_all=False, min_face_size=50)
+    except ModelLoadError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+    result = {'total_ms': round((time.perf_counter() - start) * 1000, 1), 'models': load_metrics()}
+    if args.spawned_at is not None:
+        result['startup_ms'] = round((main_at - args.spawned_at) * 1000, 1)
+    print(json.dumps(result) if args.json else json.dumps(result, indent=2))
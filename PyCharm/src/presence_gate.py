@@ -0,0 +1,130 @@
+# presence_gate.py - Chỉ chạy nhận diện khi có người trước cửa (cảm biến siêu âm + chuyển động)
+import time
+
+import cv2
+import numpy as np
+
+STATE_IDLE = "IDLE"
+STATE_ARMED = "ARMED"
+
+
+def motion_score(prev_small, small, pixel_threshold=25):
+    """
+    Tỉ lệ (%) pixel thay đổi giữa hai frame xám đã thu nhỏ.
+    """
+    diff = cv2.absdiff(prev_small, small)
+    return float(np.count_nonzero(diff > pixel_threshold)) * 100.0 / diff.size
+
+
+class PresenceGate:
+    """
+    Hai trạng thái:
+    - IDLE: không chạy tiền xử lý/phát hiện; chỉ kiểm tra chuyển động mỗi idle_check_every frame.
+    - ARMED: chạy phát hiện mỗi armed_detect_every frame.
+
+    Chuyển IDLE -> ARMED khi khoảng cách < arm_distance_cm hoặc motion >= motion_on.
+    Chuyển ARMED -> IDLE khi trong idle_after_s giây liên tục: khoảng cách > disarm_distance_cm
+    (hoặc không có), motion < motion_off và không phát hiện khuôn mặt (ngưỡng trễ hai chiều).
+    """
+
+    def __init__(self, arm_distance_cm=80.0, disarm_distance_cm=120.0, motion_on=2.0, motion_off=0.5,
+                 idle_check_every=5, armed_detect_every=1, idle_after_s=3.0, small_size=(80, 60)):
+        if disarm_distance_cm < arm_distance_cm or motion_off > motion_on:
+            raise ValueError("Ngưỡng tắt phải lỏng hơn ngưỡng bật (hysteresis)")
+        self.arm_distance_cm = arm_distance_cm
+        self.disarm_distance_cm = disarm_distance_cm
+        self.motion_on = motion_on
+        self.motion_off = motion_off
+        self.idle_check_every = max(1, idle_check_every)
+        self.armed_detect_every = max(1, armed_detect_every)
+        self.idle_after_s = idle_after_s
+        self.small_size = small_size
+
+        self.state = STATE_IDLE
+        self._prev_small = None
+        self._last_presence = 0.0
+        self._frame_in_state = 0
+
+        self.last_motion = 0.0
+        self.last_distance = None
+        self.frames_seen = 0
+        self.frames_processed = 0
+        self.frames_skipped = 0
+        self.motion_checks = 0
+        self.arm_events = 0
+
+    def _motion(self, frame):
+        small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), self.small_size,
+                           interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+        score = 0.0 if self._prev_small is None else motion_score(self._prev_small, small)
+        self._prev_small = small
+        self.motion_checks += 1
+        self.last_motion = score
+        return score
+
+    @staticmethod
+    def _as_cm(distance):
+        # distance từ thread Serial có thể là chuỗi ("Ngoài phạm vi", "Lỗi định dạng") hoặc None
+        return float(distance) if isinstance(distance, (int, float)) else None
+
+    def _set_state(self, state):
+        if state != self.state:
+            if state == STATE_ARMED:
+                self.arm_events += 1
+            print(f"[GATE] {self.state} → {state} (distance={self.last_distance}, motion={self.last_motion:.1f}%)")
+            self.state = state
+            self._frame_in_state = 0
+
+    def should_process(self, frame, distance=None, now=None):
+        """
+        Quyết định frame này có chạy pipeline nhận diện hay không.
+        """
+        now = time.monotonic() if now is None else now
+        self.frames_seen += 1
+        self._frame_in_state += 1
+        cm = self._as_cm(distance)
+        self.last_distance = cm
+
+        if self.state == STATE_IDLE:
+            near = cm is not None and cm < self.arm_distance_cm
+            if not near and self._frame_in_state % self.idle_check_every != 0:
+                self.frames_skipped += 1
+                return False
+            if near or self._motion(frame) >= self.motion_on:
+                self._last_presence = now
+                self._set_state(STATE_ARMED)
+            else:
+                self.frames_skipped += 1
+                return False
+        else:
+            still_near = cm is not None and cm <= self.disarm_distance_cm
+            if still_near or self._motion(frame) >= self.motion_off:
+                self._last_presence = now
+            elif now - self._last_presence >= self.idle_after_s:
+                self._set_state(STATE_IDLE)
+                self.frames_skipped += 1
+                return False
+
+        if self._frame_in_state % self.armed_detect_every != 0 and self._frame_in_state != 1:
+            self.frames_skipped += 1
+            return False
+        self.frames_processed += 1
+        return True
+
+    def report_faces(self, count, now=None):
+        """
+        Báo số khuôn mặt phát hiện được để giữ trạng thái ARMED khi người đứng yên.
+        """
+        if count > 0:
+            self._last_presence = time.monotonic() if now is None else now
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'frames_seen': self.frames_seen,
+            'frames_processed': self.frames_processed,
+            'frames_skipped': self.frames_skipped,
+            'motion_checks': self.motion_checks,
+            'arm_events': self.arm_events,
+        }
@@ -0,0 +1,250 @@
+# recognition_pipeline.py - Các bước xử lý một frame của Recognize: tiền xử lý, phát hiện, căn chỉnh, embedding, so khớp
+import time
+from collections import namedtuple
+
+import cv2
+
+from face_pipeline import (
+    MIN_FACE_SIZE,
+    load_deep_face_detector,
+    detect_faces_dnn,
+    detect_and_align_mtcnn,
+    square_crop_images,
+    square_crop_faces,
+    standardize_face,
+    align_face_crops,
+    embed_aligned_faces,
+    stack_embeddings
+)
+from image_enhancement import prepare_frame_for_detection, RoiEnhancer, FrameEnhancer
+
+STAGES = ('preprocess', 'detect', 'align', 'embed', 'match')
+
+# frame: BGR đã tiền xử lý (để vẽ/hiển thị), raw_frame: frame gốc khi tăng cường theo ROI, ngược lại None
+PreparedFrame = namedtuple('PreparedFrame', ['frame', 'frame_rgb', 'raw_frame', 'is_low_light', 'brightness',
+                                             'preprocess_ms'])
+# faces: mọi khuôn mặt phát hiện được; face_boxes/tracks/matches: khuôn mặt đủ lớn, cùng thứ tự;
+# pending: chỉ số các khuôn mặt vừa được embed + so khớp ở frame này; timings: ms theo STAGES
+FrameAnalysis = namedtuple('FrameAnalysis', ['faces', 'face_boxes', 'tracks', 'matches', 'pending', 'timings'])
+
+
+def load_face_detectors(pipeline_mode):
+    """
+    Bộ phát hiện cho các chế độ SSD: mạng SSD nếu có model, không thì Haar Cascade.
+    Returns: (face_detector, face_cascade); cả hai None với chế độ mtcnn hoặc khi không tải được Haar.
+    """
+    if pipeline_mode == "mtcnn":
+        return None, None
+    face_detector = load_deep_face_detector()
+    if face_detector is not None:
+        return face_detector, None
+    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    if face_cascade.empty():
+        return None, None
+    print("[INFO] Dùng Haar Cascade.")
+    return None, face_cascade
+
+
+class RecognitionPipeline:
+    """
+    Chuỗi xử lý một frame dùng chung cho Recognize.main và replay_benchmark:
+    preprocess (FrameEnhancer hoặc kiểm tra toàn cục + ROI) -> detect -> tracker -> align -> embed -> match.
+    Không gửi serial/Telegram/Firebase; phần quyết định mở cửa do nơi gọi xử lý.
+
+    mtcnn: MTCNN căn chỉnh trên crop (ssd_mtcnn), mtcnn_full: MTCNN trên cả frame (mtcnn).
+    """
+
+    def __init__(self, pipeline_mode, resnet, device, matcher, tracker, threshold, mtcnn=None, mtcnn_full=None,
+                 face_detector=None, face_cascade=None, enhance_mode="frame", denoise="nlm", verbose=True):
+        self.pipeline_mode = pipeline_mode
+        self.resnet = resnet
+        self.device = device
+        self.matcher = matcher
+        self.tracker = tracker
+        self.threshold = threshold
+        self.mtcnn = mtcnn
+        self.mtcnn_full = mtcnn_full
+        self.face_detector = face_detector
+        self.face_cascade = face_cascade
+        self.enhance_mode = enhance_mode
+        # Chế độ ROI: chỉ tăng cường vùng khuôn mặt trước khi căn chỉnh, cache theo track
+        self.roi_enhancer = RoiEnhancer() if enhance_mode == "roi" else None
+        # Một histogram mỗi frame, giữ chiến lược ánh sáng qua các frame, dùng lại LUT/CLAHE
+        self.frame_enhancer = FrameEnhancer(denoise=denoise, verbose=verbose) if enhance_mode == "frame" else None
+        if enhance_mode == "roi" and pipeline_mode == "mtcnn":
+            print("[WARNING] Chế độ pipeline mtcnn căn chỉnh ngay khi phát hiện: ROI chỉ dùng kiểm tra toàn cục.")
+
+    def preprocess(self, frame, level):
+        """
+        Tăng cường ánh sáng theo enhance_mode và mức của bộ lập lịch (level.enhance_tier).
+        Returns: PreparedFrame
+        """
+        start = time.perf_counter()
+        raw_frame = None
+        if self.enhance_mode == "roi":
+            # Chỉ kiểm tra toàn cục rẻ để hỗ trợ phát hiện; giữ frame gốc để tăng cường vùng khuôn mặt
+            raw_frame = frame
+            frame, is_low_light, brightness = prepare_frame_for_detection(raw_frame)
+            if frame is raw_frame:
+                frame = raw_frame.copy()
+        else:
+            frame = self.frame_enhancer.process(frame, tier=level.enhance_tier)
+            # brightness lấy từ histogram đã tính trong process (trước khi tăng cường)
+            brightness = self.frame_enhancer.last_stats['median']
+            is_low_light = self.frame_enhancer.strategy == "low_light"
+        preprocess_ms = (time.perf_counter() - start) * 1000
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        return PreparedFrame(frame, frame_rgb, raw_frame, is_low_light, brightness, preprocess_ms)
+
+    def detect(self, prepared, level):
+        """
+        Returns: (faces [(x, y, w, h)], aligned_faces hoặc None nếu chế độ chưa căn chỉnh khi phát hiện)
+        """
+        if self.pipeline_mode == "mtcnn":
+            return detect_and_align_mtcnn(self.mtcnn_full, prepared.frame_rgb, scale=0.5 * level.detect_size / 300)
+        if self.face_detector is not None:
+            return detect_faces_dnn(self.face_detector, prepared.frame, input_size=level.detect_size), None
+        gray = cv2.cvtColor(prepared.frame, cv2.COLOR_BGR2GRAY)
+        return self.face_cascade.detectMultiScale(gray, 1.1, 6, minSize=(MIN_FACE_SIZE, MIN_FACE_SIZE)), None
+
+    def align(self, prepared, face_boxes, face_crops, face_aligned, tracks, pending, level):
+        """
+        Căn chỉnh các khuôn mặt cần xác minh theo chế độ pipeline (tensor 160x160 hoặc None).
+        """
+        frame_rgb, raw_frame = prepared.frame_rgb, prepared.raw_frame
+        if self.pipeline_mode == "mtcnn":
+            return [face_aligned[i] for i in pending]
+        if self.pipeline_mode == "ssd_crop":
+            if raw_frame is None:
+                return square_crop_faces(frame_rgb, [face_boxes[i] for i in pending])
+            roi_crops = square_crop_images(raw_frame, [face_boxes[i] for i in pending])
+            return [
+                standardize_face(cv2.cvtColor(
+                    self.roi_enhancer.enhance(crop, tracks[i].track_id, face_boxes[i], tier=level.enhance_tier),
+                    cv2.COLOR_BGR2RGB)) if crop is not None else None
+                for i, crop in zip(pending, roi_crops)
+            ]
+        if raw_frame is not None:
+            roi_crops = []
+            for i in pending:
+                x, y, w, h = face_boxes[i]
+                enhanced = self.roi_enhancer.enhance(raw_frame[y:y + h, x:x + w], tracks[i].track_id,
+                                                     face_boxes[i], tier=level.enhance_tier)
+                roi_crops.append(cv2.cvtColor(enhanced, cv2.COLOR_BGR2RGB))
+        else:
+            roi_crops = [face_crops[i] for i in pending]
+        return align_face_crops(self.mtcnn, roi_crops)
+
+    def analyze(self, prepared, level):
+        """
+        Phát hiện, gán track, rồi căn chỉnh + embed theo batch và so khớp các track cần xác minh.
+        Track đã xác minh gần đây dùng lại danh tính đã cache (không tính vào pending).
+        Returns: FrameAnalysis
+        """
+        timings = {'preprocess': prepared.preprocess_ms}
+        start = time.perf_counter()
+        faces, aligned_faces = self.detect(prepared, level)
+        timings['detect'] = (time.perf_counter() - start) * 1000
+
+        # Gom mọi khuôn mặt đủ điều kiện trong frame để căn chỉnh và embed theo batch
+        face_boxes = []
+        face_crops = []
+        face_aligned = []
+        for face_idx, (x, y, w, h) in enumerate(faces):
+            if w < MIN_FACE_SIZE or h < MIN_FACE_SIZE:
+                continue
+            face_img = prepared.frame_rgb[y:y + h, x:x + w]
+            if face_img.size == 0:
+                continue
+            face_boxes.append((x, y, w, h))
+            face_crops.append(face_img)
+            face_aligned.append(aligned_faces[face_idx] if aligned_faces is not None else None)
+
+        tracks = self.tracker.update(face_boxes)
+        matches = [track.identity for track in tracks]
+        pending = [i for i, track in enumerate(tracks) if self.tracker.needs_embedding(track)]
+        if self.roi_enhancer is not None:
+            self.roi_enhancer.prune([t.track_id for t in self.tracker.tracks])
+        if not pending:
+            return FrameAnalysis(faces, face_boxes, tracks, matches, pending, timings)
+
+        start = time.perf_counter()
+        aligned = self.align(prepared, face_boxes, face_crops, face_aligned, tracks, pending, level)
+        timings['align'] = (time.perf_counter() - start) * 1000
+
+        # Một forward pass InceptionResnetV1 + một phép so khớp cho cả batch
+        start = time.perf_counter()
+        embeddings = embed_aligned_faces(self.resnet, aligned, self.device)
+        timings['embed'] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        valid_idx, query_matrix = stack_embeddings(embeddings)
+        for i in pending:
+            matches[i] = None
+        # MTCNN có thể không căn chỉnh được crop nào (mặt nghiêng, mờ): không có gì để so khớp
+        if valid_idx:
+            for j, top_k in zip(valid_idx, self.matcher.match(query_matrix)):
+                matches[pending[j]] = top_k[0] if top_k else None
+        timings['match'] = (time.perf_counter() - start) * 1000
+
+        for i in pending:
+            match = matches[i]
+            self.tracker.set_identity(tracks[i], match,
+                                      is_known=match is not None and match.distance < self.threshold)
+        return FrameAnalysis(faces, face_boxes, tracks, matches, pending, timings)
+
+    def stats(self):
+        stats = {'tracker': self.tracker.stats()}
+        if self.frame_enhancer is not None:
+            stats['frame_enhancer'] = self.frame_enhancer.stats()
+        if self.roi_enhancer is not None:
+            stats['roi_enhancer'] = self.roi_enhancer.stats()
+        return stats
+
+
+# status: 'gated' (cổng hiện diện bỏ qua), 'skipped' (bộ lập lịch bỏ frame), 'locked' (đang khóa tạm sau
+# nhiều lần sai, đã tiền xử lý để hiển thị) hoặc 'processed'; known: [(chỉ số trong face_boxes, MatchResult)]
+FrameDecision = namedtuple('FrameDecision', ['status', 'level', 'prepared', 'analysis', 'known', 'frame_ms'])
+
+
+class FrameProcessor:
+    """
+    Quyết định cho một frame camera, dùng chung cho vòng lặp Recognize.main và e2e_latency:
+    cổng hiện diện (tùy chọn) -> bộ lập lịch -> preprocess -> khóa tạm -> analyze -> khuôn mặt đã biết.
+    Hành động theo kết quả (lệnh serial, Telegram, giọng nói, hiển thị) do nơi gọi thực hiện.
+    """
+
+    def __init__(self, pipeline, scheduler, gate=None):
+        self.pipeline = pipeline
+        self.scheduler = scheduler
+        self.gate = gate
+
+    def process(self, frame, distance=None, locked=False):
+        """
+        distance: khoảng cách siêu âm gần nhất (cm, chuỗi hoặc None) cho cổng hiện diện.
+        Returns: FrameDecision
+        """
+        if self.gate is not None and not self.gate.should_process(frame, distance):
+            return FrameDecision('gated', None, None, None, [], 0.0)
+        if not self.scheduler.should_process():
+            return FrameDecision('skipped', None, None, None, [], 0.0)
+        level = self.scheduler.level
+        start = time.perf_counter()
+
+        prepared = self.pipeline.preprocess(frame, level)
+        self.scheduler.record('preprocess', prepared.preprocess_ms)
+        if locked:
+            return FrameDecision('locked', level, prepared, None, [], (time.perf_counter() - start) * 1000)
+
+        # Phát hiện, gán track; chỉ track cần xác minh mới được căn chỉnh + embed + so khớp
+        analysis = self.pipeline.analyze(prepared, level)
+        for stage, elapsed_ms in analysis.timings.items():
+            if stage != 'preprocess':
+                self.scheduler.record(stage, elapsed_ms)
+        if self.gate is not None:
+            self.gate.report_faces(len(analysis.faces))
+        frame_ms = (time.perf_counter() - start) * 1000
+        self.scheduler.end_frame(frame_ms)
+        known = [(i, match) for i, match in enumerate(analysis.matches)
+                 if match is not None and match.distance < self.pipeline.threshold]
+        return FrameDecision('processed', level, prepared, analysis, known, frame_ms)
@@ -0,0 +1,332 @@
+# recognition_service.py - Một tiến trình nhận diện cho nhiều khóa: model tải một lần, gallery theo LRU có giới hạn bộ nhớ
+import argparse
+import hmac
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import torch
+
+from ann_index import load_index, DEFAULT_NPROBE
+from embedding_backend import load_embedder, embedder_version, gallery_model_version, BACKENDS
+from face_pipeline import create_full_frame_mtcnn, detect_and_align_mtcnn, embed_aligned_faces, stack_embeddings
+from gallery_matcher import GalleryMatcher
+from gallery_prototypes import PrototypeMatcher, load_prototypes, MATCH_MODES
+from gallery_store import load_gallery, GalleryStoreError
+from model_loader import load_metrics
+
+DATASET_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'dataset'))
+
+# Giống Recognize.FACE_MATCH_THRESHOLD
+FACE_MATCH_THRESHOLD = 0.3
+
+DEFAULT_MEMORY_MB = 256
+
+# lock_id lấy từ URL: chỉ chữ, số, '_' và '-' (không cho '..' hay '/' đi ra ngoài thư mục dataset)
+LOCK_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+
+
+class LockStats:
+    """
+    Bộ đếm của một khóa: lượt dùng cache (hit/miss), số lần tải, tổng thời gian tải, số lần bị loại.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_ms = 0.0
+        self.last_load_ms = 0.0
+        self.evictions = 0
+        self.requests = 0
+        self.faces = 0
+
+    def as_dict(self):
+        return {
+            'hits': self.hits, 'misses': self.misses, 'loads': self.loads,
+            'load_ms_total': round(self.load_ms, 1), 'last_load_ms': round(self.last_load_ms, 1),
+            'evictions': self.evictions, 'requests': self.requests, 'faces': self.faces,
+        }
+
+
+class GalleryCache:
+    """
+    Cache LRU các matcher theo lock_id, tổng dung lượng (embeddings + chỉ mục/prototype) không quá budget_bytes.
+    Gallery được tải lười khi khóa được gọi lần đầu; khóa ít dùng nhất bị loại khi vượt budget
+    (khóa vừa tải luôn được giữ, kể cả khi một mình nó lớn hơn budget).
+    Bộ đếm chỉ tạo cho khóa đã tải thành công; lần tải lỗi chỉ cộng vào failed_loads.
+    """
+
+    def __init__(self, load_fn, budget_bytes):
+        self.load_fn = load_fn
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.stats = {}
+        self.failed_loads = 0
+        self._lock = threading.Lock()
+        # Lock tải theo khóa, chỉ tồn tại trong lúc đang tải
+        self._loading = {}
+
+    def _hit(self, lock_id, entry):
+        self.entries.move_to_end(lock_id)
+        stats = self.stats[lock_id]
+        stats.requests += 1
+        stats.hits += 1
+        return entry[0]
+
+    def get(self, lock_id):
+        """
+        Returns: matcher của khóa hoặc None nếu khóa chưa có gallery.
+        """
+        with self._lock:
+            entry = self.entries.get(lock_id)
+            if entry is not None:
+                return self._hit(lock_id, entry)
+            # Mỗi khóa chỉ tải một lần dù nhiều request đến cùng lúc
+            load_lock = self._loading.setdefault(lock_id, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                entry = self.entries.get(lock_id)
+                if entry is not None:
+                    return self._hit(lock_id, entry)
+            start = time.perf_counter()
+            try:
+                loaded = self.load_fn(lock_id)
+            finally:
+                with self._lock:
+                    if self._loading.get(lock_id) is load_lock:
+                        del self._loading[lock_id]
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                if loaded is None:
+                    self.failed_loads += 1
+                    return None
+                stats = self.stats.get(lock_id)
+                if stats is None:
+                    stats = self.stats[lock_id] = LockStats()
+                stats.requests += 1
+                stats.misses += 1
+                stats.loads += 1
+                stats.load_ms += elapsed_ms
+                stats.last_load_ms = elapsed_ms
+                matcher, size = loaded
+                self.entries[lock_id] = (matcher, size)
+                self.bytes += size
+                while self.bytes > self.budget_bytes and len(self.entries) > 1:
+                    evicted, (_, evicted_size) = self.entries.popitem(last=False)
+                    self.bytes -= evicted_size
+                    self.stats[evicted].evictions += 1
+                    print(f"[CACHE] Evicted gallery {evicted} ({evicted_size / 1e6:.1f} MB)")
+                return matcher
+
+    def record_faces(self, lock_id, count):
+        with self._lock:
+            stats = self.stats.get(lock_id)
+            if stats is not None:
+                stats.faces += count
+
+    def evict(self, lock_id):
+        """
+        Bỏ gallery của khóa khỏi cache (vd. sau khi trainer cập nhật).
+        """
+        with self._lock:
+            entry = self.entries.pop(lock_id, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'budget_bytes': self.budget_bytes,
+                'used_bytes': self.bytes,
+                'cached': list(self.entries),
+                'failed_loads': self.failed_loads,
+                'locks': {lock_id: stats.as_dict() for lock_id, stats in self.stats.items()},
+            }
+
+
+class RecognitionService:
+    """
+    Giữ một bộ MTCNN + embedder cho cả tiến trình và nhận diện frame của bất kỳ khóa nào.
+    Frame được phát hiện/căn chỉnh bằng MTCNN một bước (chế độ pipeline mtcnn của Recognize),
+    embedding theo batch rồi so khớp với gallery của khóa lấy từ GalleryCache.
+    """
+
+    def __init__(self, device=None, backend="torch", memory_mb=DEFAULT_MEMORY_MB, metric='l2',
+                 match_mode="full", nprobe=DEFAULT_NPROBE, dataset_dir=DATASET_DIR, threshold=FACE_MATCH_THRESHOLD):
+        self.device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.mtcnn = create_full_frame_mtcnn(self.device)
+        self.resnet = load_embedder(self.device, backend)
+        self.metric = metric
+        self.match_mode = match_mode
+        self.nprobe = nprobe
+        self.dataset_dir = dataset_dir
+        self.threshold = threshold
+        self.cache = GalleryCache(self._load_lock, int(memory_mb * 1024 * 1024))
+        # Các khóa dùng chung một bộ model: chạy suy luận lần lượt để không tranh thread của torch
+        self._infer_lock = threading.Lock()
+
+    def lock_dir(self, lock_id):
+        """
+        Returns: thư mục dataset của khóa, hoặc None nếu lock_id sai định dạng hay thư mục không tồn tại.
+        """
+        if not LOCK_ID_PATTERN.fullmatch(lock_id or ''):
+            return None
+        lock_dir = os.path.join(self.dataset_dir, lock_id)
+        return lock_dir if os.path.isdir(lock_dir) else None
+
+    def _load_lock(self, lock_id):
+        lock_dir = self.lock_dir(lock_id)
+        if lock_dir is None:
+            print(f"[WARNING] Khóa {lock_id!r} không hợp lệ hoặc không có thư mục dataset")
+            return None
+        try:
+            gallery = load_gallery(lock_dir)
+        except GalleryStoreError as e:
+            print(f"[ERROR] Gallery {lock_id} lỗi: {e}")
+            return None
+        if gallery is None or len(gallery.ids) == 0:
+            print(f"[WARNING] Khóa {lock_id} chưa có gallery (chạy trainer.py {lock_id})")
+            return None
+        # Không so khớp embedding của backend này với gallery do embedder khác tạo
+        if gallery_model_version(gallery.header) != embedder_version(self.resnet):
+            print(f"[ERROR] Gallery {lock_id} tạo bằng {gallery_model_version(gallery.header)}, service dùng "
+                  f"{embedder_version(self.resnet)} (chạy trainer.py {lock_id} với cùng --embed_backend)")
+            return None
+        if self.match_mode != "full":
+            prototypes = load_prototypes(lock_dir)
+            if prototypes is not None:
+                matcher = PrototypeMatcher(prototypes, gallery.embeddings, metric=self.metric,
+                                           refine=self.match_mode == "refine", reject_distance=self.threshold)
+                size = prototypes.nbytes + (gallery.embeddings.nbytes if self.match_mode == "refine" else 0)
+                return matcher, size
+        index = load_index(lock_dir)
+        matcher = GalleryMatcher(gallery.embeddings, gallery.ids, gallery.names, metric=self.metric,
+                                 index=index, nprobe=self.nprobe)
+        size = matcher.embeddings.nbytes + matcher.sq_norms.nbytes
+        if index is not None:
+            size += index.centroids.nbytes + index.order.nbytes + index.offsets.nbytes
+        return matcher, size
+
+    def recognize(self, lock_id, frame_bgr):
+        """
+        Returns: list dict {box, name, face_id, distance, confidence, known} cho mọi khuôn mặt,
+        hoặc None nếu khóa chưa có gallery.
+        """
+        matcher = self.cache.get(lock_id)
+        if matcher is None:
+            return None
+        frame_rgb = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
+        with self._infer_lock:
+            boxes, aligned = detect_and_align_mtcnn(self.mtcnn, frame_rgb)
+            embeddings = embed_aligned_faces(self.resnet, aligned, self.device)
+        valid_idx, query_matrix = stack_embeddings(embeddings)
+        matches = [None] * len(boxes)
+        if valid_idx:
+            for j, top_k in zip(valid_idx, matcher.match(query_matrix)):
+                matches[j] = top_k[0] if top_k else None
+        self.cache.record_faces(lock_id, len(boxes))
+
+        results = []
+        for box, match in zip(boxes, matches):
+            known = match is not None and match.distance < self.threshold
+            results.append({
+                'box': [int(v) for v in box],
+                'name': match.name if known else "Unknown",
+                'face_id': match.face_id if known else None,
+                'distance': round(match.distance, 4) if match is not None else None,
+                'confidence': round(match.confidence, 1) if match is not None else 0.0,
+                'known': known,
+            })
+        return results
+
+    def stats(self):
+        snapshot = self.cache.snapshot()
+        snapshot['models'] = load_metrics()
+        return snapshot
+
+
+def create_app(service, api_key=None):
+    """
+    Flask app cho service (nếu có api_key: mọi request phải gửi header X-API-Key khớp):
+    - POST /api/locks/<lock_id>/recognize: ảnh JPEG (file 'image' hoặc body thô) -> kết quả nhận diện
+    - POST /api/locks/<lock_id>/reload: bỏ gallery khỏi cache để lần sau tải lại
+    - GET /api/service/stats: bộ đếm cache theo khóa + thời gian tải model
+    """
+    from flask import Flask, request, jsonify
+
+    app = Flask(__name__)
+
+    @app.before_request
+    def check_api_key():
+        if api_key and not hmac.compare_digest(request.headers.get("X-API-Key", ""), api_key):
+            return jsonify({"status": "error", "message": "Sai API key"}), 401
+        return None
+
+    def check_lock(lock_id):
+        if not LOCK_ID_PATTERN.fullmatch(lock_id):
+            return jsonify({"status": "error", "message": "lock_id không hợp lệ"}), 400
+        if service.lock_dir(lock_id) is None:
+            return jsonify({"status": "error", "message": f"Không có khóa {lock_id}"}), 404
+        return None
+
+    @app.route("/api/locks/<lock_id>/recognize", methods=["POST"])
+    def recognize_api(lock_id):
+        error = check_lock(lock_id)
+        if error is not None:
+            return error
+        data = request.files["image"].read() if "image" in request.files else request.get_data()
+        frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR) if data else None
+        if frame is None:
+            return jsonify({"status": "error", "message": "Ảnh không hợp lệ"}), 400
+        start = time.perf_counter()
+        faces = service.recognize(lock_id, frame)
+        if faces is None:
+            return jsonify({"status": "error", "message": f"Khóa {lock_id} chưa có gallery"}), 404
+        return jsonify({"status": "success", "lock_id": lock_id, "faces": faces,
+                        "latency_ms": round((time.perf_counter() - start) * 1000, 1)})
+
+    @app.route("/api/locks/<lock_id>/reload", methods=["POST"])
+    def reload_api(lock_id):
+        error = check_lock(lock_id)
+        if error is not None:
+            return error
+        service.cache.evict(lock_id)
+        return jsonify({"status": "success", "lock_id": lock_id})
+
+    @app.route("/api/service/stats", methods=["GET"])
+    def stats_api():
+        return jsonify(service.stats())
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Service nhận diện dùng chung model cho nhiều khóa")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Mặc định chỉ nghe trên máy này; mở ra mạng (0.0.0.0) thì nên đặt --api_key")
+    parser.add_argument("--api_key", default=os.getenv("RECOGNITION_API_KEY"),
+                        help="Yêu cầu header X-API-Key (mặc định lấy từ biến môi trường RECOGNITION_API_KEY)")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--memory_mb", type=float, default=DEFAULT_MEMORY_MB,
+                        help="Giới hạn bộ nhớ cho các gallery trong cache")
+    parser.add_argument("--embed_backend", choices=BACKENDS, default="torch")
+    parser.add_argument("--match_metric", choices=GalleryMatcher.METRICS, default="l2")
+    parser.add_argument("--match_mode", choices=MATCH_MODES, default="full")
+    parser.add_argument("--ann_nprobe", type=int, default=DEFAULT_NPROBE)
+    parser.add_argument("--preload", nargs='*', default=[], help="Tải sẵn gallery của các khóa này")
+    args = parser.parse_args()
+
+    service = RecognitionService(backend=args.embed_backend, memory_mb=args.memory_mb, metric=args.match_metric,
+                                 match_mode=args.match_mode, nprobe=args.ann_nprobe)
+    for lock_id in args.preload:
+        service.cache.get(lock_id)
+    if args.host not in ("127.0.0.1", "localhost") and not args.api_key:
+        print(f"[WARN] Service nghe trên {args.host} mà không có API key")
+    create_app(service, api_key=args.api_key).run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,289 @@
+# replay_benchmark.py - Phát lại video/thư mục ảnh qua đúng các bước của Recognize.main (không cần camera, ESP32, mạng)
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import cv2
+import torch
+
+from ann_index import load_index, DEFAULT_NPROBE
+from bench_utils import iter_frames, summarize
+from embedding_backend import load_embedder, embedder_version, gallery_model_version, BACKENDS
+from event_dispatcher import EventDispatcher, RecognitionEvent
+from face_pipeline import PIPELINE_MODES, create_full_frame_mtcnn
+from face_tracker import FaceTracker
+from frame_scheduler import DEFAULT_LEVELS
+from gallery_matcher import GalleryMatcher
+from gallery_prototypes import PrototypeMatcher, load_prototypes, MATCH_MODES
+from gallery_store import load_gallery, GalleryStoreError
+from image_enhancement import DENOISE_MODES
+from model_loader import load_mtcnn, load_metrics, ModelLoadError
+from recognition_pipeline import RecognitionPipeline, load_face_detectors, STAGES
+
+DATASET_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'dataset'))
+DEFAULT_SOURCE = os.path.join(os.path.dirname(__file__), '..', 'temp', '*.jpg')
+
+# Giống Recognize.FACE_MATCH_THRESHOLD
+FACE_MATCH_THRESHOLD = 0.3
+
+
+def peak_rss_mb():
+    """
+    RSS lớn nhất của tiến trình (MB): getrusage trên Linux/macOS, psutil trên Windows.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux trả KB, macOS trả byte
+        return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return round(getattr(info, 'peak_wset', info.rss) / (1024 * 1024), 1)
+    except ImportError:
+        return None
+
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def build_matcher(lock_id, metric, match_mode, nprobe, model_version=None):
+    """
+    Matcher giống Recognize.main; không có lock_id thì dùng gallery rỗng (mọi khuôn mặt là Unknown).
+    model_version: phiên bản embedder sẽ tạo query; gallery của embedder khác bị từ chối.
+    """
+    if not lock_id:
+        print("[WARN] Không có --lock_id: so khớp với gallery rỗng")
+        return GalleryMatcher([], [], [], metric=metric)
+    lock_dir = os.path.join(DATASET_DIR, lock_id)
+    try:
+        gallery = load_gallery(lock_dir)
+    except GalleryStoreError as e:
+        print(f"[ERROR] Gallery {lock_id} lỗi: {e}")
+        sys.exit(1)
+    if gallery is None or len(gallery.ids) == 0:
+        print(f"[ERROR] Khóa {lock_id} chưa có gallery (chạy trainer.py {lock_id})")
+        sys.exit(1)
+    if model_version is not None and gallery_model_version(gallery.header) != model_version:
+        print(f"[ERROR] Gallery {lock_id} tạo bằng {gallery_model_version(gallery.header)}, embedder là "
+              f"{model_version} (chạy trainer.py {lock_id} với cùng --embed_backend)")
+        sys.exit(1)
+    if match_mode != "full":
+        prototypes = load_prototypes(lock_dir)
+        if prototypes is not None:
+            return PrototypeMatcher(prototypes, gallery.embeddings, metric=metric, refine=match_mode == "refine",
+                                    reject_distance=FACE_MATCH_THRESHOLD)
+        print("[WARN] Chưa có prototype cho gallery này, dùng gallery đầy đủ.")
+    return GalleryMatcher(gallery.embeddings, gallery.ids, gallery.names, metric=metric,
+                          index=load_index(lock_dir), nprobe=nprobe)
+
+
+def build_stub_dispatcher(sink_delay=0.0):
+    """
+    Dispatcher với các sink storage/telegram/speech chỉ đếm sự kiện: giữ chi phí tạo + xếp hàng sự kiện
+    như lúc chạy thật nhưng không gọi Firebase, Telegram hay TTS.
+    sink_delay: giây mỗi sự kiện (giả lập mạng chậm), 0 = trả về ngay.
+    """
+    def handle(event, state):
+        if sink_delay:
+            time.sleep(sink_delay)
+
+    dispatcher = EventDispatcher()
+    for name in ('storage', 'telegram', 'speech'):
+        dispatcher.register_sink(name, handle, workers=1, queue_size=64)
+    return dispatcher
+
+
+def add_pipeline_args(parser, reverify_interval=1):
+    """
+    Các tùy chọn pipeline giống Recognize (dùng chung với e2e_latency.py).
+    """
+    parser.add_argument("--lock_id", help="Khóa có gallery để so khớp (bỏ trống: gallery rỗng)")
+    parser.add_argument("--pipeline", choices=PIPELINE_MODES, default="ssd_mtcnn")
+    parser.add_argument("--enhance_mode", choices=["frame", "roi"], default="frame")
+    parser.add_argument("--denoise", choices=DENOISE_MODES, default="nlm")
+    parser.add_argument("--embed_backend", choices=BACKENDS, default="torch")
+    parser.add_argument("--match_metric", choices=GalleryMatcher.METRICS, default="l2")
+    parser.add_argument("--match_mode", choices=MATCH_MODES, default="full")
+    parser.add_argument("--ann_nprobe", type=int, default=DEFAULT_NPROBE)
+    parser.add_argument("--level", type=int, default=0, choices=range(len(DEFAULT_LEVELS)),
+                        help="Mức chất lượng cố định của bộ lập lịch (0 = đầy đủ) để các lần chạy so sánh được")
+    parser.add_argument("--reverify_interval", type=int, default=reverify_interval,
+                        help="Frame giữa hai lần embed lại một track (như Recognize)")
+
+
+def build_tracker(args):
+    return FaceTracker(reverify_interval=args.reverify_interval,
+                       unknown_reverify_interval=min(5, args.reverify_interval))
+
+
+def build_pipeline(args, device):
+    """
+    Tải model và gallery như Recognize.main, thoát với [ERROR] nếu thiếu.
+    Returns: RecognitionPipeline
+    """
+    mtcnn = None
+    mtcnn_full = None
+    try:
+        if args.pipeline == "ssd_mtcnn":
+            mtcnn = load_mtcnn(device, keep_all=False, min_face_size=120, thresholds=[0.6, 0.7, 0.7],
+                               post_process=True)
+        elif args.pipeline == "mtcnn":
+            mtcnn_full = create_full_frame_mtcnn(device)
+        resnet = load_embedder(device, args.embed_backend)
+    except ModelLoadError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+    face_detector, face_cascade = load_face_detectors(args.pipeline)
+    if args.pipeline != "mtcnn" and face_detector is None and face_cascade is None:
+        print("[ERROR] Không tải được Haar Cascade.")
+        sys.exit(1)
+
+    matcher = build_matcher(args.lock_id, args.match_metric, args.match_mode, args.ann_nprobe,
+                            model_version=embedder_version(resnet))
+    return RecognitionPipeline(args.pipeline, resnet, device, matcher, build_tracker(args), FACE_MATCH_THRESHOLD,
+                               mtcnn=mtcnn, mtcnn_full=mtcnn_full, face_detector=face_detector,
+                               face_cascade=face_cascade, enhance_mode=args.enhance_mode,
+                               denoise=args.denoise, verbose=False)
+
+
+def environment_info(device):
+    return {
+        'git_commit': git_revision(),
+        'device': str(device),
+        'torch_threads': torch.get_num_threads(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'opencv': cv2.__version__,
+    }
+
+
+def run_replay(pipeline, frames, level, dispatcher, lock_id, warmup=0):
+    """
+    Chạy pipeline trên từng frame; 'decide' là thời gian tạo + gửi sự kiện cho khuôn mặt đã nhận ra.
+    Returns: dict thống kê (latency theo bước, thông lượng, số khuôn mặt/nhận diện)
+    """
+    samples = {stage: [] for stage in STAGES + ('decide', 'frame')}
+    frames_seen = 0
+    frames_measured = 0
+    faces = 0
+    embedded = 0
+    recognized = 0
+    read_ms = 0.0
+    pipeline_ms = 0.0
+
+    read_start = time.perf_counter()
+    for frame in frames:
+        read_ms += (time.perf_counter() - read_start) * 1000
+        frames_seen += 1
+        frame_start = time.perf_counter()
+        prepared = pipeline.preprocess(frame, level)
+        analysis = pipeline.analyze(prepared, level)
+
+        decide_start = time.perf_counter()
+        for match in analysis.matches:
+            if match is not None and match.distance < FACE_MATCH_THRESHOLD:
+                event = RecognitionEvent('SUCCESS', lock_id, match.name, match.confidence,
+                                         frame=prepared.frame.copy())
+                dispatcher.dispatch(event, ['storage', 'telegram', 'speech'])
+                if frames_seen > warmup:
+                    recognized += 1
+        decide_ms = (time.perf_counter() - decide_start) * 1000
+        frame_ms = (time.perf_counter() - frame_start) * 1000
+
+        if frames_seen > warmup:
+            frames_measured += 1
+            pipeline_ms += frame_ms
+            faces += len(analysis.face_boxes)
+            embedded += len(analysis.pending)
+            for stage, elapsed_ms in analysis.timings.items():
+                samples[stage].append(elapsed_ms)
+            if analysis.face_boxes:
+                samples['decide'].append(decide_ms)
+            samples['frame'].append(frame_ms)
+        read_start = time.perf_counter()
+
+    return {
+        'frames': frames_seen,
+        'frames_measured': frames_measured,
+        'warmup_frames': min(warmup, frames_seen),
+        'faces': faces,
+        'faces_embedded': embedded,
+        'recognized': recognized,
+        'read_ms_total': round(read_ms, 1),
+        'throughput_fps': round(frames_measured * 1000 / pipeline_ms, 2) if pipeline_ms else None,
+        'latency_ms': {stage: summarize(values) for stage, values in samples.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark headless: phát lại video hoặc ảnh qua preprocess -> detect -> align -> embed -> match")
+    parser.add_argument("--source", default=DEFAULT_SOURCE,
+                        help="File video, thư mục ảnh hoặc glob (mặc định PyCharm/temp/*.jpg)")
+    add_pipeline_args(parser)
+    parser.add_argument("--resize", help="Đổi kích thước frame, vd. 640x480 như camera")
+    parser.add_argument("--limit", type=int, default=0, help="Chỉ dùng N frame đầu tiên")
+    parser.add_argument("--repeat", type=int, default=1, help="Phát lại nguồn N lần để có thêm mẫu")
+    parser.add_argument("--warmup", type=int, default=3, help="Số frame đầu không tính vào thống kê")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.resize.lower().split('x')) if args.resize else None
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    pipeline = build_pipeline(args, device)
+    dispatcher = build_stub_dispatcher()
+
+    def frames():
+        for _ in range(max(1, args.repeat)):
+            yield from iter_frames(args.source, args.limit, size)
+
+    print(f"[BENCH] {args.source} | pipeline={args.pipeline}, enhance={args.enhance_mode}, "
+          f"backend={args.embed_backend}, level={args.level}")
+    wall_start = time.perf_counter()
+    results = run_replay(pipeline, frames(), DEFAULT_LEVELS[args.level], dispatcher, args.lock_id or "replay",
+                         warmup=args.warmup)
+    wall_s = time.perf_counter() - wall_start
+    dispatcher.stop(timeout=5)
+    if results['frames'] == 0:
+        print(f"[ERROR] Không có frame nào tại {args.source}")
+        sys.exit(1)
+
+    results['wall_s'] = round(wall_s, 3)
+    results['wall_fps'] = round(results['frames'] / wall_s, 2) if wall_s else None
+    report = {
+        'source': args.source,
+        'config': {k: v for k, v in vars(args).items() if k not in ('source', 'output')},
+        'environment': environment_info(device),
+        'results': results,
+        'pipeline': pipeline.stats(),
+        'dispatcher': dispatcher.stats(),
+        'models': load_metrics(),
+        'gallery_size': len(pipeline.matcher),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False, default=str)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"[INFO] Đã ghi kết quả: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
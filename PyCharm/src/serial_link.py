@@ -0,0 +1,285 @@
+# serial_link.py - Một thread duy nhất đọc cổng ESP32: tách dòng thành sự kiện, chia DISTANCE cho subscriber, trả lời lệnh chờ
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+
+import serial
+
+from metrics import REGISTRY
+
+# kind: DISTANCE (value = cm hoặc None khi OUT_RANGE), PIN_PROMPT, PIN_ENTERED (value = mã PIN),
+# PIN_TIMEOUT, CMD (value = lệnh ESP32 vừa nhận, từ dòng "[CMD] ..."), LOG (các dòng khác)
+SerialEvent = namedtuple('SerialEvent', ['kind', 'value', 'line', 'timestamp'])
+EVENT_KINDS = ('DISTANCE', 'PIN_PROMPT', 'PIN_ENTERED', 'PIN_TIMEOUT', 'CMD', 'LOG')
+
+# Số mẫu độ trễ giữ lại cho mỗi lệnh
+LATENCY_SAMPLES = 256
+RECENT_EVENTS = 64
+
+SERIAL_RTT = REGISTRY.histogram('smartlock_serial_rtt_seconds', 'Thời gian khứ hồi lệnh serial tới ESP32', ('command',))
+SERIAL_TIMEOUTS = REGISTRY.counter('smartlock_serial_timeouts', 'Lệnh serial hết thời gian chờ phản hồi', ('command',))
+SERIAL_LINES = REGISTRY.counter('smartlock_serial_lines', 'Dòng nhận từ ESP32 theo loại', ('kind',))
+
+
+def parse_line(line, timestamp=None):
+    """
+    Chuyển một dòng từ firmware thành SerialEvent.
+    """
+    timestamp = time.perf_counter() if timestamp is None else timestamp
+    if line.startswith("DISTANCE:"):
+        value = line[len("DISTANCE:"):].replace(" cm", "").strip()
+        if value == "OUT_RANGE":
+            return SerialEvent('DISTANCE', None, line, timestamp)
+        try:
+            return SerialEvent('DISTANCE', float(value), line, timestamp)
+        except ValueError:
+            return SerialEvent('LOG', None, line, timestamp)
+    if line.startswith("PIN_ENTERED:"):
+        return SerialEvent('PIN_ENTERED', line[len("PIN_ENTERED:"):].strip(), line, timestamp)
+    if line.startswith("[CMD] "):
+        return SerialEvent('CMD', line[len("[CMD] "):].strip(), line, timestamp)
+    if line in ("PIN_PROMPT", "PIN_TIMEOUT"):
+        return SerialEvent(line, None, line, timestamp)
+    return SerialEvent('LOG', None, line, timestamp)
+
+
+class CommandStats:
+    def __init__(self, command):
+        self.sent = 0
+        self.acked = 0
+        self.timeouts = 0
+        self.rtt_ms = deque(maxlen=LATENCY_SAMPLES)
+        self.rtt_metric = SERIAL_RTT.labels(command)
+        self.timeout_metric = SERIAL_TIMEOUTS.labels(command)
+
+    def as_dict(self):
+        rtt = sorted(self.rtt_ms)
+        summary = None
+        if rtt:
+            summary = {
+                'mean': round(sum(rtt) / len(rtt), 2),
+                'p50': round(rtt[len(rtt) // 2], 2),
+                'p95': round(rtt[min(len(rtt) - 1, int(len(rtt) * 0.95))], 2),
+                'max': round(rtt[-1], 2),
+            }
+        return {'sent': self.sent, 'acked': self.acked, 'timeouts': self.timeouts, 'rtt_ms': summary}
+
+
+class _Waiter:
+    def __init__(self, kinds, predicate, future, command=None, sent_at=None):
+        self.kinds = kinds
+        self.predicate = predicate
+        self.future = future
+        self.command = command
+        self.sent_at = sent_at
+
+
+class SerialLink:
+    """
+    Chủ sở hữu duy nhất của cổng serial ESP32.
+
+    - Thread I/O đọc từng dòng (readline chặn có timeout, không vòng bận) và phân loại thành SerialEvent.
+    - subscribe(kind, callback): nhận sự kiện (vd. DISTANCE) trong thread I/O, callback phải nhanh.
+    - request(command, expect): gửi lệnh, trả Future được giải quyết bằng sự kiện expect đầu tiên
+      (mặc định: dòng "[CMD] <command>" firmware in khi nhận lệnh); thời gian khứ hồi được ghi cho mỗi lệnh.
+    - wait_for(kinds, timeout, since): chờ sự kiện, kể cả sự kiện đã đến sau mốc since.
+
+    Ghi lệnh được tuần tự hóa bằng khóa ở thread gọi (pyserial đọc/ghi song công được),
+    nên gửi lệnh không phải chờ readline của thread I/O.
+    """
+
+    def __init__(self, ser, name="serial-link"):
+        self.ser = ser
+        self.distance = None
+        self.distance_at = None
+        self.lines_read = 0
+        self.read_errors = 0
+        self._subscribers = {}
+        self._line_metrics = {kind: SERIAL_LINES.labels(kind) for kind in EVENT_KINDS}
+        self._waiters = []
+        self._recent = deque(maxlen=RECENT_EVENTS)
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    @classmethod
+    def open(cls, port, baudrate=115200, read_timeout=0.5):
+        """
+        Returns: SerialLink đã chạy, hoặc None nếu không mở được cổng.
+        """
+        try:
+            ser = serial.Serial(port, baudrate, timeout=read_timeout)
+        except serial.SerialException as e:
+            print(f"[ERROR] Không thể kết nối Serial: {e}")
+            return None
+        print(f"[INFO] Đã kết nối Serial tại {port}")
+        return cls(ser).start()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def is_open(self):
+        return self.ser.is_open and not self._stop_event.is_set()
+
+    def close(self, timeout=2.0):
+        self._stop_event.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=timeout)
+        try:
+            self.ser.close()
+        except serial.SerialException:
+            pass
+        with self._lock:
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                raw = self.ser.readline()
+            except (serial.SerialException, OSError, TypeError) as e:
+                if not self._stop_event.is_set():
+                    self.read_errors += 1
+                    print(f"[ERROR] Lỗi Serial trong thread: {e}")
+                break
+            if not raw:
+                continue
+            line = raw.decode('utf-8', errors='ignore').strip()
+            if line:
+                self.lines_read += 1
+                event = parse_line(line)
+                self._line_metrics[event.kind].inc()
+                self._publish(event)
+        self._stop_event.set()
+
+    def _publish(self, event):
+        if event.kind == 'DISTANCE':
+            self.distance = event.value
+            self.distance_at = event.timestamp
+        with self._lock:
+            self._recent.append(event)
+            matched = [w for w in self._waiters if event.kind in w.kinds and w.predicate(event)]
+            for waiter in matched:
+                self._waiters.remove(waiter)
+                if waiter.command is not None:
+                    stats = self._command_stats(waiter.command)
+                    stats.acked += 1
+                    stats.rtt_ms.append((event.timestamp - waiter.sent_at) * 1000)
+                    stats.rtt_metric.observe(event.timestamp - waiter.sent_at)
+            callbacks = list(self._subscribers.get(event.kind, ()))
+        for waiter in matched:
+            if not waiter.future.done():
+                waiter.future.set_result(event)
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"[WARNING] Subscriber serial lỗi: {e}")
+
+    def _command_stats(self, command):
+        stats = self._stats.get(command)
+        if stats is None:
+            stats = self._stats[command] = CommandStats(command)
+        return stats
+
+    def subscribe(self, kind, callback):
+        with self._lock:
+            self._subscribers.setdefault(kind, []).append(callback)
+
+    def _add_waiter(self, kinds, predicate, command=None, sent_at=None, since=None):
+        future = Future()
+        waiter = _Waiter(kinds, predicate, future, command, sent_at)
+        with self._lock:
+            if since is not None:
+                for event in self._recent:
+                    if event.timestamp >= since and event.kind in kinds and predicate(event):
+                        future.set_result(event)
+                        return future, waiter
+            self._waiters.append(waiter)
+        return future, waiter
+
+    def _expire(self, waiter, timeout):
+        """
+        Hết thời gian: bỏ waiter, Future trả None.
+        """
+        def expire():
+            with self._lock:
+                if waiter not in self._waiters:
+                    return
+                self._waiters.remove(waiter)
+                if waiter.command is not None:
+                    stats = self._command_stats(waiter.command)
+                    stats.timeouts += 1
+                    stats.timeout_metric.inc()
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+        waiter.future.add_done_callback(lambda _: timer.cancel())
+
+    def send(self, command):
+        """
+        Ghi một lệnh (thêm '\\n'). Returns: perf_counter lúc ghi xong, None nếu lỗi.
+        """
+        if not self.is_open:
+            return None
+        try:
+            with self._write_lock:
+                self.ser.write(f"{command}\n".encode())
+                return time.perf_counter()
+        except serial.SerialException as e:
+            print(f"[ERROR] Lỗi Serial: {e}")
+            return None
+
+    def request(self, command, expect=None, timeout=10.0):
+        """
+        Gửi lệnh và trả Future -> SerialEvent phản hồi (hoặc None khi hết thời gian / lỗi).
+        expect: kind sự kiện chờ (vd. 'PIN_PROMPT'); None = dòng xác nhận "[CMD] <command>".
+        """
+        if expect is None:
+            kinds, predicate = ('CMD',), (lambda event: event.value == command)
+        else:
+            kinds, predicate = (expect,), (lambda event: True)
+        # Đăng ký trước khi ghi để không lỡ phản hồi nhanh
+        future, waiter = self._add_waiter(kinds, predicate, command=command, sent_at=time.perf_counter())
+        with self._lock:
+            self._command_stats(command).sent += 1
+        sent_at = self.send(command)
+        if sent_at is None:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            future.set_result(None)
+            return future
+        waiter.sent_at = sent_at
+        self._expire(waiter, timeout)
+        return future
+
+    def wait_for(self, kinds, timeout, since=None):
+        """
+        Chờ sự kiện đầu tiên thuộc kinds (chuỗi hoặc tuple); since: chấp nhận sự kiện đến từ mốc perf_counter này.
+        Returns: SerialEvent hoặc None khi hết thời gian.
+        """
+        kinds = (kinds,) if isinstance(kinds, str) else tuple(kinds)
+        future, waiter = self._add_waiter(kinds, lambda event: True, since=since)
+        if future.done():
+            return future.result()
+        self._expire(waiter, timeout)
+        return future.result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'lines_read': self.lines_read,
+                'read_errors': self.read_errors,
+                'pending': len(self._waiters),
+                'commands': {command: stats.as_dict() for command, stats in self._stats.items()},
+            }
@@ -1,23 +1,60 @@
+import argparse
+import copy
 import os
 import sys
-import pickle
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import firebase_admin
 from firebase_admin import credentials, storage
-from facenet_pytorch import MTCNN, InceptionResnetV1
 import torch
 from dotenv import load_dotenv
 import io
 import re
 import numpy as np
 
-# Cấu hình stdout (UTF-8) cho Windows
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+from gallery_store import (
+    save_gallery,
+    load_gallery,
+    load_manifest,
+    save_manifest,
+    sha256_file,
+    GalleryStoreError,
+    LEGACY_PICKLE,
+)
+from firebase_sync import sync_lock, DEFAULT_DOWNLOAD_WORKERS
+from model_loader import load_mtcnn, load_metrics
+from embedding_backend import load_embedder, BACKENDS, MODEL_VERSIONS
+from ann_index import build_index, load_index, EXACT_SEARCH_BELOW
+from gallery_prototypes import build_prototypes, load_prototypes, DEFAULT_PROTOTYPES
 
 # --- Cấu hình mặc định ---
 # Nếu bạn muốn trainer KHÔNG bao giờ download ảnh từ Firebase, set DOWNLOAD_FROM_FIREBASE = "false" trong .env
 DOWNLOAD_ENV_VAR = "DOWNLOAD_FROM_FIREBASE"
 
+# Đổi khi thay cấu hình phát hiện/căn chỉnh hoặc mô hình embedding -> manifest cũ tự bị bỏ, tạo lại toàn bộ
+DETECTOR_VERSION = "mtcnn-min50-v1"
+# (backend INT8 có phiên bản riêng, lấy từ embedder.model_version)
+MODEL_VERSION = MODEL_VERSIONS["torch"]
+
+# Lưu gallery + manifest sau mỗi N ảnh mới để chạy lại tiếp tục được nếu bị ngắt
+CHECKPOINT_EVERY = 25
+
+# Pipeline enroll: số thread giải mã ảnh, số ảnh mỗi lần gọi MTCNN, số khuôn mặt mỗi batch InceptionResnetV1
+DEFAULT_DECODE_WORKERS = min(8, os.cpu_count() or 2)
+DEFAULT_DETECT_BATCH = 16
+DEFAULT_BATCH_SIZE = 32
+
+# Cấu hình MTCNN của trainer (đổi thì phải đổi DETECTOR_VERSION)
+TRAINER_MTCNN_OPTIONS = {'keep_all': False, 'min_face_size': 50, 'thresholds': [0.6, 0.7, 0.7],
+                         'factor': 0.709, 'post_process': True, 'select_largest': True}
+
+# Ảnh trong một lần gọi MTCNN được gom theo kích thước (bước 64px) rồi pad về cùng cỡ
+SIZE_BUCKET = 64
+
+EnrollItem = namedtuple('EnrollItem', ['rel_path', 'local_path', 'face_id', 'name', 'info', 'source'])
+
 def initialize_firebase():
     """Khởi tạo kết nối đến Firebase và trả về object bucket."""
     env_path = os.path.join(os.path.dirname(__file__), '../.env/config.env')
@@ -62,45 +99,383 @@ def _extract_name_from_filename(filename):
     name = m.group(2).replace('_', ' ')
     return name
 
-def _process_image_file(img_path, mtcnn, resnet, device):
+class StageStats:
     """
-    Trả về embedding 1D numpy array hoặc None nếu gặp lỗi / không phát hiện khuôn mặt.
+    Đếm số ảnh và thời gian của từng bước (decode / detect / embed), in tiến độ mỗi report_every ảnh.
+    Thời gian decode là tổng thời gian của các thread (ảnh/s trên một thread).
     """
+
+    STAGES = ('decode', 'detect', 'embed')
+
+    def __init__(self, report_every=50):
+        self.report_every = report_every
+        self.counts = dict.fromkeys(self.STAGES, 0)
+        self.seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.faces = 0
+        self.start = time.perf_counter()
+
+    def add(self, stage, count, seconds):
+        before = self.counts[stage]
+        self.counts[stage] += count
+        self.seconds[stage] += seconds
+        if self.report_every and before // self.report_every != self.counts[stage] // self.report_every:
+            print(f"[PROGRESS] {stage}: {self.counts[stage]} ({self.rate(stage):.1f}/s)")
+
+    def rate(self, stage):
+        return self.counts[stage] / self.seconds[stage] if self.seconds[stage] > 0 else 0.0
+
+    def summary(self):
+        wall = time.perf_counter() - self.start
+        return {
+            'images': self.counts['decode'],
+            'faces': self.faces,
+            'wall_s': round(wall, 3),
+            'images_per_s': round(self.counts['decode'] / wall, 2) if wall > 0 else 0.0,
+            'stages': {
+                stage: {'count': self.counts[stage], 'seconds': round(self.seconds[stage], 3),
+                        'per_s': round(self.rate(stage), 2)}
+                for stage in self.STAGES
+            },
+        }
+
+
+def _decode_item(item):
+    start = time.perf_counter()
+    rgb = None
     try:
-        img = cv2.imread(img_path)
-        if img is None:
-            return None
-
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-        # MTCNN trả về tensor (face) khi dùng như mtcnn(img_rgb)
-        face = mtcnn(img_rgb)
-        if face is None:
-            return None
-
-        with torch.no_grad():
-            face = face.unsqueeze(0).to(device)
-            emb = resnet(face).detach().cpu().numpy()
-            emb = np.squeeze(emb)  # 1D vector
-            return emb
+        img = cv2.imread(item.local_path)
+        if img is not None:
+            rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     except Exception as e:
-        print(f"[ERROR] processing {img_path}: {e}")
-        return None
+        print(f"[ERROR] decoding {item.local_path}: {e}")
+    return item, rgb, time.perf_counter() - start
+
+
+def decode_images(items, workers, stats):
+    """
+    Giải mã ảnh song song bằng thread pool, giữ thứ tự và chỉ giữ tối đa workers * 4 ảnh đang chờ.
+    Yields: (item, ảnh RGB hoặc None)
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        window = deque()
+        for item in items:
+            window.append(pool.submit(_decode_item, item))
+            if len(window) >= workers * 4:
+                item_done, rgb, seconds = window.popleft().result()
+                stats.add('decode', 1, seconds)
+                yield item_done, rgb
+        while window:
+            item_done, rgb, seconds = window.popleft().result()
+            stats.add('decode', 1, seconds)
+            yield item_done, rgb
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for value in iterable:
+        chunk.append(value)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _pad_image(img, height, width):
+    if img.shape[:2] == (height, width):
+        return img
+    padded = np.zeros((height, width, 3), dtype=img.dtype)
+    padded[:img.shape[0], :img.shape[1]] = img
+    return padded
+
+
+def detect_and_align(decoded, mtcnn, detect_batch, stats):
+    """
+    Chạy MTCNN trên danh sách ảnh: ảnh cùng nhóm kích thước được pad (phải/dưới) về cùng cỡ
+    để detect một lần, box được cắt lại theo ảnh gốc, chọn khuôn mặt lớn nhất
+    (giống MTCNN(keep_all=False)) rồi căn chỉnh từ ảnh gốc.
+    Yields: (item, tensor 3x160x160 hoặc None)
+    """
+    for chunk in _chunks(decoded, detect_batch):
+        start = time.perf_counter()
+        valid = [i for i, (_, rgb) in enumerate(chunk) if rgb is not None]
+        boxes = {}
+        groups = {}
+        for i in valid:
+            h, w = chunk[i][1].shape[:2]
+            groups.setdefault((h // SIZE_BUCKET, w // SIZE_BUCKET), []).append(i)
+        for indices in groups.values():
+            height = max(chunk[i][1].shape[0] for i in indices)
+            width = max(chunk[i][1].shape[1] for i in indices)
+            try:
+                batch_boxes, _ = mtcnn.detect([_pad_image(chunk[i][1], height, width) for i in indices])
+            except Exception as e:
+                print(f"[ERROR] MTCNN batch failed: {e}")
+                continue
+            for i, found in zip(indices, batch_boxes):
+                if found is None or len(found) == 0:
+                    continue
+                h, w = chunk[i][1].shape[:2]
+                found = found.copy()
+                found[:, [0, 2]] = np.clip(found[:, [0, 2]], 0, w)
+                found[:, [1, 3]] = np.clip(found[:, [1, 3]], 0, h)
+                areas = (found[:, 2] - found[:, 0]) * (found[:, 3] - found[:, 1])
+                largest = int(np.argmax(areas))
+                boxes[i] = found[largest:largest + 1]
+
+        aligned = {}
+        if boxes:
+            order = sorted(boxes)
+            faces = mtcnn.extract([chunk[i][1] for i in order], [boxes[i] for i in order], None)
+            aligned = dict(zip(order, faces))
+        stats.add('detect', len(chunk), time.perf_counter() - start)
+        for i, (item, _) in enumerate(chunk):
+            yield item, aligned.get(i)
+
+
+def embed_faces(aligned_stream, resnet, device, batch_size, stats):
+    """
+    Gom khuôn mặt đã căn chỉnh thành batch batch_size cho InceptionResnetV1 (torch.inference_mode).
+    Yields: (item, embedding 1D numpy hoặc None) theo đúng thứ tự đầu vào.
+    """
+    pending = []
+    pending_faces = 0
+
+    def flush():
+        faces = [face for _, face in pending if face is not None]
+        embeddings = iter(())
+        if faces:
+            start = time.perf_counter()
+            with torch.inference_mode():
+                embeddings = iter(resnet(torch.stack(faces).to(device)).cpu().numpy())
+            stats.add('embed', len(faces), time.perf_counter() - start)
+            stats.faces += len(faces)
+        return [(item, next(embeddings) if face is not None else None) for item, face in pending]
+
+    for item, face in aligned_stream:
+        pending.append((item, face))
+        if face is not None:
+            pending_faces += 1
+        if pending_faces >= batch_size:
+            yield from flush()
+            pending, pending_faces = [], 0
+    if pending:
+        yield from flush()
+
+
+def embed_images(items, mtcnn, resnet, device, batch_size=DEFAULT_BATCH_SIZE,
+                 detect_batch=DEFAULT_DETECT_BATCH, workers=DEFAULT_DECODE_WORKERS, stats=None):
+    """
+    Pipeline enroll dạng generator: decode song song -> MTCNN theo danh sách -> embedding theo batch.
+    Yields: (item, embedding hoặc None)
+    """
+    stats = stats or StageStats()
+    decoded = decode_images(items, workers, stats)
+    aligned = detect_and_align(decoded, mtcnn, detect_batch, stats)
+    return embed_faces(aligned, resnet, device, batch_size, stats)
+
+
+def trainer_mtcnn(device, base=None):
+    """
+    MTCNN theo cấu hình của trainer. Nếu có base (MTCNN đã tải, vd. của Recognize) thì chỉ sao chép
+    nông và đổi tham số phát hiện: dùng chung trọng số P/R/O-Net, không tải lại.
+    """
+    if base is None:
+        return load_mtcnn(device, **TRAINER_MTCNN_OPTIONS)
+    mtcnn = copy.copy(base)
+    for key, value in TRAINER_MTCNN_OPTIONS.items():
+        setattr(mtcnn, key, value)
+    mtcnn.image_size = 160
+    mtcnn.margin = 0
+    mtcnn.selection_method = None
+    return mtcnn
+
 
-def generate_embeddings(lock_id):
+def _load_models(mtcnn=None, resnet=None, device=None, backend="torch"):
     """
-    Tạo embeddings cho tất cả người trong lock_id.
+    Dùng model đã tải nếu được truyền vào, chỉ tải phần còn thiếu (embedder theo backend).
+    Returns: (mtcnn theo cấu hình trainer, resnet, device)
+    """
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        print(f"[INFO] Using device: {device}")
+    if resnet is None:
+        resnet = load_embedder(device, backend)
+    return trainer_mtcnn(device, base=mtcnn), resnet, device
+
+
+def _lock_dataset_dir(lock_id):
+    base_dataset_dir = os.path.join(os.path.dirname(__file__), '..', 'dataset')
+    return os.path.join(base_dataset_dir, lock_id)
+
+
+def iter_local_images(dataset_dir):
+    """
+    Yields: (face_id, filename, đường dẫn) cho mọi ảnh trong dataset/<lock_id>/<face_id>/
+    """
+    if not os.path.isdir(dataset_dir):
+        return
+    for entry in sorted(os.listdir(dataset_dir)):
+        face_dir = os.path.join(dataset_dir, entry)
+        if not os.path.isdir(face_dir):
+            continue
+        # duyệt tất cả file ảnh trong thư mục người dùng
+        for filename in sorted(os.listdir(face_dir)):
+            if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
+                yield entry, filename, os.path.join(face_dir, filename)
+
+
+class IncrementalGallery:
+    """
+    Gallery được cập nhật tăng dần theo manifest:
+    manifest['entries'][đường dẫn tương đối] = {size, mtime, sha256, face_id, name, row}
+    (row = hàng trong gallery, None nếu ảnh không có khuôn mặt).
+    - Ảnh có cùng size + mtime (hoặc cùng hash nếu mtime đổi) dùng lại embedding cũ.
+    - Ảnh mới/đổi nội dung được embed lại; ảnh đã xóa bị bỏ khi commit.
+    - Manifest chỉ hợp lệ khi cùng detector/model version và cùng generation với gallery.
+    """
+
+    def __init__(self, dataset_dir, full=False, model_version=MODEL_VERSION):
+        self.dataset_dir = dataset_dir
+        self.model_version = model_version
+        self.entries = {}
+        self.vectors = {}
+        self.seen = set()
+        self.reused = 0
+        self.embedded = 0
+        self._since_checkpoint = 0
+        self._header = None
+        self._dirty = True
+        if not full:
+            self._load_previous()
+
+    def _load_previous(self):
+        manifest = load_manifest(self.dataset_dir)
+        if manifest is None:
+            return
+        if manifest.get('detector') != DETECTOR_VERSION or manifest.get('model') != self.model_version:
+            print("[INFO] Detector/model version changed, rebuilding all embeddings")
+            return
+        try:
+            gallery = load_gallery(self.dataset_dir, migrate=False)
+        except GalleryStoreError as e:
+            print(f"[WARN] Gallery lỗi ({e}), rebuilding all embeddings")
+            return
+        if gallery is None or gallery.header.get('generation') != manifest.get('gallery_generation'):
+            print("[WARN] Manifest không khớp gallery, rebuilding all embeddings")
+            return
+        for rel_path, entry in manifest.get('entries', {}).items():
+            row = entry.get('row')
+            if row is not None:
+                if row >= len(gallery.embeddings):
+                    continue
+                self.vectors[rel_path] = np.array(gallery.embeddings[row])
+            self.entries[rel_path] = entry
+        self._header = gallery.header
+        self._dirty = False
+
+    def lookup(self, rel_path, abs_path):
+        """
+        Returns: (True, None) nếu ảnh không đổi (đã giữ lại kết quả cũ),
+        hoặc (False, (stat, sha256)) nếu cần embed. Hash đọc file theo từng khối, không giữ nội dung:
+        ảnh được đọc lại và giải mã trong thread decode của pipeline.
+        """
+        self.seen.add(rel_path)
+        st = os.stat(abs_path)
+        entry = self.entries.get(rel_path)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+            self.reused += 1
+            return True, None
+        digest = sha256_file(abs_path)
+        if entry is not None and entry['sha256'] == digest:
+            # Chỉ đổi mtime (copy/sync lại), nội dung giữ nguyên
+            entry['size'], entry['mtime'] = st.st_size, st.st_mtime_ns
+            self.reused += 1
+            self._dirty = True
+            return True, None
+        return False, (st, digest)
+
+    def add(self, rel_path, info, face_id, name, emb):
+        st, digest = info
+        self.entries[rel_path] = {
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'sha256': digest,
+            'face_id': face_id,
+            'name': name,
+            'row': None,
+        }
+        if emb is not None:
+            self.vectors[rel_path] = np.ravel(emb).astype(np.float32)
+        else:
+            self.vectors.pop(rel_path, None)
+        self.embedded += 1
+        self._dirty = True
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= CHECKPOINT_EVERY:
+            self.save(drop_unseen=False)
+
+    def save(self, drop_unseen=True):
+        """
+        Ghi gallery rồi manifest (thứ tự hàng theo đường dẫn).
+        drop_unseen=True bỏ các ảnh không còn trên đĩa (chỉ dùng ở lần commit cuối).
+        """
+        if drop_unseen:
+            for rel_path in [p for p in self.entries if p not in self.seen]:
+                del self.entries[rel_path]
+                self.vectors.pop(rel_path, None)
+                self._dirty = True
+
+        if not self._dirty:
+            # Không có gì thay đổi: giữ nguyên gallery hiện tại
+            return self._header, self._header['count']
+
+        paths = sorted(p for p in self.entries if p in self.vectors)
+        embeddings = [self.vectors[p] for p in paths]
+        ids = [self.entries[p]['face_id'] for p in paths]
+        names = [self.entries[p]['name'] for p in paths]
+        for entry in self.entries.values():
+            entry['row'] = None
+        for row, rel_path in enumerate(paths):
+            self.entries[rel_path]['row'] = row
+
+        header = save_gallery(self.dataset_dir, embeddings, ids, names, model_version=self.model_version)
+        save_manifest(self.dataset_dir, {
+            'detector': DETECTOR_VERSION,
+            'model': self.model_version,
+            'gallery_generation': header['generation'],
+            'entries': self.entries,
+        })
+        self._since_checkpoint = 0
+        self._header = header
+        self._dirty = False
+        return header, len(paths)
+
+
+def generate_embeddings(lock_id, full=False, batch_size=DEFAULT_BATCH_SIZE,
+                        detect_batch=DEFAULT_DETECT_BATCH, workers=DEFAULT_DECODE_WORKERS,
+                        download_workers=DEFAULT_DOWNLOAD_WORKERS, mtcnn=None, resnet=None, device=None,
+                        bucket=None, backend="torch", ann_min_size=EXACT_SEARCH_BELOW, prototypes=0):
+    """
+    Tạo embeddings cho tất cả người trong lock_id (gọi được trực tiếp từ tiến trình khác, vd. Recognize).
     Quy trình:
-    1) Quét thư mục local dataset/<lock_id>/<face_id>/* — ưu tiên dùng local.
-    2) Nếu local không có file nào, (và biến env cho phép) sẽ query Firebase và download chỉ các file thiếu.
-    3) Lưu embeddings.pkl trong dataset/<lock_id>/embeddings.pkl
+    1) Nếu biến env cho phép: đồng bộ Firebase (firebase_sync.sync_lock) — chỉ tải blob thiếu/đã đổi.
+    2) Quét thư mục local dataset/<lock_id>/<face_id>/*, mỗi file được xét đúng một lần.
+    3) Lưu gallery (gallery.json + embeddings.<n>.npy + labels.<n>.npy) trong dataset/<lock_id>/
+    Chỉ ảnh mới hoặc đã đổi mới được embed (theo manifest.json); full=True tạo lại toàn bộ.
+    Gallery từ ann_min_size mẫu trở lên có thêm chỉ mục IVF (ann_index) cho Recognize.
+    prototypes > 0: nén thêm mỗi người thành vài prototype (gallery_prototypes, tối đa N khi không biết hướng mặt).
+    Ảnh cần embed đi qua pipeline embed_images (decode song song, MTCNN và resnet theo batch).
+    mtcnn/resnet/device/bucket: model và bucket đã khởi tạo để dùng lại; None -> tự tải
+    (resnet theo backend: torch / onnx / onnx-int8, xem embedding_backend).
+    Returns: Gallery vừa lưu, hoặc None nếu không lưu được.
     """
-    print(f"[START] Generating embeddings for lock: {lock_id}")
+    print(f"[START] Generating embeddings for lock: {lock_id}{' (full rebuild)' if full else ''}")
+    start_time = time.perf_counter()
 
     # Khởi tạo Firebase (chỉ khi cần list/download)
-    bucket = None
     download_allowed = should_download_from_firebase()
-    if download_allowed:
+    if download_allowed and bucket is None:
         try:
             bucket = initialize_firebase()
         except Exception as e:
@@ -108,116 +483,131 @@ def generate_embeddings(lock_id):
             bucket = None
             # Nếu không có Firebase và không có local -> file embeddings rỗng sẽ được tạo
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f"[INFO] Using device: {device}")
-
-    mtcnn = MTCNN(keep_all=False, min_face_size=50, device=device)
-    resnet = InceptionResnetV1(pretrained='vggface2').eval().to(device)
-
-    known_embeddings = []
-    known_ids = []
-    known_names = []
+    mtcnn, resnet, device = _load_models(mtcnn, resnet, device, backend)
 
     # Thư mục dataset dành cho lock
-    base_dataset_dir = os.path.join(os.path.dirname(__file__), '..', 'dataset')
-    dataset_dir = os.path.join(base_dataset_dir, lock_id)
+    dataset_dir = _lock_dataset_dir(lock_id)
     os.makedirs(dataset_dir, exist_ok=True)
 
-    # ---- 1) QUÉT LOCAL: dataset/<lock_id>/<face_id>/* ----
-    local_found_any = False
-    if os.path.isdir(dataset_dir):
-        for entry in sorted(os.listdir(dataset_dir)):
-            face_dir = os.path.join(dataset_dir, entry)
-            if not os.path.isdir(face_dir):
-                continue
-            face_id = entry
-            # duyệt tất cả file ảnh trong thư mục người dùng
-            for filename in sorted(os.listdir(face_dir)):
-                if not filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    continue
-                local_found_any = True
-                local_path = os.path.join(face_dir, filename)
-                emb = _process_image_file(local_path, mtcnn, resnet, device)
-                if emb is not None:
-                    known_embeddings.append(emb)
-                    known_ids.append(face_id)
-                    # Nếu tên người trong filename -> lấy, nếu không -> face_id
-                    name = _extract_name_from_filename(filename) or face_id
-                    known_names.append(name)
-                    print(f"[LOCAL] Processed {face_id}/{filename} -> {name}")
-                else:
-                    print(f"[LOCAL] No face found in {local_path} (skipped)")
-
-    # ---- 2) NẾU KHÔNG CÓ LOCAL HOẶC MUỐN BỔ SUNG: QUÉT FIREBASE (chỉ khi cho phép) ----
+    gallery = IncrementalGallery(dataset_dir, full=full,
+                                 model_version=getattr(resnet, 'model_version', MODEL_VERSION))
+    pending = []
+
+    def embed_if_needed(face_id, filename, local_path, source):
+        rel_path = f"{face_id}/{filename}"
+        unchanged, info = gallery.lookup(rel_path, local_path)
+        if unchanged:
+            return
+        # Nếu tên người trong filename -> lấy, nếu không -> face_id
+        name = _extract_name_from_filename(filename) or face_id
+        pending.append(EnrollItem(rel_path, local_path, face_id, name, info, source))
+
+    # ---- 1) ĐỒNG BỘ FIREBASE (chỉ khi cho phép): chỉ tải blob thiếu hoặc đã đổi ----
+    downloaded = set()
     if download_allowed and bucket is not None:
-        # chuẩn bị prefix cho cả faces và pending_faces
-        prefixes = [f"locks/{lock_id}/faces/", f"locks/{lock_id}/pending_faces/"]
-        for prefix in prefixes:
-            try:
-                blobs = list(bucket.list_blobs(prefix=prefix))
-            except Exception as e:
-                print(f"[WARN] Không thể list blobs cho prefix {prefix}: {e}")
-                blobs = []
-
-            for blob in blobs:
-                try:
-                    parts = blob.name.split('/')
-                    # mong muốn dạng: locks/<lockId>/(faces|pending_faces)/<userId>/<filename>
-                    if len(parts) < 5:
-                        continue
-                    blob_lock, folder_type, user_id = parts[0], parts[2], parts[3] if len(parts) >= 4 else None
-                    # parts layout check
-                    user_id = parts[3]
-                    filename = parts[4]
-
-                    # local expected path: dataset/<lock_id>/<user_id>/<filename>
-                    local_user_dir = os.path.join(dataset_dir, user_id)
-                    os.makedirs(local_user_dir, exist_ok=True)
-                    local_path = os.path.join(local_user_dir, filename)
-
-                    # Nếu file đã được xử lý trong local pass (tránh xử lý duplicate)
-                    # Nếu local exists, _process_image_file sẽ handle nó (we already processed local above).
-                    # Chỉ download nếu file local chưa có
-                    if not os.path.exists(local_path):
-                        try:
-                            blob.download_to_filename(local_path)
-                            print(f"[DOWNLOAD] {blob.name} -> {local_path}")
-                        except Exception as e:
-                            print(f"[WARN] Không thể download {blob.name}: {e}")
-                            continue
-                    else:
-                        # nếu đã có local, chỉ thông báo
-                        print(f"[SKIP] Local exists, skip download: {local_path}")
-
-                    # Sau khi đảm bảo file tồn tại local, process nó
-                    emb = _process_image_file(local_path, mtcnn, resnet, device)
-                    if emb is not None:
-                        known_embeddings.append(emb)
-                        known_ids.append(user_id)
-                        name = _extract_name_from_filename(filename) or user_id
-                        known_names.append(name)
-                        print(f"[FIREBASE] Processed {user_id}/{filename} -> {name}")
-                    else:
-                        print(f"[FIREBASE] No face found in {local_path} (skipped)")
-
-                except Exception as e:
-                    print(f"[ERROR] processing blob {getattr(blob, 'name', str(blob))}: {e}")
-
-    # ---- 3) LƯU embeddings (dưới dạng pickle) ----
-    embeddings_path = os.path.join(dataset_dir, "embeddings.pkl")
+        try:
+            downloaded = sync_lock(bucket, lock_id, dataset_dir, workers=download_workers)
+        except Exception as e:
+            print(f"[WARN] Không thể đồng bộ Firebase: {e}. Tiếp tục chỉ với local files.")
+
+    # ---- 2) QUÉT LOCAL: dataset/<lock_id>/<face_id>/* (mỗi file chỉ vào embedder một lần) ----
+    for face_id, filename, local_path in iter_local_images(dataset_dir):
+        source = "FIREBASE" if f"{face_id}/{filename}" in downloaded else "LOCAL"
+        embed_if_needed(face_id, filename, local_path, source)
+
+    # ---- 3) EMBED các ảnh mới/đổi theo batch ----
+    if pending:
+        print(f"[INFO] Embedding {len(pending)} new/changed images "
+              f"(batch {batch_size}, detect batch {detect_batch}, {workers} decode threads)")
+        stats = StageStats()
+        for item, emb in embed_images(pending, mtcnn, resnet, device, batch_size, detect_batch, workers, stats):
+            gallery.add(item.rel_path, item.info, item.face_id, item.name, emb)
+            if emb is not None:
+                print(f"[{item.source}] Processed {item.rel_path} -> {item.name}")
+            else:
+                print(f"[{item.source}] No face found in {item.local_path} (skipped)")
+        print(f"[STATS] {stats.summary()}")
+
+    # ---- 4) LƯU gallery (ghi nguyên tử, có checksum) ----
     try:
-        # Chuyển embeddings thành list để pickle ổn định
-        # (mỗi embedding là 1D numpy array)
-        pickle.dump((known_embeddings, known_ids, known_names), open(embeddings_path, 'wb'))
-        print(f"[DONE] Embeddings saved to: {embeddings_path}")
-        print(f"[SUMMARY] Total faces processed: {len(known_ids)}")
+        header, total = gallery.save()
+        # Pickle cũ không còn dùng, tránh bị chuyển đổi đè lên gallery mới
+        legacy_path = os.path.join(dataset_dir, LEGACY_PICKLE)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+        print(f"[DONE] Gallery saved to: {dataset_dir} (generation {header['generation']})")
+        if load_index(dataset_dir) is None:
+            build_index(dataset_dir, min_size=ann_min_size)
+        if prototypes and load_prototypes(dataset_dir) is None:
+            build_prototypes(dataset_dir, per_identity=prototypes)
+        print(f"[SUMMARY] Total faces: {total} (embedded {gallery.embedded}, reused {gallery.reused}) "
+              f"in {time.perf_counter() - start_time:.1f}s")
+        return load_gallery(dataset_dir, migrate=False)
     except Exception as e:
         print(f"[ERROR] Không thể lưu embeddings: {e}")
+        return None
+
+def benchmark_enrollment(lock_id, batch_size=DEFAULT_BATCH_SIZE, detect_batch=DEFAULT_DETECT_BATCH,
+                         workers=DEFAULT_DECODE_WORKERS, limit=0, backend="torch"):
+    """
+    Chạy pipeline enroll trên mọi ảnh local của khóa (không đọc manifest, không ghi gallery)
+    và trả về thông lượng ảnh/s từng bước.
+    """
+    items = [
+        EnrollItem(f"{face_id}/{filename}", path, face_id, face_id, None, "BENCH")
+        for face_id, filename, path in iter_local_images(_lock_dataset_dir(lock_id))
+    ]
+    if limit:
+        items = items[:limit]
+    if not items:
+        print(f"[ERROR] Không có ảnh local cho khóa {lock_id}")
+        return None
+    mtcnn, resnet, device = _load_models(backend=backend)
+    stats = StageStats(report_every=0)
+    for _ in embed_images(items, mtcnn, resnet, device, batch_size, detect_batch, workers, stats):
+        pass
+    summary = stats.summary()
+    summary.update({'device': str(device), 'batch_size': batch_size, 'detect_batch': detect_batch,
+                    'workers': workers, 'torch_threads': torch.get_num_threads(), 'backend': backend,
+                    'models': load_metrics()})
+    return summary
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python trainer.py <lock_id>")
-        sys.exit(1)
+    # Cấu hình stdout (UTF-8) cho Windows
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+    parser = argparse.ArgumentParser(description="Tạo/cập nhật gallery embeddings cho một khóa")
+    parser.add_argument("lock_id")
+    parser.add_argument("--full", action="store_true", help="Bỏ qua manifest, embed lại toàn bộ ảnh")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Số khuôn mặt mỗi batch InceptionResnetV1")
+    parser.add_argument("--detect_batch", type=int, default=DEFAULT_DETECT_BATCH,
+                        help="Số ảnh mỗi lần gọi MTCNN")
+    parser.add_argument("--workers", type=int, default=DEFAULT_DECODE_WORKERS, help="Số thread giải mã ảnh")
+    parser.add_argument("--download_workers", type=int, default=DEFAULT_DOWNLOAD_WORKERS,
+                        help="Số luồng tải ảnh từ Firebase")
+    parser.add_argument("--embed_backend", choices=BACKENDS, default="torch",
+                        help="Backend embedding (onnx/onnx-int8 cần export trước bằng embedding_backend.py)")
+    parser.add_argument("--ann_min_size", type=int, default=EXACT_SEARCH_BELOW,
+                        help="Tạo chỉ mục ANN (IVF) khi gallery có từ N mẫu trở lên")
+    parser.add_argument("--prototypes", type=int, nargs='?', const=DEFAULT_PROTOTYPES, default=0,
+                        help="Nén gallery thành prototype theo người (N prototype khi ảnh không có hướng mặt)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Chỉ đo thông lượng (ảnh/s) trên ảnh local, không ghi gallery")
+    parser.add_argument("--limit", type=int, default=0, help="--benchmark: chỉ dùng N ảnh đầu")
+    args = parser.parse_args()
 
-    lock_id_arg = sys.argv[1]
-    generate_embeddings(lock_id_arg)
+    if args.benchmark:
+        result = benchmark_enrollment(args.lock_id, args.batch_size, args.detect_batch, args.workers, args.limit,
+                                      backend=args.embed_backend)
+        if result is None:
+            sys.exit(1)
+        import json
+        print(json.dumps(result, indent=2))
+    else:
+        gallery = generate_embeddings(args.lock_id, full=args.full, batch_size=args.batch_size,
+                                      detect_batch=args.detect_batch, workers=args.workers,
+                                      download_workers=args.download_workers, backend=args.embed_backend,
+                                      ann_min_size=args.ann_min_size, prototypes=args.prototypes)
+        if gallery is None:
+            sys.exit(1)
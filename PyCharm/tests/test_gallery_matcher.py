@@ -0,0 +1,32 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from gallery_matcher import GalleryMatcher  # noqa: E402
+
+
+def _matcher(metric='l2'):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(4, 512)).astype(np.float32)
+    return GalleryMatcher(embeddings, ['a', 'b', 'c', 'd'], ['A', 'B', 'C', 'D'], metric=metric), embeddings
+
+
+def test_match_empty_query_returns_empty_list():
+    # stack_embeddings trả về ma trận (0, 512) khi frame không có mặt nào căn chỉnh được
+    for metric in GalleryMatcher.METRICS:
+        matcher, _ = _matcher(metric)
+        empty = np.zeros((0, 512), dtype=np.float32)
+        assert matcher.match(empty) == []
+        assert matcher.distances(empty).shape == (0, 4)
+        indices, dists = matcher.search(empty, k=2)
+        assert indices.shape == (0, 2) and dists.shape == (0, 2)
+
+
+def test_match_finds_exact_row():
+    matcher, embeddings = _matcher()
+    results = matcher.match(embeddings[[2, 0]])
+    assert [top[0].face_id for top in results] == ['c', 'a']
+    assert results[0][0].distance < 1e-3
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from gallery_prototypes import PrototypeMatcher, PrototypeSet  # noqa: E402
+
+
+def test_match_empty_query_returns_empty_list():
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(6, 512)).astype(np.float32)
+    ids = ['a', 'a', 'a', 'b', 'b', 'b']
+    protos = PrototypeSet.build(embeddings, ids, [i.upper() for i in ids], per_identity=2)
+    for refine in (False, True):
+        matcher = PrototypeMatcher(protos, embeddings, refine=refine)
+        assert matcher.match(np.zeros((0, 512), dtype=np.float32)) == []
+        assert matcher.match(embeddings[[4]])[0][0].face_id == 'b'
@@ -0,0 +1,50 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import gallery_store  # noqa: E402
+from gallery_store import GalleryStoreError, load_gallery, remove_gallery, save_gallery  # noqa: E402
+
+
+def _save(lock_dir):
+    embeddings = np.arange(8 * 512, dtype=np.float32).reshape(8, 512)
+    return save_gallery(str(lock_dir), embeddings, ['a'] * 4 + ['b'] * 4, ['A'] * 4 + ['B'] * 4)
+
+
+def test_default_load_skips_hash_when_files_unchanged(tmp_path, monkeypatch):
+    _save(tmp_path)
+    calls = []
+    monkeypatch.setattr(gallery_store, 'sha256_file', lambda path: calls.append(path))
+    gallery = load_gallery(str(tmp_path))
+    assert len(gallery.ids) == 8 and calls == []
+
+
+def test_changed_file_is_hashed(tmp_path):
+    header = _save(tmp_path)
+    matrix_path = os.path.join(str(tmp_path), header['matrix'])
+    data = np.load(matrix_path)
+    data[0, 0] += 1.0
+    np.save(matrix_path, data)
+    with pytest.raises(GalleryStoreError):
+        load_gallery(str(tmp_path))
+    # verify=True luôn hash toàn bộ, kể cả khi stat khớp
+    _save(tmp_path)
+    assert load_gallery(str(tmp_path), verify=True) is not None
+
+
+def test_header_records_model_version(tmp_path):
+    embeddings = np.zeros((2, 512), dtype=np.float32)
+    save_gallery(str(tmp_path), embeddings, ['a', 'b'], ['A', 'B'], model_version='inceptionresnetv1-vggface2-int8-v1')
+    assert load_gallery(str(tmp_path)).header['model_version'] == 'inceptionresnetv1-vggface2-int8-v1'
+
+
+def test_remove_gallery_deletes_generation_sidecars(tmp_path):
+    header = _save(tmp_path)
+    for name in (f"ivf.{header['generation']}.npz", "prototypes.1.npz", "prototypes.0.npz", "face_1.jpg"):
+        (tmp_path / name).write_bytes(b"x")
+    remove_gallery(str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == ['face_1.jpg']
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from image_enhancement import RoiEnhancer  # noqa: E402
+
+
+def _face(seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 80, size=(160, 160, 3), dtype=np.uint8)
+
+
+def test_roi_cache_hits_when_box_jitters_by_a_pixel():
+    enhancer = RoiEnhancer()
+    face = _face()
+    first = enhancer.enhance(face, track_id=1, box=(100, 80, 160, 160))
+    second = enhancer.enhance(face, track_id=1, box=(101, 79, 161, 160))
+    assert second is first
+    assert enhancer.hits == 1 and enhancer.misses == 1
+
+
+def test_roi_cache_misses_when_box_moves_or_content_changes():
+    enhancer = RoiEnhancer()
+    face = _face()
+    enhancer.enhance(face, track_id=1, box=(100, 80, 160, 160))
+    enhancer.enhance(face, track_id=1, box=(180, 80, 160, 160))
+    enhancer.enhance(np.full_like(face, 200), track_id=1, box=(180, 80, 160, 160))
+    assert enhancer.hits == 0 and enhancer.misses == 3